@@ -0,0 +1,1332 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import download_l8_imgs
+import download_utils
+
+
+""" Local stand-in for the M2M download servers. GET /<name>?size=<bytes> returns that many
+    bytes as an attachment called <name>, generated on the fly so the server itself doesn't
+    hold the file in memory. Byte i of every file is PATTERN[i % len(PATTERN)], so a body
+    resumed from the wrong offset doesn't match. Range requests ("bytes=<start>-[<end>]") are
+    answered with 206 unless &norange=1 is given. &send=<bytes> cuts a full (non-range)
+    response short after that many bytes while still announcing size in Content-Length,
+    like a dropped connection, and &rate=<bytes/s> throttles each connection. """
+class FileHandler(BaseHTTPRequestHandler):
+    PATTERN = bytes(range(256)) * 255 + bytes(range(241)) # 65521 bytes, a prime length
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        name, _, query = self.path.lstrip("/").partition("?")
+        params = dict(pair.split("=") for pair in query.split("&") if pair)
+        size = int(params.get("size", 0))
+        rate = int(params.get("rate", 0))
+        start, length = 0, size
+        requested = self.headers.get("Range")
+        if requested and "norange" not in params:
+            first, _, last = requested[len("bytes="):].partition("-")
+            start = int(first)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            length = min(size, int(last) + 1 if last else size) - start
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{start + length - 1}/{size}")
+            end = start + length
+        else:
+            self.send_response(200)
+            end = min(size, int(params.get("send", size)))
+        self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+        self.send_header("Content-Length", str(length))
+        if "norange" not in params:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        position = start
+        began = time.perf_counter()
+        while position < end:
+            offset = position % len(self.PATTERN)
+            data = self.PATTERN[offset:offset + end - position]
+            self.wfile.write(data)
+            position += len(data)
+            if rate:
+                # sleep until this connection is back under its rate
+                time.sleep(max(0.0, (position - start) / rate - (time.perf_counter() - began)))
+
+    @classmethod
+    def content(cls, size):
+        return (cls.PATTERN * (size // len(cls.PATTERN) + 1))[:size]
+
+
+""" Local stand-in for the M2M JSON API. Every POST gets {"errorCode": null, "data": ...}.
+    scene-search pages through total_hits fake scenes, scene lists are kept per listId for
+    download-options, and download-request makes each requested download available after
+    the next of release_delays seconds (cycling; 0 means right away), with a URL on
+    file_url. The other endpoints return small canned payloads. It speaks
+    HTTP/1.1 so clients can keep connections open. Each new connection waits connect_delay
+    seconds before being served, standing in for the TCP/TLS handshake round trips to the
+    real server, and each request waits request_delay, standing in for the server's work. """
+class M2MHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connect_delay = 0.0
+    request_delay = 0.0
+    total_hits = 50
+    release_delays = [0]
+    file_url = ""
+    connections = 0
+    retrieve_calls = 0
+    scene_lists = {}
+    requested_downloads = {}
+    lock = threading.Lock()
+    DATA = {
+        "login": "api-key",
+        "scene-list-remove": None,
+    }
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes; don't let Nagle hold the body back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with M2MHandler.lock:
+            M2MHandler.connections += 1
+        time.sleep(self.connect_delay)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        time.sleep(self.request_delay)
+        if endpoint == "scene-search":
+            first = payload.get("startingNumber", 1)
+            last = min(self.total_hits, first + payload.get("maxResults", 100) - 1)
+            data = {"results": [{"entityId": f"LC8{i:06d}"} for i in range(first, last + 1)],
+                    "recordsReturned": max(0, last - first + 1),
+                    "totalHits": self.total_hits,
+                    "startingNumber": first}
+        elif endpoint == "scene-list-add":
+            with M2MHandler.lock:
+                self.scene_lists.setdefault(payload.get("listId"), []).extend(payload.get("entityIds", []))
+            data = len(payload.get("entityIds", []))
+        elif endpoint == "download-request":
+            now = time.time()
+            with M2MHandler.lock:
+                for i, product in enumerate(payload.get("downloads", [])):
+                    released = now + self.release_delays[i % len(self.release_delays)]
+                    url = f"{self.file_url}{product['entityId']}.tar?size=1024&released={released}"
+                    self.requested_downloads[i] = {"downloadId": i, "entityId": product["entityId"],
+                                                   "url": url, "released": released}
+                # like the real API, download-request doesn't say which entity a download is for
+                available = [{"downloadId": d["downloadId"], "eulaCode": None, "url": d["url"]}
+                             for d in self.requested_downloads.values() if d["released"] <= now]
+                preparing = [{"downloadId": d["downloadId"], "eulaCode": None, "url": None}
+                             for d in self.requested_downloads.values() if d["released"] > now]
+            data = {"availableDownloads": available, "preparingDownloads": preparing}
+        elif endpoint == "download-retrieve":
+            now = time.time()
+            with M2MHandler.lock:
+                M2MHandler.retrieve_calls += 1
+                available = [d for d in self.requested_downloads.values() if d["released"] <= now]
+                requested = [dict(d, url=None) for d in self.requested_downloads.values() if d["released"] > now]
+            data = {"available": available, "requested": requested}
+        elif endpoint == "download-options":
+            with M2MHandler.lock:
+                entity_ids = self.scene_lists.get(payload.get("listId"), [])
+            data = [{"entityId": entity_id, "id": f"P{entity_id}", "bulkAvailable": True} for entity_id in entity_ids]
+        else:
+            if endpoint == "scene-list-remove":
+                with M2MHandler.lock:
+                    self.scene_lists.pop(payload.get("listId"), None)
+            data = self.DATA.get(endpoint)
+        body = json.dumps({"errorCode": None, "errorMessage": None, "data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+""" ThreadingHTTPServer that doesn't print the connection resets the checks cause on purpose. """
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass
+
+
+""" Start a server with the given handler on a free local port in a background thread. """
+def start_server(handler=FileHandler):
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/"
+
+
+""" Return the result of func(*args), its wall time, and the peak memory python allocated while it ran. """
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+""" The download_file from before streaming: reads the whole body with response.content. """
+def buffered_download(url):
+    response = requests.get(url, stream=True)
+    filename = download_utils.filename_from_response(response)
+    destination = os.path.join(download_utils.path, filename)
+    with open(destination, 'wb') as file:
+        file.write(response.content)
+    return destination
+
+
+""" Compare peak memory of the streaming download_file with reading the whole response. """
+def benchmark_memory(args):
+    server, base_url = start_server()
+    size = args.megabytes * (1 << 20)
+    with tempfile.TemporaryDirectory() as directory:
+        download_utils.path = directory
+        download_utils.download_chunk_size = args.chunk_size
+        url = f"{base_url}scene.tar?size={size}"
+
+        _, elapsed, peak = measure(buffered_download, url)
+        print(f"buffered:  {elapsed:.2f} s, peak {peak / (1 << 20):.1f} MB")
+        os.remove(os.path.join(directory, "scene.tar"))
+
+        filename, elapsed, peak = measure(download_utils.download_file, url)
+        destination = os.path.join(directory, filename)
+        print(f"streaming: {elapsed:.2f} s, peak {peak / (1 << 20):.1f} MB "
+              f"(chunk size {args.chunk_size / (1 << 10):.0f} KB)")
+        if os.path.getsize(destination) != size:
+            raise Exception(f"downloaded {os.path.getsize(destination)} of {size} bytes")
+    server.shutdown()
+
+
+""" Download a file whose first response is cut short, then download it again: the second
+    attempt should continue from the .part with a Range request, and the journal should
+    record both the partial and the finished download. Repeated against a server that
+    ignores Range, where the second attempt has to start over. """
+def check_resume(args):
+    server, base_url = start_server()
+    size = args.megabytes * (1 << 20)
+    expected = FileHandler.content(size)
+    for norange in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            download_utils.path = directory
+            download_utils.journal = download_utils.DownloadJournal(os.path.join(directory, "journal.json"))
+            url = f"{base_url}scene.tar?size={size}" + ("&norange=1" if norange else "")
+            try:
+                download_utils.download_file(f"{url}&send={size // 3}", entity_id="LC08_TEST")
+            except (IOError, requests.exceptions.RequestException) as e:
+                print(f"first attempt failed as expected: {type(e).__name__}")
+            else:
+                raise Exception("the truncated download did not raise")
+            entry = download_utils.journal.get("LC08_TEST")
+            print(f"journal after failure: {entry}")
+            if entry["complete"] or entry["bytes"] != download_utils.partial_size("scene.tar"):
+                raise Exception("the journal does not match the partial download")
+
+            start = time.perf_counter()
+            download_utils.download_file(url, entity_id="LC08_TEST")
+            elapsed = time.perf_counter() - start
+            with open(os.path.join(directory, "scene.tar"), 'rb') as file:
+                if file.read() != expected:
+                    raise Exception("the resumed file differs from the original")
+            if os.path.exists(os.path.join(directory, "scene.tar.part")):
+                raise Exception("the .part file was left behind")
+            print(f"journal after retry: {download_utils.journal.get('LC08_TEST')}")
+            print(f"{'restarted (no Range support)' if norange else 'resumed'} in {elapsed:.2f} s, contents match\n")
+    download_utils.journal = None
+    server.shutdown()
+
+
+""" Compare one connection against segmented downloads of a file from a server that throttles
+    each connection, and check every segmented copy matches the original. """
+def benchmark_segments(args):
+    server, base_url = start_server()
+    size = args.megabytes * (1 << 20)
+    expected = FileHandler.content(size)
+    url = f"{base_url}scene.tar?size={size}&rate={args.rate << 20}"
+    download_utils.SEGMENT_MIN_BYTES = 0
+    with tempfile.TemporaryDirectory() as directory:
+        download_utils.path = directory
+        for segments in args.segments:
+            download_utils.segments = segments
+            download_utils.sema = threading.Semaphore(args.connections)
+            start = time.perf_counter()
+            filename = download_utils.download_file(url)
+            elapsed = time.perf_counter() - start
+            with open(os.path.join(directory, filename), 'rb') as file:
+                if file.read() != expected:
+                    raise Exception(f"the file downloaded with {segments} segments differs from the original")
+            os.remove(os.path.join(directory, filename))
+            print(f"{segments} segment(s): {elapsed:.2f} s ({size / elapsed / (1 << 20):.1f} MB/s), contents match\n")
+    download_utils.sema = None
+    download_utils.segments = 1
+    server.shutdown()
+
+
+""" The send_request from before the shared session: a new connection for every call. """
+def unpooled_request(url, data, apiKey=None):
+    headers = {'X-Auth-Token': apiKey} if apiKey else None
+    response = requests.post(url, json.dumps(data), headers=headers)
+    output = json.loads(response.text)
+    response.close()
+    return output['data']
+
+
+""" Time the M2M call sequence download_l8_imgs.py makes (login, search, list add, download
+    options, list remove, download request, then download-retrieve polls), sending each
+    call over a new connection vs over the shared pooled session, from several threads. """
+def benchmark_session(args):
+    M2MHandler.connect_delay = args.connect_ms / 1000
+    server, base_url = start_server(M2MHandler)
+    endpoints = ["login", "scene-search", "scene-list-add", "download-options", "scene-list-remove",
+                 "download-request"] + ["download-retrieve"] * args.polls
+
+    def run(send):
+        def sequence():
+            for endpoint in endpoints:
+                send(base_url + endpoint, {"label": "benchmark"}, "api-key")
+        M2MHandler.connections = 0
+        start = time.perf_counter()
+        threads = [threading.Thread(target=sequence) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, M2MHandler.connections
+
+    calls = len(endpoints) * args.threads
+    print(f"{args.threads} thread(s) x {len(endpoints)} calls, {args.connect_ms} ms per new connection")
+    for label, send in (("new connection per call", unpooled_request),
+                        ("pooled session", download_utils.send_request)):
+        download_utils.http_session = download_utils.HTTPSession(pool_size=args.threads)
+        elapsed, connections = run(send)
+        print(f"{label:24}: {elapsed:.3f} s, {elapsed / calls * 1000:.1f} ms/call, {connections} connections")
+    download_utils.http_session = None
+    server.shutdown()
+
+
+""" Run download_l8_imgs.search against the mock API with a large archive, comparing the old
+    single request (which only returned max_results scenes) with paging sequentially and
+    concurrently, and check every scene comes back once, in order. """
+def benchmark_search(args):
+    M2MHandler.total_hits = args.scenes
+    M2MHandler.request_delay = args.delay_ms / 1000
+    server, base_url = start_server(M2MHandler)
+    download_utils.http_session = download_utils.HTTPSession(pool_size=2 * max(args.threads) + 1)
+    expected = [f"LC8{i:06d}" for i in range(1, args.scenes + 1)]
+    print(f"{args.scenes} matching scenes, {args.delay_ms} ms per request, pages of {args.page_size}")
+    for threads in args.threads:
+        start = time.perf_counter()
+        downloads = download_l8_imgs.search(base_url, "api-key", "landsat_ot_c2_l2", max_results=0,
+                                            page_size=args.page_size, search_threads=threads)
+        elapsed = time.perf_counter() - start
+        if [d['entityId'] for d in downloads] != expected:
+            raise Exception(f"search with {threads} thread(s) returned the wrong scenes")
+        if M2MHandler.scene_lists:
+            raise Exception("search left scene lists behind")
+        print(f"{threads} search thread(s): {elapsed:.2f} s, {len(downloads)} scenes, all present and in order")
+    download_utils.http_session = None
+    server.shutdown()
+
+
+""" Run download_l8_imgs.request_downloads against the mock API, which releases downloads
+    on a schedule, polling at a fixed interval vs adaptively, and report how long each URL
+    waited between becoming available and being handed to the download pool. Every download
+    must end up in the journal under its entityId. """
+def benchmark_polling(args):
+    file_server, M2MHandler.file_url = start_server()
+    M2MHandler.release_delays = [0] + [args.spread * (i + 1) / args.downloads for i in range(args.downloads - 1)]
+    api_server, api_url = start_server(M2MHandler)
+    downloads = [{"entityId": f"LC8{i:06d}", "productId": i} for i in range(args.downloads)]
+    print(f"{args.downloads} downloads released over {args.spread} s")
+    with tempfile.TemporaryDirectory() as directory:
+        download_utils.path = directory
+        for label, min_interval, max_interval in (("fixed", args.fixed, args.fixed),
+                                                  ("adaptive", args.min_interval, args.max_interval)):
+            M2MHandler.requested_downloads = {}
+            M2MHandler.retrieve_calls = 0
+            download_utils.journal = download_utils.DownloadJournal(os.path.join(directory, f"{label}.json"))
+            start = time.perf_counter()
+            with download_utils.DownloadManager(workers=4) as manager:
+                download_l8_imgs.request_downloads(api_url, "api-key", downloads, manager,
+                                                   min_interval, max_interval)
+                results = manager.join()
+            elapsed = time.perf_counter() - start
+            delays = sorted(r.submitted_at - float(r.url.rsplit("released=", 1)[1]) for r in results)
+            print(f"{label} ({min_interval}-{max_interval} s): {elapsed:.2f} s total, "
+                  f"{M2MHandler.retrieve_calls} polls, availability-to-dispatch median "
+                  f"{delays[len(delays) // 2]:.2f} s, max {delays[-1]:.2f} s")
+            download_utils.print_download_stats(results)
+            print()
+            if not all(download_utils.journal.is_complete(d["entityId"]) for d in downloads):
+                raise Exception("downloads are missing from the journal under their entityId")
+    download_utils.journal = None
+    api_server.shutdown()
+    file_server.shutdown()
+
+
+""" Samples the total size of the files in a directory on a background thread and keeps the
+    largest total seen. """
+class DiskUsageMonitor:
+    def __init__(self, directory, interval=0.01):
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            total = 0
+            for entry in os.scandir(self.directory):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+            self.peak = max(self.peak, total)
+
+
+""" Download scenes from the throttled local server and upload them to a moto s3 bucket,
+    first the old way (every download, then every upload one at a time) and then pipelined
+    (each file queued for upload as soon as it has downloaded and deleted once uploaded),
+    comparing wall time and peak disk usage. Requires moto. """
+def benchmark_pipeline(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the pipeline benchmark needs boto3 and moto (pip install moto)")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    server, base_url = start_server()
+    size = args.megabytes * (1 << 20)
+    filenames = [f"LC08_L2SP_008056_2021{month:02d}{day:02d}_20210105_02_T1.tar"
+                 for month, day in zip(range(1, 13), range(1, 29))][:args.scenes]
+    urls = [f"{base_url}{filename}?size={size}&rate={args.rate << 20}" for filename in filenames]
+    print(f"{len(urls)} scenes of {args.megabytes} MB, {args.rate} MB/s per download connection")
+
+    def sequential(s3, bucket):
+        with download_utils.DownloadManager(workers=args.workers) as manager:
+            for url in urls:
+                manager.submit(url)
+            results = manager.join()
+        for result in results:
+            download_utils.upload_to_s3(result.filename, bucket,
+                                        download_l8_imgs.l8_s3_prefix(result.filename, "landsat"), s3, delete=True)
+
+    def pipelined(s3, bucket):
+        with download_utils.S3Uploader(bucket, s3, workers=args.upload_threads,
+                                       transfer_threads=args.transfer_threads,
+                                       chunk_size=8 << 20) as uploader:
+            def upload(result):
+                uploader.submit(result.filename, download_l8_imgs.l8_s3_prefix(result.filename, "landsat"))
+            with download_utils.DownloadManager(workers=args.workers, on_download=upload) as manager:
+                for url in urls:
+                    manager.submit(url)
+                manager.join()
+            uploader.join()
+
+    with tempfile.TemporaryDirectory() as directory, mock_aws():
+        # upload_to_s3 takes file names relative to the working directory, like the script
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            s3 = boto3.resource("s3")
+            for label, run in (("download, then upload", sequential), ("pipelined", pipelined)):
+                bucket = label.split(",")[0].replace(" ", "-")
+                s3.create_bucket(Bucket=bucket)
+                with DiskUsageMonitor(directory) as monitor:
+                    start = time.perf_counter()
+                    run(s3, bucket)
+                    elapsed = time.perf_counter() - start
+                keys = sorted(obj.key for obj in s3.Bucket(bucket).objects.all())
+                expected = sorted(download_utils.s3_join(download_l8_imgs.l8_s3_prefix(f, "landsat"), f)
+                                  for f in filenames)
+                if keys != expected:
+                    raise Exception(f"{label}: bucket holds {keys}, expected {expected}")
+                if os.listdir(directory):
+                    raise Exception(f"{label}: local files left behind: {os.listdir(directory)}")
+                print(f"{label:22}: {elapsed:.2f} s, peak disk {monitor.peak / (1 << 20):.0f} MB, "
+                      f"{len(keys)} objects uploaded\n")
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+
+""" Stream scenes from the throttled local server straight into a moto s3 bucket with
+    stream_to_s3, checking every object matches the original and nothing touches local disk,
+    then check a download cut short leaves no object behind. Requires moto. """
+def benchmark_stream(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the stream benchmark needs boto3 and moto (pip install moto)")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    server, base_url = start_server()
+    size = args.megabytes * (1 << 20)
+    filenames = [f"LC08_L2SP_008056_2021{month:02d}{day:02d}_20210105_02_T1.tar"
+                 for month, day in zip(range(1, 13), range(1, 29))][:args.scenes]
+    prefix_for = functools.partial(download_l8_imgs.l8_s3_prefix, dataset_name="landsat")
+    print(f"{len(filenames)} scenes of {args.megabytes} MB, {args.rate} MB/s per download connection")
+
+    with tempfile.TemporaryDirectory() as directory, mock_aws():
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            s3 = boto3.resource("s3")
+            s3.create_bucket(Bucket="landsat")
+            stream = functools.partial(download_utils.stream_to_s3, bucket="landsat", s3=s3, prefix_for=prefix_for,
+                                       chunk_size=8 << 20, transfer_threads=args.transfer_threads)
+            with DiskUsageMonitor(directory) as monitor:
+                start = time.perf_counter()
+                with download_utils.DownloadManager(workers=args.workers, download=stream) as manager:
+                    for filename in filenames:
+                        manager.submit(f"{base_url}{filename}?size={size}&rate={args.rate << 20}")
+                    results = manager.join()
+                elapsed = time.perf_counter() - start
+            expected = FileHandler.content(size)
+            for filename in filenames:
+                key = download_utils.s3_join(prefix_for(filename), filename)
+                if s3.Object("landsat", key).get()["Body"].read() != expected:
+                    raise Exception(f"s3://landsat/{key} differs from the original")
+            if not all(result.ok for result in results):
+                raise Exception("some streams failed")
+            print(f"streamed {len(filenames)} scenes in {elapsed:.2f} s, objects match, "
+                  f"peak local disk {monitor.peak} bytes\n")
+
+            manager = download_utils.DownloadManager(workers=1, max_tries=1, download=stream)
+            with manager:
+                manager.submit(f"{base_url}{filenames[0].replace('2021', '2022')}?size={size}&send={size // 2}")
+                result, = manager.join()
+            leftovers = [obj.key for obj in s3.Bucket("landsat").objects.all() if "2022" in obj.key]
+            uploads = s3.meta.client.list_multipart_uploads(Bucket="landsat").get("Uploads", [])
+            if result.ok or leftovers or uploads:
+                raise Exception(f"truncated stream: ok={result.ok}, objects={leftovers}, open uploads={uploads}")
+            print("truncated stream raised and left no object or open multipart upload behind")
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+
+""" Adds latency to every request of the boto3 clients created after install() (standing in
+    for cross-region round trips) and answers a share of the copy requests with 503 SlowDown. """
+class S3Conditions:
+    def __init__(self, latency=0.05, throttle_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.copy_requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def install(self):
+        import boto3
+        events = boto3._get_default_session().events
+        events.register("before-send.s3", self.before_send, unique_id="benchmark-s3-conditions")
+
+    def uninstall(self):
+        import boto3
+        boto3._get_default_session().events.unregister("before-send.s3", unique_id="benchmark-s3-conditions")
+
+    def before_send(self, request, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        time.sleep(self.latency)
+        if not self.throttle_every or "x-amz-copy-source" not in request.headers:
+            return None
+        with self.lock:
+            self.copy_requests += 1
+            throttle = self.copy_requests % self.throttle_every == 0
+            self.throttled += throttle
+        if throttle:
+            body = b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>"
+            return AWSResponse(request.url, 503, {}, RawBody(body))
+        return None
+
+
+""" Minimal stand-in for the urllib3 response botocore reads a response body from. """
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+""" The per-key existence check download_s2_imgs_s3.download made before every copy. """
+def check_existence(s3_client, bucket, target_prefix):
+    response = s3_client.list_objects_v2(Bucket=bucket, MaxKeys=1, Prefix=target_prefix, RequestPayer='requester')
+    return 'Contents' in response
+
+
+""" Put fake sentinel-s2-l2a objects for the farm tiles into a moto bucket: every wanted file
+    plus extra_files other keys per acquisition, on every day but each fifth one. Returns the
+    number of wanted objects. """
+def fill_s2_bucket(s3, tiles, files, start_date, days, extra_files=0, large_mb=0, reprocessed_every=0, split_every=0,
+                   band_kb=1):
+    import datetime
+    s3.create_bucket(Bucket="sentinel-s2-l2a")
+    wanted = 0
+    for day in range(days):
+        if day % 5 == 4: # sentinel-2 revisits every 5 days here; leave gaps like the real bucket
+            continue
+        date = start_date + datetime.timedelta(days=day)
+        # sequence 1 is the same datatake with a newer processing baseline, or the second half of a split datatake
+        sequences = [(0, "T153621", "N0300")]
+        if reprocessed_every and day % reprocessed_every == 1:
+            sequences.append((1, "T153621", "N0301"))
+        elif split_every and day % split_every == 2:
+            sequences.append((1, "T155011", "N0300"))
+        for tile in tiles:
+            for sequence, sensing, baseline in sequences:
+                prefix = f"tiles/{tile}{date.year}/{date.month}/{date.day}/{sequence}/"
+                product_name = (f"S2A_MSIL2A_{date:%Y%m%d}{sensing}_{baseline}_R068_T{tile.replace('/', '')}_"
+                                f"{date:%Y%m%d}T19422{sequence}")
+                for file in files:
+                    size = (large_mb << 20) if day == 0 and file.endswith(".jp2") and large_mb else 1024
+                    size = (band_kb << 10) if file.endswith(".jp2") and size == 1024 else size
+                    body = b"x" * size
+                    if file == "tileInfo.json":
+                        # a reprocessing or the other half of a datatake reports its own cloud cover
+                        body = json.dumps({"cloudyPixelPercentage": (day * 37 + 50 * sequence) % 100,
+                                           "dataCoveragePercentage": 100.0,
+                                           "productName": product_name}).encode()
+                    s3.put_object(Bucket="sentinel-s2-l2a", Body=body, Key=prefix + file)
+                    wanted += 1
+                for i in range(extra_files):
+                    s3.put_object(Bucket="sentinel-s2-l2a", Body=b"", Key=f"{prefix}R60m/B{i:02d}.jp2")
+    return wanted
+
+
+""" Copy a month of (tile, date, file) objects for the two farm tiles from a moto stand-in of
+    the sentinel-s2-l2a bucket (with some days missing and two large JP2s), first one at a time
+    like the original loop, then with download_s2_imgs_s3.download and its S3Copier, and check
+    the destination buckets match. Then checks S3Copier retries connection errors and keeps a
+    CopyResult for every copy with a client that times out, can't connect or breaks. Requires moto. """
+def benchmark_copy(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the copy benchmark needs boto3 and moto (pip install moto)")
+    import datetime
+    import download_s2_imgs_s3
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    start_date = datetime.datetime(2021, 10, 1)
+    end_date = start_date + datetime.timedelta(days=args.days - 1)
+    conditions = S3Conditions(latency=args.latency_ms / 1000, throttle_every=args.throttle_every)
+
+    with mock_aws():
+        s3 = boto3.client("s3")
+        sources = fill_s2_bucket(s3, tiles, files, start_date, args.days, large_mb=args.large_mb)
+        print(f"{sources} source objects over {args.days} days ({args.large_mb} MB JP2s on the first day), "
+              f"{args.latency_ms} ms per request" + (f", every {args.throttle_every}th copy request throttled"
+                                                     if args.throttle_every else ""))
+
+        def serial(bucket):
+            client = boto3.client("s3")
+            temp_date = start_date
+            while temp_date.date() <= end_date.date():
+                date_str = f"{temp_date.year}/{temp_date.month}/{temp_date.day}/0/"
+                for tile in tiles:
+                    for file in files:
+                        target_prefix = f'tiles/{tile}{date_str}{file}'
+                        if check_existence(client, "sentinel-s2-l2a", target_prefix):
+                            client.copy({'Bucket': "sentinel-s2-l2a", 'Key': target_prefix}, bucket,
+                                        f"sentinel-2/{tile}{date_str}{os.path.basename(file)}",
+                                        ExtraArgs={'RequestPayer': 'requester'})
+                temp_date += datetime.timedelta(days=1)
+
+        def concurrent(bucket):
+            with tempfile.TemporaryDirectory() as directory:
+                results = download_s2_imgs_s3.download(bucket, start_date, end_date, tiles, files,
+                                                       workers=args.workers, part_threads=args.part_threads,
+                                                       catalog_path=os.path.join(directory, "s2_catalog.sqlite"))
+            if sum(r.ok for r in results) != sources:
+                raise Exception(f"{sum(r.ok for r in results)} of {sources} objects copied")
+
+        listings = {}
+        for label, run in (("serial", serial), ("S3Copier", concurrent)):
+            bucket = f"dst-{label.lower()}"
+            s3.create_bucket(Bucket=bucket)
+            conditions.install()
+            try:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    run(bucket)
+                elapsed = time.perf_counter() - start
+            finally:
+                conditions.uninstall()
+            listings[label] = sorted((o["Key"], o["Size"]) for o in s3.list_objects_v2(Bucket=bucket)["Contents"])
+            summary = [line for line in output.getvalue().splitlines() if line.startswith("Copied")]
+            print(f"{label:8}: {elapsed:.2f} s" + (f" - {summary[0]}" if summary else ""))
+        if listings["serial"] != listings["S3Copier"] or len(listings["serial"]) != sources:
+            raise Exception("the destination buckets differ")
+        print(f"both destination buckets hold the same {sources} objects; {conditions.throttled} copy requests throttled")
+
+    # connection errors: retried like throttling, and never lose the other results
+    from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+
+    class FlakyClient:
+        def __init__(self):
+            self.calls = {}
+
+        def copy(self, copy_source, bucket, key, **kwargs):
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if key == "down":
+                raise EndpointConnectionError(endpoint_url="https://s3.example.com")
+            if key == "timeout" and self.calls[key] == 1:
+                raise ReadTimeoutError(endpoint_url="https://s3.example.com")
+            if key == "broken":
+                raise ValueError("not a boto error")
+
+    client = FlakyClient()
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        with download_utils.S3Copier(client, workers=2, max_tries=3, backoff=0) as copier:
+            for key in ("fine", "timeout", "down", "broken"):
+                copier.submit("src", key, "dst", key)
+            results = copier.join()
+    states = {r.dst_key: (r.ok, r.attempts) for r in results}
+    print(f"flaky client: {states}")
+    if states != {"fine": (True, 1), "timeout": (True, 2), "down": (False, 3), "broken": (False, 1)}:
+        raise Exception("S3Copier didn't retry connection errors or lost a result")
+
+
+""" Count the LIST requests needed to find a year of the farm tiles' files in a moto stand-in
+    of the sentinel-s2-l2a bucket: one existence check per tile, day and file (the old loop)
+    vs s2_catalog.list_available, and check both find the same keys. Requires moto. """
+def benchmark_listing(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the listing benchmark needs boto3 and moto (pip install moto)")
+    import datetime
+    import s2_catalog
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    start_date = datetime.datetime(2021, 1, 1)
+    end_date = start_date + datetime.timedelta(days=args.days - 1)
+    with mock_aws():
+        s3 = boto3.client("s3")
+        wanted = fill_s2_bucket(s3, tiles, files, start_date, args.days, extra_files=args.extra_files)
+        calls = []
+        s3.meta.events.register("before-call.s3.ListObjectsV2", lambda **kwargs: calls.append(1))
+        print(f"{args.days} days, {wanted} wanted objects among {wanted // len(files) * (len(files) + args.extra_files)}")
+
+        start = time.perf_counter()
+        found = set()
+        temp_date = start_date
+        while temp_date.date() <= end_date.date():
+            date_str = f"{temp_date.year}/{temp_date.month}/{temp_date.day}/0/"
+            for tile in tiles:
+                for file in files:
+                    if check_existence(s3, "sentinel-s2-l2a", f'tiles/{tile}{date_str}{file}'):
+                        found.add((tile, temp_date.date(), 0, file))
+            temp_date += datetime.timedelta(days=1)
+        print(f"per-key checks: {len(calls)} LIST requests, {time.perf_counter() - start:.2f} s, {len(found)} found")
+
+        calls.clear()
+        start = time.perf_counter()
+        available = s2_catalog.list_available(s3, "sentinel-s2-l2a", tiles, start_date, end_date, files)
+        print(f"list_available: {len(calls)} LIST requests, {time.perf_counter() - start:.2f} s, {len(available)} found")
+        if available != found:
+            raise Exception("list_available found different keys than the per-key checks")
+
+
+""" Plan a copy from an s2_catalog.S2Catalog over a moto stand-in of the sentinel-s2-l2a bucket:
+    build it for a year of the farm tiles, plan the same year again, then extend the range by
+    a month, counting the LIST and tileInfo.json GET requests each refresh makes and checking the
+    planned keys match a fresh list_available. A second catalog is synced for January, then June,
+    then January to June, which must list the months in between. Requires moto. """
+def benchmark_catalog(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the catalog benchmark needs boto3 and moto (pip install moto)")
+    import datetime
+    import s2_catalog
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    start_date = datetime.datetime(2021, 1, 1)
+    end_date = start_date + datetime.timedelta(days=args.days - 1)
+    with mock_aws(), tempfile.TemporaryDirectory() as directory:
+        s3 = boto3.client("s3")
+        fill_s2_bucket(s3, tiles, files, start_date, args.days + 31, extra_files=args.extra_files)
+        calls = {"ListObjectsV2": 0, "GetObject": 0}
+        for operation in calls:
+            s3.meta.events.register(f"before-call.s3.{operation}",
+                                    lambda operation=operation, **kwargs: calls.__setitem__(operation, calls[operation] + 1))
+
+        catalog = s2_catalog.S2Catalog(os.path.join(directory, "s2_catalog.sqlite"))
+        # a second catalog synced for January, then June, then January to June must still list February to May
+        disjoint = s2_catalog.S2Catalog(os.path.join(directory, "s2_disjoint.sqlite"))
+        year = start_date.year
+        steps = (("first sync", catalog, start_date, end_date), ("same range", catalog, start_date, end_date),
+                 ("one more month", catalog, start_date, end_date + datetime.timedelta(days=31)),
+                 ("january", disjoint, datetime.date(year, 1, 1), datetime.date(year, 1, 31)),
+                 ("june", disjoint, datetime.date(year, 6, 1), datetime.date(year, 6, 30)),
+                 ("january-june", disjoint, datetime.date(year, 1, 1), datetime.date(year, 6, 30)))
+        for label, step_catalog, step_start, step_end in steps:
+            for operation in calls:
+                calls[operation] = 0
+            start = time.perf_counter()
+            added = step_catalog.refresh(s3, tiles, step_start, step_end)
+            available = step_catalog.available(tiles, step_start, step_end, files)
+            elapsed = time.perf_counter() - start
+            print(f"{label:14}: {calls['ListObjectsV2']:3} LIST, {calls['GetObject']:3} GET, {elapsed:.2f} s, "
+                  f"{added} new acquisitions, {len(available)} keys planned")
+            if available != s2_catalog.list_available(s3, "sentinel-s2-l2a", tiles, step_start, step_end, files):
+                raise Exception(f"the catalog plans different keys than list_available ({label})")
+        disjoint.close()
+        clear = catalog.acquisitions(tiles, start_date, end_date, cloud_max=args.cloud_max)
+        print(f"{len(clear)} of {len(catalog.acquisitions(tiles, start_date, end_date))} acquisitions in the first "
+              f"range have at most {args.cloud_max}% cloud cover")
+        catalog.close()
+
+
+""" Copy a month of the farm tiles from a moto stand-in of the sentinel-s2-l2a bucket where some days
+    were reprocessed (a sequence 1 with a newer processing baseline) and some datatakes were split
+    (a sequence 1 with another sensing time), with download_s2_imgs_s3.download, and check the
+    destination holds exactly the newest processing of every datatake. Copies again with a cloud_max,
+    which must skip the cloudy newest sequences without bringing back the ones they supersede.
+    Requires moto. """
+def benchmark_sequences(args):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        raise Exception("the sequences benchmark needs boto3 and moto (pip install moto)")
+    import datetime
+    import download_s2_imgs_s3
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    start_date = datetime.datetime(2021, 10, 1)
+    end_date = start_date + datetime.timedelta(days=args.days - 1)
+    with mock_aws(), tempfile.TemporaryDirectory() as directory:
+        s3 = boto3.client("s3")
+        sources = fill_s2_bucket(s3, tiles, files, start_date, args.days,
+                                 reprocessed_every=args.reprocessed_every, split_every=args.split_every)
+        expected, only_first, clear = set(), set(), set()
+        superseded = 0
+        for day in range(args.days):
+            if day % 5 == 4:
+                continue
+            date = start_date + datetime.timedelta(days=day)
+            only_first |= {f"sentinel-2/{tile}{date.year}/{date.month}/{date.day}/0/{os.path.basename(file)}"
+                           for tile in tiles for file in files}
+            if args.reprocessed_every and day % args.reprocessed_every == 1:
+                sequences = [1]
+                superseded += len(tiles)
+            elif args.split_every and day % args.split_every == 2:
+                sequences = [0, 1]
+            else:
+                sequences = [0]
+            expected |= {f"sentinel-2/{tile}{date.year}/{date.month}/{date.day}/{sequence}/{os.path.basename(file)}"
+                         for tile in tiles for sequence in sequences for file in files}
+            clear |= {f"sentinel-2/{tile}{date.year}/{date.month}/{date.day}/{sequence}/{os.path.basename(file)}"
+                      for tile in tiles for sequence in sequences for file in files
+                      if (day * 37 + 50 * sequence) % 100 <= args.cloud_max}
+
+        s3.create_bucket(Bucket="dst")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            download_s2_imgs_s3.download("dst", start_date, end_date, tiles, files, workers=args.workers,
+                                         catalog_path=os.path.join(directory, "s2_catalog.sqlite"))
+        elapsed = time.perf_counter() - start
+        for line in output.getvalue().splitlines():
+            if line.startswith(("Skipping", "Copied")):
+                print(line)
+        copied = {o["Key"] for page in s3.get_paginator("list_objects_v2").paginate(Bucket="dst")
+                  for o in page.get("Contents", [])}
+        print(f"{sources} source objects, {len(copied)} copied in {elapsed:.2f} s; sequence 0 only would have copied "
+              f"{len(only_first)}, {len(only_first - expected)} of them superseded and missing "
+              f"{len(expected - only_first)} newer or split ones")
+        if copied != expected:
+            raise Exception(f"{len(copied - expected)} unexpected and {len(expected - copied)} missing objects")
+        if f"Skipping {superseded} sequence(s) superseded by a newer processing baseline" not in output.getvalue():
+            raise Exception(f"expected {superseded} superseded sequences to be reported")
+
+        s3.create_bucket(Bucket="dst-clear")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            download_s2_imgs_s3.download("dst-clear", start_date, end_date, tiles, files, workers=args.workers,
+                                         catalog_path=os.path.join(directory, "s2_catalog.sqlite"),
+                                         cloud_max=args.cloud_max)
+        copied = {o["Key"] for page in s3.get_paginator("list_objects_v2").paginate(Bucket="dst-clear")
+                  for o in page.get("Contents", [])}
+        print(f"with at most {args.cloud_max}% cloud cover: {len(copied)} copied, {len(copied - expected)} of them "
+              f"superseded")
+        if copied != clear:
+            raise Exception(f"{len(copied - clear)} unexpected and {len(clear - copied)} missing objects under cloud_max")
+        if f"Skipping {superseded} sequence(s) superseded by a newer processing baseline" not in output.getvalue():
+            raise Exception(f"expected {superseded} superseded sequences to be reported under cloud_max")
+
+
+""" A MSK_CLOUDS_B00.gml document with an OPAQUE mask feature for every (x1, y1, x2, y2) box, in UTM 18N. """
+def cloud_mask_gml(boxes):
+    features = []
+    for i, (x1, y1, x2, y2) in enumerate(boxes):
+        ring = " ".join(f"{x} {y}" for x, y in ((x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)))
+        features.append(
+            f'<eop:MaskFeature gml:id="OPAQUE.{i}"><eop:maskType codeSpace="urn:gs2:S2PDGS:maskType">OPAQUE</eop:maskType>'
+            f'<eop:extentOf><gml:Polygon gml:id="OPAQUE.{i}.G" srsName="urn:ogc:def:crs:EPSG::32618"><gml:exterior>'
+            f'<gml:LinearRing><gml:posList srsDimension="2">{ring}</gml:posList></gml:LinearRing></gml:exterior>'
+            f'</gml:Polygon></eop:extentOf></eop:MaskFeature>')
+    members = f"<eop:maskMembers>{''.join(features)}</eop:maskMembers>" if features else ""
+    return ('<?xml version="1.0" encoding="UTF-8"?><eop:Mask xmlns:eop="http://www.opengis.net/eop/2.0" '
+            'xmlns:gml="http://www.opengis.net/gml/3.2" gml:id="MSK_CLOUDS">'
+            f'<gml:boundedBy><gml:Null>Inapplicable</gml:Null></gml:boundedBy>{members}</eop:Mask>').encode()
+
+
+""" Copy a month of the farm tiles (with band_kb JP2 bands) from a moto stand-in of the sentinel-s2-l2a
+    bucket whose days cycle through: clear, clouds over the farm boundary, clouds elsewhere on a mostly
+    cloudy tile, and half the boundary under cloud. Copies everything, then with a tile-level cloud
+    filter, then with the AOI prefilter (twice, the second time from the catalog), and checks which
+    days the prefilter let through. Also checks a boundary without area (its outline) is turned
+    down by load_aoi and doesn't break aoi_cloud_cover. Requires moto, shapely and pyproj. """
+def benchmark_clouds(args):
+    try:
+        import boto3
+        from moto import mock_aws
+        from pyproj import Transformer
+    except ImportError:
+        raise Exception("the clouds benchmark needs boto3, moto, shapely and pyproj (pip install moto shapely pyproj)")
+    import datetime
+    import download_s2_imgs_s3
+    from shapely.geometry import LineString, mapping
+    from s2_clouds import load_aoi, aoi_cloud_cover
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    # UTM 18N extents of the two tiles; the boundary lies in 18NWM and reaches into 18NXM
+    extents = {'18/N/WM/': (499980, 590200, 609780, 700000), '18/N/XM/': (600000, 590200, 709800, 700000)}
+    aoi = load_aoi(args.boundary)
+    to_utm = Transformer.from_crs(4326, 32618, always_xy=True)
+    xs, ys = to_utm.transform(*aoi.exterior.coords.xy)
+    x1, y1, x2, y2 = min(xs), min(ys), max(xs), max(ys)
+    # (tile cloudyPixelPercentage, cloud boxes, tiles passing a 20% AOI threshold) for each kind of day; when the
+    # western half of the boundary is cloudy, 18NXM only sees the clear eastern edge of it
+    kinds = [(5, [], set(tiles)),
+             (30, [(x1 - 1000, y1 - 1000, x2 + 1000, y2 + 1000)], set()),
+             (70, [(640000, 590200, 709800, 700000), (499980, 590200, 560000, 640000)], set(tiles)),
+             (50, [(x1 - 1000, y1 - 1000, (x1 + x2) / 2, y2 + 1000)], {'18/N/XM/'})]
+
+    start_date = datetime.datetime(2021, 10, 1)
+    end_date = start_date + datetime.timedelta(days=args.days - 1)
+    with mock_aws(), tempfile.TemporaryDirectory() as directory:
+        s3 = boto3.client("s3")
+        fill_s2_bucket(s3, tiles, files, start_date, args.days, band_kb=args.band_kb)
+        clear_days, tile_clear_days = set(), set()
+        for day in range(args.days):
+            if day % 5 == 4:
+                continue
+            date = start_date + datetime.timedelta(days=day)
+            tile_cloud, boxes, passing = kinds[day % len(kinds)]
+            clear_days |= {f"{tile}{date.year}/{date.month}/{date.day}" for tile in passing}
+            for tile in tiles:
+                prefix = f"tiles/{tile}{date.year}/{date.month}/{date.day}/0/"
+                ex1, ey1, ex2, ey2 = extents[tile]
+                # the second day's 18NWM tileInfo has no cloud cover: unknown is kept by both filters
+                unknown = day == 1 and tile == '18/N/WM/'
+                if unknown or tile_cloud <= 20:
+                    tile_clear_days.add(f"{tile}{date.year}/{date.month}/{date.day}")
+                tile_info = {"cloudyPixelPercentage": tile_cloud, "dataCoveragePercentage": 100.0,
+                             "productName": f"S2A_MSIL2A_{date:%Y%m%d}T153621_N0300_R068_T{tile.replace('/', '')}_"
+                                            f"{date:%Y%m%d}T194220",
+                             "tileDataGeometry": {"type": "Polygon",
+                                                  "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG:8.8.1:32618"}},
+                                                  "coordinates": [[[ex1, ey1], [ex2, ey1], [ex2, ey2], [ex1, ey2], [ex1, ey1]]]}}
+                if unknown:
+                    del tile_info["cloudyPixelPercentage"]
+                s3.put_object(Bucket="sentinel-s2-l2a", Key=prefix + "tileInfo.json", Body=json.dumps(tile_info).encode())
+                s3.put_object(Bucket="sentinel-s2-l2a", Key=prefix + "qi/MSK_CLOUDS_B00.gml", Body=cloud_mask_gml(boxes))
+
+        gets = []
+        boto3._get_default_session().events.register("before-call.s3.GetObject", lambda **kwargs: gets.append(1),
+                                                     unique_id="benchmark-clouds-gets")
+        catalog_path = os.path.join(directory, "s2_catalog.sqlite")
+        runs = (("everything", {}), ("tile <= 20%", {"cloud_max": 20}),
+                ("AOI <= 20%", {"cloud_max": 20, "aoi": aoi}), ("AOI, cached", {"cloud_max": 20, "aoi": aoi}))
+        for i, (label, kwargs) in enumerate(runs):
+            bucket = f"dst-{i}"
+            s3.create_bucket(Bucket=bucket)
+            gets.clear()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                results = download_s2_imgs_s3.download(bucket, start_date, end_date, tiles, files, workers=args.workers,
+                                                       catalog_path=catalog_path, **kwargs)
+            elapsed = time.perf_counter() - start
+            copied = sum(r.bytes for r in results if r.ok)
+            bands = [r for r in results if r.ok and r.dst_key.endswith(".jp2")]
+            print(f"{label:12}: {len(results):3} objects, {len(bands):3} bands, {copied / 2**20:7.1f} MB in {elapsed:.2f} s, "
+                  f"{len(gets)} GET requests")
+            for line in output.getvalue().splitlines():
+                if line.startswith("Cloud prefilter"):
+                    print(f"              {line}")
+            band_days = {"/".join(r.dst_key.split("/")[1:7]) for r in bands}
+            if "aoi" not in kwargs and "cloud_max" in kwargs and band_days != tile_clear_days:
+                raise Exception(f"the tile filter copied bands of {sorted(band_days - tile_clear_days)} "
+                                f"and skipped {sorted(tile_clear_days - band_days)}")
+            if "aoi" in kwargs and band_days != clear_days:
+                raise Exception(f"the prefilter copied bands of {sorted(band_days - clear_days)} "
+                                f"and skipped {sorted(clear_days - band_days)}")
+        print(f"the tile filter copied bands for the {len(tile_clear_days)} tile-days clear or of unknown cloud cover; "
+              f"the AOI prefilter for exactly the {len(clear_days)} tile-days clear over the boundary")
+
+        # an AOI without area: load_aoi turns it down, and aoi_cloud_cover doesn't divide by its area
+        line = LineString(aoi.exterior.coords)
+        line_path = os.path.join(directory, "line.geojson")
+        with open(line_path, "w") as file:
+            json.dump({"type": "Feature", "properties": {}, "geometry": mapping(line)}, file)
+        try:
+            load_aoi(line_path)
+            raise Exception("load_aoi accepted a LineString boundary")
+        except ValueError as e:
+            print(f"load_aoi: {e}")
+        ex1, ey1, ex2, ey2 = extents['18/N/WM/']
+        tile_info = {"cloudyPixelPercentage": 30,
+                     "tileDataGeometry": {"type": "Polygon", "crs": {"type": "name", "properties": {"name": "EPSG:32618"}},
+                                          "coordinates": [[[ex1, ey1], [ex2, ey1], [ex2, ey2], [ex1, ey2], [ex1, ey1]]]}}
+        cover = aoi_cloud_cover(line, tile_info, cloud_mask_gml(kinds[1][1]))
+        print(f"cloud cover over the boundary's outline: {cover}")
+        if cover[1] is not None:
+            raise Exception("a LineString AOI got an AOI coverage")
+
+
+""" Local stand-in for the Sentinel Hub metadata server (SHConfig.aws_metadata_url), which
+    AwsTileRequest reads tileInfo.json from. Serves the tileInfo of every path in tiles after
+    waiting delay seconds. """
+class TileInfoHandler(BaseHTTPRequestHandler):
+    tiles = {}
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = self.tiles.get(self.path.lstrip("/"))
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+""" Download days x 2 farm tiles (with band_kb JP2 bands) through sentinelhub's AwsTileRequest
+    from a moto stand-in of the sentinel-s2-l2a bucket and a local metadata server, each request
+    delayed latency_ms: first with the original loop, then one tile at a time with download(), then
+    with tile_threads tiles at once, then again into the same folder, where the manifest should skip every tile, and
+    once more after corrupting a file, which should only fetch that tile again. Requires moto
+    and sentinelhub (3.x, with AwsTileRequest). """
+def benchmark_tiles(args):
+    try:
+        import boto3
+        import botocore.handlers
+        from moto import mock_aws
+        from sentinelhub import SHConfig
+    except ImportError:
+        raise Exception("the tiles benchmark needs boto3, moto and sentinelhub (pip install moto sentinelhub)")
+    from unittest import mock
+    import datetime
+    import download_s2_imgs
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    tiles = ['18/N/WM/', '18/N/XM/']
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    start_date = datetime.datetime(2021, 10, 1)
+    TileInfoHandler.delay = args.latency_ms / 1000
+    server, url = start_server(TileInfoHandler)
+    config = SHConfig()
+    config.aws_metadata_url = url.rstrip("/")
+    config.aws_access_key_id, config.aws_secret_access_key = "testing", "testing"
+
+    # sentinelhub opens a new boto3 session per file, so the latency goes in the handlers every new session gets
+    def delay(**kwargs):
+        time.sleep(args.latency_ms / 1000)
+    botocore.handlers.BUILTIN_HANDLERS.insert(0, ("before-send.s3", delay))
+    try:
+        with mock_aws(), tempfile.TemporaryDirectory() as directory, \
+                mock.patch("builtins.input", return_value="y"), contextlib.redirect_stderr(io.StringIO()):
+            s3 = boto3.client("s3")
+            fill_s2_bucket(s3, tiles, files, start_date, args.days, band_kb=args.band_kb)
+            downloads = []
+            for obj in s3.list_objects_v2(Bucket="sentinel-s2-l2a", Prefix="tiles/")["Contents"]:
+                if obj["Key"].endswith("tileInfo.json"):
+                    tile_path = os.path.dirname(obj["Key"])
+                    downloads.append(download_s2_imgs.aws_tile(f"s3://sentinel-s2-l2a/{tile_path}"))
+                    day = downloads[-1][1]
+                    TileInfoHandler.tiles[f"sentinel-s2-l2a/{tile_path}/tileInfo.json"] = json.dumps(
+                        {"timestamp": f"{day}T15:47:51.930Z", "path": tile_path,
+                         "productName": f"S2A_MSIL2A_{day.replace('-', '')}T153621_N0300_R068_T{downloads[-1][0]}_"
+                                        f"{day.replace('-', '')}T194220"}).encode()
+            print(f"{len(downloads)} tiles of {len(files)} files, {args.band_kb} KB bands, "
+                  f"{args.latency_ms} ms per request")
+
+            def run(label, folder, tile_threads, file_threads):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    results = download_s2_imgs.download(downloads, data_folder=folder, tile_threads=tile_threads,
+                                                        file_threads=file_threads, config=config)
+                elapsed = time.perf_counter() - start
+                summary = [line for line in output.getvalue().splitlines() if line.startswith("Downloaded ")][-1]
+                print(f"{label:10}: {elapsed:5.2f} s - {summary}")
+                if not all(r.ok for r in results):
+                    raise Exception(f"{sum(not r.ok for r in results)} tiles failed: {[r for r in results if not r.ok]}")
+                return results
+
+            # the original loop: one AwsTileRequest after another, sentinelhub's own download client
+            start = time.perf_counter()
+            for tile in downloads:
+                download_s2_imgs.AwsTileRequest(tile=tile[0], time=tile[1], aws_index=tile[2],
+                                                bands=['R10m/B04', 'R10m/B08'], metafiles=['tileInfo', 'qi/MSK_CLOUDS_B00'],
+                                                data_folder=os.path.join(directory, "original"),
+                                                data_collection=download_s2_imgs.DATA_COLLECTION,
+                                                config=config).save_data()
+            print(f"{'original':10}: {time.perf_counter() - start:5.2f} s")
+            run("1 worker", os.path.join(directory, "loop"), 1, None)
+            folder = os.path.join(directory, "concurrent")
+            run("concurrent", folder, args.tile_threads, args.file_threads)
+            results = run("again", folder, args.tile_threads, args.file_threads)
+            if not all(r.skipped for r in results):
+                raise Exception("the manifest didn't skip every tile")
+            # same size, different content: only the checksum can tell
+            corrupted = os.path.join(folder, download_s2_imgs.tile_key(downloads[0]), "R10m", "B04.jp2")
+            with open(corrupted, "r+b") as file:
+                file.write(b"y")
+            results = run("corrupted", folder, args.tile_threads, args.file_threads)
+            if [r.tile for r in results if not r.skipped] != [downloads[0]]:
+                raise Exception("expected only the corrupted tile to be downloaded again")
+            with open(corrupted, "rb") as file:
+                if file.read(1) != b"x":
+                    raise Exception("the corrupted file wasn't replaced")
+            print("the manifest skipped every intact tile and replaced the corrupted one")
+    finally:
+        botocore.handlers.BUILTIN_HANDLERS.remove(("before-send.s3", delay))
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the download helpers in download_utils.py against local stand-in servers.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    memory_parser = subparsers.add_parser("memory", help="peak memory of streaming vs buffered downloads")
+    memory_parser.add_argument("-megabytes", "--mb", dest="megabytes", type=int, default=200,
+                               help="size of the file to download")
+    memory_parser.add_argument("-chunk-size", dest="chunk_size", type=int, default=download_utils.download_chunk_size,
+                               help="bytes written to disk at a time")
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    resume_parser = subparsers.add_parser("resume", help="check an interrupted download resumes with a Range request")
+    resume_parser.add_argument("-megabytes", "--mb", dest="megabytes", type=int, default=20,
+                               help="size of the file to download")
+    resume_parser.set_defaults(func=check_resume)
+
+    segments_parser = subparsers.add_parser("segments", help="single vs segmented download from a throttled server")
+    segments_parser.add_argument("-megabytes", "--mb", dest="megabytes", type=int, default=40,
+                                 help="size of the file to download")
+    segments_parser.add_argument("-rate", type=int, default=10,
+                                 help="MB/s the server allows each connection")
+    segments_parser.add_argument("-segments", type=int, nargs="+", default=[1, 2, 4, 8],
+                                 help="segment counts to try")
+    segments_parser.add_argument("-connections", type=int, default=8,
+                                 help="size of the shared connection budget (download_utils.sema)")
+    segments_parser.set_defaults(func=benchmark_segments)
+
+    session_parser = subparsers.add_parser("session", help="M2M API call latency with and without the pooled session")
+    session_parser.add_argument("-threads", type=int, default=4,
+                                help="threads making calls at once")
+    session_parser.add_argument("-polls", type=int, default=20,
+                                help="download-retrieve calls per thread")
+    session_parser.add_argument("-connect-ms", dest="connect_ms", type=float, default=30.0,
+                                help="simulated cost of opening a connection, in ms")
+    session_parser.set_defaults(func=benchmark_session)
+
+    search_parser = subparsers.add_parser("search", help="paginated scene search against a mock M2M API")
+    search_parser.add_argument("-scenes", type=int, default=20000,
+                               help="number of scenes matching the search")
+    search_parser.add_argument("-page-size", dest="page_size", type=int, default=1000,
+                               help="scenes per scene-search request")
+    search_parser.add_argument("-threads", type=int, nargs="+", default=[1, 4],
+                               help="search thread counts to try")
+    search_parser.add_argument("-delay-ms", dest="delay_ms", type=float, default=100.0,
+                               help="simulated server time per request, in ms")
+    search_parser.set_defaults(func=benchmark_search)
+
+    poll_parser = subparsers.add_parser("poll", help="fixed vs adaptive download-retrieve polling against a mock M2M API")
+    poll_parser.add_argument("-downloads", type=int, default=20,
+                             help="number of downloads requested")
+    poll_parser.add_argument("-spread", type=float, default=6.0,
+                             help="seconds over which the downloads become available")
+    poll_parser.add_argument("-fixed", type=float, default=3.0,
+                             help="interval of the fixed poller (the script used 30 s)")
+    poll_parser.add_argument("-min-interval", dest="min_interval", type=float, default=0.25,
+                             help="first interval of the adaptive poller")
+    poll_parser.add_argument("-max-interval", dest="max_interval", type=float, default=3.0,
+                             help="longest interval of the adaptive poller")
+    poll_parser.set_defaults(func=benchmark_polling)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="download-then-upload vs pipelined upload to a moto s3")
+    pipeline_parser.add_argument("-scenes", type=int, default=8,
+                                 help="number of scenes to download (at most 12)")
+    pipeline_parser.add_argument("-megabytes", "--mb", dest="megabytes", type=int, default=20,
+                                 help="size of each scene")
+    pipeline_parser.add_argument("-rate", type=int, default=20,
+                                 help="MB/s the server allows each connection")
+    pipeline_parser.add_argument("-workers", type=int, default=2,
+                                 help="download threads")
+    pipeline_parser.add_argument("-upload-threads", dest="upload_threads", type=int, default=2,
+                                 help="upload threads")
+    pipeline_parser.add_argument("-transfer-threads", dest="transfer_threads", type=int, default=4,
+                                 help="multipart chunks uploaded at once per file")
+    pipeline_parser.set_defaults(func=benchmark_pipeline)
+
+    stream_parser = subparsers.add_parser("stream", help="stream scenes straight into a moto s3 bucket")
+    stream_parser.add_argument("-scenes", type=int, default=4,
+                               help="number of scenes to stream (at most 12)")
+    stream_parser.add_argument("-megabytes", "--mb", dest="megabytes", type=int, default=20,
+                               help="size of each scene")
+    stream_parser.add_argument("-rate", type=int, default=20,
+                               help="MB/s the server allows each connection")
+    stream_parser.add_argument("-workers", type=int, default=2,
+                               help="download threads")
+    stream_parser.add_argument("-transfer-threads", dest="transfer_threads", type=int, default=4,
+                               help="multipart chunks uploaded at once per scene")
+    stream_parser.set_defaults(func=benchmark_stream)
+
+    copy_parser = subparsers.add_parser("copy", help="serial vs concurrent S2 server-side copies on a moto s3")
+    copy_parser.add_argument("-days", type=int, default=20,
+                             help="number of days to copy")
+    copy_parser.add_argument("-large-mb", dest="large_mb", type=int, default=40,
+                             help="size of the JP2s on the first day, copied as multipart copies")
+    copy_parser.add_argument("-latency-ms", dest="latency_ms", type=float, default=50.0,
+                             help="simulated round trip per s3 request, in ms")
+    copy_parser.add_argument("-throttle-every", dest="throttle_every", type=int, default=7,
+                             help="answer every nth copy request with 503 SlowDown (0 for never)")
+    copy_parser.add_argument("-workers", type=int, default=16,
+                             help="objects copied at once")
+    copy_parser.add_argument("-part-threads", dest="part_threads", type=int, default=4,
+                             help="parts of a multipart copy copied at once")
+    copy_parser.set_defaults(func=benchmark_copy)
+
+    listing_parser = subparsers.add_parser("listing", help="per-key existence checks vs a listing index on a moto s3")
+    listing_parser.add_argument("-days", type=int, default=365,
+                                help="number of days to look for files on")
+    listing_parser.add_argument("-extra-files", dest="extra_files", type=int, default=60,
+                                help="other keys stored per acquisition, listed but not wanted")
+    listing_parser.set_defaults(func=benchmark_listing)
+
+    catalog_parser = subparsers.add_parser("catalog", help="incremental refreshes of the local S2 catalog on a moto s3")
+    catalog_parser.add_argument("-days", type=int, default=365,
+                                help="number of days in the first sync")
+    catalog_parser.add_argument("-extra-files", dest="extra_files", type=int, default=60,
+                                help="other files under each day's prefix, which listings have to page through")
+    catalog_parser.add_argument("-cloud-max", dest="cloud_max", type=float, default=20,
+                                help="cloud cover threshold for the example query")
+    catalog_parser.set_defaults(func=benchmark_catalog)
+
+    sequences_parser = subparsers.add_parser("sequences", help="copy only the newest sequence of each datatake on a moto s3")
+    sequences_parser.add_argument("-days", type=int, default=30,
+                                  help="number of days to copy")
+    sequences_parser.add_argument("-reprocessed-every", dest="reprocessed_every", type=int, default=3,
+                                  help="every nth day also has a reprocessed sequence 1")
+    sequences_parser.add_argument("-split-every", dest="split_every", type=int, default=7,
+                                  help="every nth day (not reprocessed) also has a split sequence 1")
+    sequences_parser.add_argument("-workers", type=int, default=download_utils.COPY_WORKERS,
+                                  help="max number of files copied at once")
+    sequences_parser.add_argument("-cloud-max", dest="cloud_max", type=float, default=50,
+                                  help="cloud cover threshold (percent) of the second copy")
+    sequences_parser.set_defaults(func=benchmark_sequences)
+
+    clouds_parser = subparsers.add_parser("clouds", help="cloud cover prefilter over the farm boundary on a moto s3")
+    clouds_parser.add_argument("-days", type=int, default=30,
+                               help="number of days to copy")
+    clouds_parser.add_argument("-band-kb", dest="band_kb", type=int, default=1024,
+                               help="size of each JP2 band in KB")
+    clouds_parser.add_argument("-boundary", type=str,
+                               default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "polygons",
+                                                    "geojson", "boundary.geojson"),
+                               help="geojson of the area of interest")
+    clouds_parser.add_argument("-workers", type=int, default=download_utils.COPY_WORKERS,
+                               help="max number of files copied at once")
+    clouds_parser.set_defaults(func=benchmark_clouds)
+
+    tiles_parser = subparsers.add_parser("tiles", help="AwsTileRequest downloads: loop vs concurrent, and the manifest")
+    tiles_parser.add_argument("-days", type=int, default=10,
+                              help="number of days of the two farm tiles")
+    tiles_parser.add_argument("-band-kb", dest="band_kb", type=int, default=1024,
+                              help="size of each JP2 band in KB")
+    tiles_parser.add_argument("-latency-ms", dest="latency_ms", type=float, default=50,
+                              help="delay before each metadata and s3 request")
+    tiles_parser.add_argument("-tile-threads", dest="tile_threads", type=int, default=8,
+                              help="tiles downloaded at once")
+    tiles_parser.add_argument("-file-threads", dest="file_threads", type=int, default=4,
+                              help="files of one tile downloaded at once")
+    tiles_parser.set_defaults(func=benchmark_tiles)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,44 @@ import time
 import argparse
 import re
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import boto3
 
 import download_utils
-from download_utils import get_credentials, send_request, threaded_download, threads, s3_join, upload_to_s3
+from download_utils import get_credentials, send_request, DownloadManager, DownloadJournal, HTTPSession, S3Uploader, download_file, print_download_stats, s3_join, stream_to_s3
+
+
+SEARCH_PAGE_SIZE = 1000 # scenes per scene-search request
+SCENE_BATCH_SIZE = 500 # scenes per scene-list-add/download-options round
+POLL_MIN_INTERVAL = 5 # seconds between download-retrieve polls while downloads keep arriving
+POLL_MAX_INTERVAL = 60 # longest wait between polls once nothing has been ready for a while
+
+# a full breakdown of the naming convention can be found here:
+# https://www.usgs.gov/faqs/what-naming-convention-landsat-collection-2-level-1-and-level-2-scenes?qt-news_science_products=0#qt-news_science_products
+L8_NAME_PATTERN = re.compile(r"""
+                (?P<sat>L\w{3})         # match the sensor type and satellite (ex. LC08)
+                (?:_)
+                (?P<level>L\w{3})       # match the processing level (ex. L2SP)
+                (?:_)
+                (?P<path>\d{3})         # match the path
+                (?P<row>\d{3})          # match the row
+                (?:_)
+                (?P<acq_year>\d{4})     # match the acquisition year
+                (?P<acq_month>\d{2})    # match the acquisition month
+                (?P<acq_day>\d{2})      # match the acquisition day
+                (?:_)
+                (?P<proc_year>\d{8})    # match the processing year
+                (?:_)
+                (?P<col_number>\d{2})   # match the collection number
+                (?:_)
+                (?P<col_category>\w{2}) # match the collection category
+                (?:.tar)
+                """, re.VERBOSE)
 
 
 # --------------------------------------------------------------------------- #
@@ -18,6 +49,12 @@ from download_utils import get_credentials, send_request, threaded_download, thr
 # --------------------------------------------------------------------------- #
 
 
+""" Return the s3 prefix a downloaded scene is stored under: dataset_name/path/row/year/month. """
+def l8_s3_prefix(filename, dataset_name):
+    m = L8_NAME_PATTERN.match(filename)
+    return s3_join(dataset_name, m.group('path'), m.group('row'), m.group('acq_year'), m.group('acq_month'))
+
+
 """ Log in to the API and return the API key to use with future requests. """
 def authenticate(url, username=None, password=None):
     # To access the API, first register for USGS Eros credentials here: https://ers.cr.usgs.gov/register
@@ -28,13 +65,19 @@ def authenticate(url, username=None, password=None):
     payload = {'username': username, 'password': password}
     print("Logging in...")
     api_key = send_request(url + "login", payload)
+    # later API requests reuse the session's connections and send the key automatically
+    download_utils.get_session().authenticate(url, api_key)
     return api_key
 
 
 """ Search for images matching a certain criteria, and return a list of products that can
     be downloaded. date_range should be a tuple, cloud_max should be an int, and boundary
-    should oint to a GeoJSON file. Reserving **kwargs to be used in the future if needed. """
-def search(url, api_key, dataset=None, max_results=50, date_range=None, cloud_max=None, boundary=None, **kwargs):
+    should oint to a GeoJSON file. max_results of 0 or None returns every matching scene.
+    Search results are paged through (see search_scenes) and their download options are
+    looked up batch_size scenes at a time as the pages arrive.
+    Reserving **kwargs to be used in the future if needed. """
+def search(url, api_key, dataset=None, max_results=50, date_range=None, cloud_max=None, boundary=None,
+           page_size=SEARCH_PAGE_SIZE, search_threads=4, batch_size=SCENE_BATCH_SIZE, **kwargs):
     print("Fetching scenes...")
     
     # search for scenes that match our criteria
@@ -72,23 +115,64 @@ def search(url, api_key, dataset=None, max_results=50, date_range=None, cloud_ma
         'spatialFilter': spatial_filter
     }
     
-    payload = { 
-        'datasetName': dataset,
-        'maxResults': max_results,
-        'startingNumber': 1, 
-        'sceneFilter': scene_filter
-    }
+    # look up the download options of each batch of scenes as soon as it fills up, a few
+    # batches at a time, while the search keeps paging
+    label = datetime.now().strftime("%Y%m%d_%H%M%S")
+    scene_ids = (scene['entityId'] for scene in
+                 search_scenes(url, api_key, dataset, scene_filter, max_results, page_size, search_threads))
+    downloads = []
+    with ThreadPoolExecutor(max_workers=search_threads) as executor:
+        pending = deque()
+        for number, batch in enumerate(batched(scene_ids, batch_size)):
+            pending.append(executor.submit(download_options, url, api_key, dataset, batch, f"{label}_{number}"))
+            if len(pending) == search_threads:
+                downloads.extend(pending.popleft().result())
+        while pending:
+            downloads.extend(pending.popleft().result())
+    
+    return downloads
+
+
+""" Yield the scenes matching scene_filter, page_size at a time. The first page tells us
+    how many scenes match; the rest are requested search_threads pages at a time, and
+    yielded in order. Stops after max_results scenes (0 or None for all of them). """
+def search_scenes(url, api_key, dataset, scene_filter, max_results=None, page_size=SEARCH_PAGE_SIZE, search_threads=4):
+    def fetch_page(starting_number, count):
+        payload = { 
+            'datasetName': dataset,
+            'maxResults': count,
+            'startingNumber': starting_number, 
+            'sceneFilter': scene_filter
+        }
+        return send_request(url + "scene-search", payload, api_key)
     
-    matching_scenes = send_request(url + "scene-search", payload, api_key)['results']
-    entityIds = []
-    for scene in matching_scenes:
-        entityIds.append(scene['entityId'])
+    first_page = fetch_page(1, min(page_size, max_results) if max_results else page_size)
+    total = first_page['totalHits']
+    if max_results:
+        total = min(total, max_results)
+    print(f"Found {total} matching scene(s).")
+    yield from first_page['results'][:total]
+    if len(first_page['results']) == 0:
+        return
     
+    # only search_threads pages are held at once, however many scenes match
+    with ThreadPoolExecutor(max_workers=search_threads) as executor:
+        pending = deque()
+        for starting_number in range(len(first_page['results']) + 1, total + 1, page_size):
+            pending.append(executor.submit(fetch_page, starting_number, min(page_size, total - starting_number + 1)))
+            if len(pending) == search_threads:
+                yield from pending.popleft().result()['results']
+        while pending:
+            yield from pending.popleft().result()['results']
+
+
+""" Return the downloadable products for a batch of entity IDs, via a temporary scene list
+    called list_id. """
+def download_options(url, api_key, dataset, entity_ids, list_id):
     # add scenes to list
-    list_id = datetime.now().strftime("%Y%m%d_%H%M%S")
     payload = {
         'listId': list_id,
-        'entityIds': entityIds,
+        'entityIds': entity_ids,
         'datasetName': dataset
     }
     
@@ -116,6 +200,18 @@ def search(url, api_key, dataset=None, max_results=50, date_range=None, cloud_ma
     return downloads
 
 
+""" Yield lists of up to size items from iterable. """
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class JSONFormatError(Exception):
     pass
 
@@ -141,15 +237,62 @@ def format_geojson(geojson):
         raise JSONFormatError(f"Error parsing JSON: missing {e} field")
         
 
-def download(url, api_key, downloads, completed_list=[]):
+""" Ask to download the given products, then request them (see request_downloads).
+    Returns once every URL has been submitted; use manager.join() to wait for the files. """
+def download(url, api_key, downloads, manager):
     if len(downloads) == 0:
         print("No tiles matching the criteria were found.")
         return None
 
+    if download_utils.journal is not None:
+        done = {d['entityId'] for d in downloads if download_utils.journal.is_complete(d['entityId'])}
+        if done:
+            print(f"Skipping {len(done)} scene(s) already downloaded by an earlier run.")
+            downloads = [d for d in downloads if d['entityId'] not in done]
+            if len(downloads) == 0:
+                return None
+
     download = input(f"Download {len(downloads)} scene(s)? (Y/N) ")
     if download.lower() not in {'y', 'yes'}:
         return None
-        
+    
+    request_downloads(url, api_key, downloads, manager)
+    return manager
+
+
+""" Map the downloadIds of a download-request response to the entityIds in its payload
+    (downloads). The response only lists downloadId and url for each download, so unless it
+    names the entity or there is just one download, the entityIds are read back with a
+    download-retrieve for the request's label, keeping only the entities that were asked for.
+    Downloads that can't be matched are left out (and get journaled under their file name). """
+def download_entity_ids(url, api_key, label, downloads, results):
+    requested = {d['entityId'] for d in downloads}
+    download_ids = {result['downloadId'] for result in results['availableDownloads'] + results['preparingDownloads']}
+    entity_ids = {}
+
+    def match(items):
+        for item in items:
+            if item.get('downloadId') in download_ids and item.get('entityId') in requested:
+                entity_ids[item['downloadId']] = item['entityId']
+
+    match(results['availableDownloads'] + results['preparingDownloads'])
+    if len(download_ids) == 1 and len(requested) == 1:
+        entity_ids = {download_id: entity_id for download_id in download_ids for entity_id in requested}
+    if download_ids - set(entity_ids):
+        retrieved = send_request(url + "download-retrieve", {"label": label}, api_key, False)
+        if retrieved != False:
+            match(retrieved['available'] + retrieved['requested'])
+    unmatched = len(download_ids - set(entity_ids))
+    if unmatched:
+        print(f"Could not tell which scene {unmatched} download(s) belong to; they are journaled by file name.")
+    return entity_ids
+
+
+""" Request the given downloads and hand each URL to the DownloadManager as soon as it becomes
+    available. Downloads that are still being prepared are polled for with download-retrieve,
+    min_interval seconds apart at first; every poll that turns up nothing doubles the wait
+    (up to max_interval), and any newly available download resets it. """
+def request_downloads(url, api_key, downloads, manager, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
     print("Requesting scenes for download...")
     label = datetime.now().strftime("%Y%m%d_%H%M%S")
     payload = {
@@ -158,33 +301,33 @@ def download(url, api_key, downloads, completed_list=[]):
     }
     
     results = send_request(url + "download-request", payload, api_key)
+    # the journal keys downloads by entityId, which download-request doesn't answer with
+    entity_ids = download_entity_ids(url, api_key, label, downloads, results)
     
     for result in results['availableDownloads']:       
-        threaded_download(result['url'], threads, completed_list)
+        manager.submit(result['url'], entity_id=entity_ids.get(result['downloadId']))
     
     # if downloads not immediately available, poll until they become available
-    preparing_dl_count = len(results['preparingDownloads'])
-    preparing_dl_ids = []
-    if preparing_dl_count > 0:
-        print("Waiting for all downloads to become available...")
-        for result in results['preparingDownloads']:  
-            preparing_dl_ids.append(result['downloadId'])
+    preparing_dl_ids = {result['downloadId'] for result in results['preparingDownloads']}
+    if len(preparing_dl_ids) > 0:
+        print(f"Waiting for {len(preparing_dl_ids)} download(s) to become available...")
         payload = {"label" : label}   
+        interval = min_interval
         while len(preparing_dl_ids) > 0: 
-            time.sleep(30)
+            time.sleep(interval)
             results = send_request(url + "download-retrieve", payload, api_key, False)
+            dispatched = 0
             if results != False:
-                for result in results['available']:                            
-                    if result['downloadId'] in preparing_dl_ids:
-                        preparing_dl_ids.remove(result['downloadId'])
-                        threaded_download(result['url'], threads, completed_list)
-                        
-                for result in results['requested']:   
-                    if result['downloadId'] in preparing_dl_ids:
-                        preparing_dl_ids.remove(result['downloadId'])
-                        threaded_download(result['url'], threads, completed_list)
-                        
-    return completed_list
+                for result in results['available'] + results['requested']:
+                    if result['downloadId'] in preparing_dl_ids and result.get('url'):
+                        preparing_dl_ids.discard(result['downloadId'])
+                        manager.submit(result['url'], entity_id=entity_ids.get(result['downloadId']))
+                        dispatched += 1
+            if dispatched:
+                print(f"{dispatched} more download(s) available, {len(preparing_dl_ids)} still being prepared.")
+                interval = min_interval
+            else:
+                interval = min(max_interval, interval * 2)
 
 
 def main():
@@ -203,13 +346,41 @@ def main():
                         help="s3 bucket to store downloaded scenes in")
     parser.add_argument("-maxresults", "--mr", metavar="int",
                         dest="max_results", type=int, default=50,
-                        help="max number of results to return from search")
+                        help="max number of results to return from search (0 for all of them)")
+    parser.add_argument("-pagesize", "--ps", metavar="int",
+                        dest="page_size", type=int, default=SEARCH_PAGE_SIZE,
+                        help="number of scenes to fetch per search request")
+    parser.add_argument("-searchthreads", "--st", metavar="int",
+                        dest="search_threads", type=int, default=4,
+                        help="max number of search pages (and download option batches) to fetch at once")
     parser.add_argument("-maxthreads", "--mt", metavar="int",
                         dest="max_threads", type=int, default=5,
                         help="max number of threads to use to download")
+    parser.add_argument("-segments", "--sg", metavar="int",
+                        dest="segments", type=int, default=1,
+                        help="max connections to split each large scene across (shares the -maxthreads budget)")
+    parser.add_argument("-journal", metavar="path/to/json",
+                        dest="journal", type=str, default="download_journal.json",
+                        help="file recording download progress, so an interrupted run can be resumed")
+    parser.add_argument("-stream", action="store_true",
+                        help="stream scenes straight into the -dst bucket instead of saving them to disk first")
+    parser.add_argument("-uploadthreads", "--ut", metavar="int",
+                        dest="upload_threads", type=int, default=2,
+                        help="max number of scenes to upload to s3 at once")
+    parser.add_argument("-transferthreads", "--tt", metavar="int",
+                        dest="transfer_threads", type=int, default=4,
+                        help="max number of multipart chunks to upload at once per scene")
     args = parser.parse_args()
+    if args.stream and not args.dst:
+        parser.error("-stream needs a -dst bucket")
     
     download_utils.sema = threading.Semaphore(value=args.max_threads)
+    download_utils.journal = DownloadJournal(args.journal)
+    download_utils.segments = args.segments
+    # every connection the search (pages and download options) or the downloads may hold at
+    # once, plus the other API calls
+    download_utils.http_session = HTTPSession(
+        pool_size=max(args.max_threads * args.segments, 2 * args.search_threads) + 1)
     
     url = "https://m2m.cr.usgs.gov/api/api/json/stable/"
     dataset = "landsat_ot_c2_l2"
@@ -218,50 +389,52 @@ def main():
     api_key = authenticate(url)
     
     downloads = search(url, api_key, dataset, 
-                       max_results=args.max_results, 
+                       max_results=args.max_results,
+                       page_size=args.page_size,
+                       search_threads=args.search_threads, 
                        date_range=args.date_range, 
                        cloud_max=args.cloud_max, 
                        boundary=args.boundary)
     
-    completed_list = []
-    download(url, api_key, downloads, completed_list)
-    
-    # wait until all downloads have finished
-    for thread in threads:
-        while thread.is_alive():
-            time.sleep(30)
-    
-    # upload files to s3 if bucket is specified
+    # upload files to s3 if bucket is specified, each one as soon as it has downloaded
+    # (or with -stream, while it downloads)
+    uploader = None
+    download_function = download_file
     if args.dst:
         # assuming you have set up aws credentials properly
         # TODO: add command line argument to change profile?
         s3 = boto3.resource('s3')
-        # a full breakdown of the naming convention can be found here:
-        # https://www.usgs.gov/faqs/what-naming-convention-landsat-collection-2-level-1-and-level-2-scenes?qt-news_science_products=0#qt-news_science_products
-        l8_name_pattern = re.compile(r"""
-                        (?P<sat>L\w{3})         # match the sensor type and satellite (ex. LC08)
-                        (?:_)
-                        (?P<level>L\w{3})       # match the processing level (ex. L2SP)
-                        (?:_)
-                        (?P<path>\d{3})         # match the path
-                        (?P<row>\d{3})          # match the row
-                        (?:_)
-                        (?P<acq_year>\d{4})     # match the acquisition year
-                        (?P<acq_month>\d{2})    # match the acquisition month
-                        (?P<acq_day>\d{2})      # match the acquisition day
-                        (?:_)
-                        (?P<proc_year>\d{8})    # match the processing year
-                        (?:_)
-                        (?P<col_number>\d{2})   # match the collection number
-                        (?:_)
-                        (?P<col_category>\w{2}) # match the collection category
-                        (?:.tar)
-                        """, re.VERBOSE)
-        for file in completed_list:
-            m = l8_name_pattern.match(file)
-            prefix = s3_join(dataset_name, m.group('path'), m.group('row'), m.group('acq_year'),
-                              m.group('acq_month'))
-            upload_to_s3(file, args.dst, prefix, s3, delete=True)
+        prefix_for = partial(l8_s3_prefix, dataset_name=dataset_name)
+        uploader = S3Uploader(args.dst, s3, workers=args.upload_threads, transfer_threads=args.transfer_threads)
+        if args.stream:
+            download_function = partial(stream_to_s3, bucket=args.dst, s3=s3, prefix_for=prefix_for,
+                                        transfer_threads=args.transfer_threads)
+        # scenes finished by an earlier run that are still waiting to be uploaded
+        for filename in download_utils.journal.completed_files(d['entityId'] for d in downloads):
+            if Path(filename).exists():
+                uploader.submit(filename, prefix_for(filename))
+    
+    def upload(result):
+        uploader.submit(result.filename, prefix_for(result.filename))
+    
+    with DownloadManager(workers=args.max_threads, download=download_function,
+                         on_download=upload if uploader and not args.stream else None) as manager:
+        download(url, api_key, downloads, manager)
+        # wait until all downloads have finished
+        results = manager.join()
+    print_download_stats(results)
+    failed = [result for result in results if not result.ok]
+    if failed:
+        print(f"{len(failed)} download(s) failed:")
+        for result in failed:
+            print(f"  {result.url}: {result.error}")
+    
+    if uploader:
+        print("Waiting for uploads to finish...")
+        with uploader:
+            not_uploaded = [filename for filename, ok in uploader.join() if not ok]
+        if not_uploaded:
+            print(f"{len(not_uploaded)} upload(s) failed, the files were kept: {', '.join(not_uploaded)}")
             
     print("Done.")
     
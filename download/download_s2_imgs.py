@@ -1,15 +1,48 @@
 import argparse
+import hashlib
 import json
 import re
 import os
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from sys import path_importer_cache
 
 import boto3
-from sentinelhub import SHConfig, WebFeatureService, DataCollection, Geometry, AwsTileRequest, AwsTile
+from botocore.config import Config
+from sentinelhub import SHConfig, WebFeatureService, DataCollection, Geometry, AwsTileRequest, AwsTile, \
+    AwsDownloadClient
+
+from download_utils import S3Copier, DownloadJournal, s3_copy_client, COPY_WORKERS, COPY_PART_THREADS
 
 
 DATA_COLLECTION = DataCollection.SENTINEL2_L2A
+TILE_THREADS = 4 # tiles downloaded at once by download()
+FILE_THREADS = 4 # files of one tile downloaded at once (sentinelhub's max_threads)
+MANIFEST_NAME = "s2_manifest.json" # sizes and checksums of the tiles in a data folder
+HASH_CHUNK_SIZE = 1 << 20
+
+# a full breakdown of the naming convention can be found here:
+# https://roda.sentinel-hub.com/sentinel-s2-l2a/readme.html
+S2_PATH_PATTERN = re.compile(r"""
+    (?:s3://)
+    (?P<bucket>sentinel-s2-\w{3})   # match the bucket name (ex. sentinel-s2-l2a)
+    (?:/tiles/)
+    (?P<utm>\d{1,2})                # match the utm zone
+    (?:/)
+    (?P<lat>\w{1})                  # match the latitute band
+    (?:/)
+    (?P<square>\w{2})               # match the square within the utm zone/lat band
+    (?:/)
+    (?P<year>\d{4})                 # match the year
+    (?:/)
+    (?P<month>\d{1,2})              # match the month
+    (?:/)
+    (?P<day>\d{1,2})                # match the day
+    (?:/)
+    (?P<sequence>\d+)               # match the aws index
+    """, re.VERBOSE)
 
 
 """ Authenticate the user based on the credentials in their config.json file.
@@ -55,8 +88,9 @@ def search(config, dataset=None,  date_range=None, cloud_max=1, boundary=None, *
 
 
 """ Given a list of tiles in the Sentinelhub S2 bucket and a list of files to copy for
-    each tile, copy those files into dst_bucket. """
-def copy_to_s3(tile_list, dst_bucket, files):
+    each tile, copy those files into dst_bucket, workers files at a time (see S3Copier).
+    Returns a CopyResult for every file. """
+def copy_to_s3(tile_list, dst_bucket, files, workers=COPY_WORKERS, part_threads=COPY_PART_THREADS):
     if len(tile_list) == 0:
         print("No tiles matching the criteria were found.")
         return None
@@ -65,48 +99,27 @@ def copy_to_s3(tile_list, dst_bucket, files):
     if download.lower() not in {'y', 'yes'}:
         return None
 
-    s3 = boto3.resource('s3')
-
-    # a full breakdown of the naming convention can be found here:
-    # https://roda.sentinel-hub.com/sentinel-s2-l2a/readme.html
-    s2_name_pattern = re.compile(r"""
-        (?:s3://)
-        (?P<bucket>sentinel-s2-\w{3})   # match the bucket name (ex. sentinel-s2-l2a)
-        (?:/tiles/)
-        (?P<utm>\d{1,2})                # match the utm zone
-        (?:/)
-        (?P<lat>\w{1})                  # match the latitute band
-        (?:/)
-        (?P<square>\w{2})               # match the square within the utm zone/lat band
-        (?:/)
-        (?P<year>\d{4})                 # match the year
-        (?:/)
-        (?P<month>\d{1,2})              # match the month
-        (?:/)
-        (?P<day>\d{1,2})                # match the day
-        (?:/\d+)
-        """, re.VERBOSE)
-    
-    for tile in tile_list:
-        id = tile[0] # use tile id when naming output files
-        path = tile[1]
-        m = s2_name_pattern.match(path)
-        # pad month and day with a zero if necessary
-        month = pad_zeroes(m.group('month'))
-        day = pad_zeroes(m.group('day'))
-        for file in files:
-            # split bucket name from key
-            copy_key = f"{path[21:]}/{file}"
-            copy_source = {
-                'Bucket': m.group('bucket'),
-                'Key': copy_key
-            }
-            # construct the appropriate key, removing the /tiles/ prefix and stripping any folders from the
-            # individual files (ex. R10m/B04.jp2 -> B04.jp2)
-            dst_key = (f"sentinel-2/{m.group('utm')}/{m.group('lat')}/{m.group('square')}/"
-                        f"{m.group('year')}/{month}/{day}/{id}_{os.path.basename(file)}")
-            print(f"Copying to s3://{dst_bucket}/{dst_key}...")
-            s3.meta.client.copy(copy_source, dst_bucket, dst_key, ExtraArgs={'RequestPayer': 'requester'})
+    s3_client = s3_copy_client(workers, part_threads)
+
+    with S3Copier(s3_client, workers, part_threads) as copier:
+        for tile in tile_list:
+            id = tile[0] # use tile id when naming output files
+            path = tile[1]
+            m = S2_PATH_PATTERN.match(path)
+            # pad month and day with a zero if necessary
+            month = pad_zeroes(m.group('month'))
+            day = pad_zeroes(m.group('day'))
+            for file in files:
+                # split bucket name from key
+                copy_key = f"{path[21:]}/{file}"
+                # construct the appropriate key, removing the /tiles/ prefix and stripping any folders from the
+                # individual files (ex. R10m/B04.jp2 -> B04.jp2)
+                dst_key = (f"sentinel-2/{m.group('utm')}/{m.group('lat')}/{m.group('square')}/"
+                            f"{m.group('year')}/{month}/{day}/{id}_{os.path.basename(file)}")
+                copier.submit(m.group('bucket'), copy_key, dst_bucket, dst_key)
+        results = copier.join()
+    copier.print_summary(results)
+    return results
 
 
 """ Given a string, return that string padded with zeroes, if necessary.
@@ -117,17 +130,126 @@ def pad_zeroes(string):
     return string
 
 
-# download tiles locally
-def download(downloads, bands=['R10m/B04', 'R10m/B08'], metafiles=['tileInfo', 'qi/MSK_CLOUDS_B00'], data_folder="."):
-    # by default, select R/NIR bands, tile info metadata file, and cloud mask
+""" Given the path of a tile in the Sentinelhub S2 bucket (see search), return the
+    (tile name, time, aws index) AwsTileRequest takes. """
+def aws_tile(path):
+    m = S2_PATH_PATTERN.match(path)
+    return (f"{m.group('utm')}{m.group('lat')}{m.group('square')}",
+            f"{m.group('year')}-{pad_zeroes(m.group('month'))}-{pad_zeroes(m.group('day'))}",
+            int(m.group('sequence')))
 
-    download = input(f"Download {len(downloads)} scene(s)? (Y/N) ")
-    if download.lower() not in {'y', 'yes'}:
-        return None
 
-    downloaded = []
-    for tile in downloads:
-        print(f"Downloading {tile}...")
+""" sentinelhub's AwsDownloadClient builds a new boto3 session and s3 client for every file it
+    downloads, which takes longer than fetching a small file and holds the GIL while it does, so
+    parallel downloads end up waiting on each other. This one uses the (thread-safe) s3_client
+    it's given for every file of every tile. It overrides the private _get_s3_client of
+    sentinelhub 3.4; with a sentinelhub that hasn't got it, the stock client is used instead
+    (see SHARED_S3_CLIENT). """
+class SharedAwsDownloadClient(AwsDownloadClient):
+    def __init__(self, *, s3_client, **kwargs):
+        super().__init__(**kwargs)
+        self.s3_client = s3_client
+
+    def _get_s3_client(self):
+        return self.s3_client
+
+
+SHARED_S3_CLIENT = hasattr(AwsDownloadClient, "_get_s3_client")
+
+
+""" Return an s3 client for SharedAwsDownloadClient with the credentials in config (an SHConfig),
+    keeping up to pool_size connections open. """
+def tile_s3_client(config=None, pool_size=TILE_THREADS * FILE_THREADS):
+    config = config or SHConfig()
+    return boto3.Session().client(
+        's3',
+        aws_access_key_id=config.aws_access_key_id or None,
+        aws_secret_access_key=config.aws_secret_access_key or None,
+        aws_session_token=getattr(config, 'aws_session_token', None) or None,
+        config=Config(max_pool_connections=pool_size)
+    )
+
+
+""" Outcome of one tile handled by download(). """
+class TileDownload:
+    def __init__(self, tile):
+        self.tile = tile        # (tile name, time, aws index)
+        self.files = []         # paths relative to the data folder
+        self.bytes = 0          # bytes downloaded (0 when skipped)
+        self.seconds = 0.0
+        self.skipped = False    # already in the data folder, matching the manifest
+        self.error = None       # the exception, if the download failed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        state = "skipped" if self.skipped else ("downloaded" if self.ok else f"failed: {self.error}")
+        return f"TileDownload({tile_key(self.tile)}, {state})"
+
+
+""" Manifest key of a (tile name, time, aws index) tile, the same as the folder AwsTileRequest
+    saves it in (ex. 18NWM,2021-10-10,0). """
+def tile_key(tile):
+    return f"{tile[0]},{tile[1]},{tile[2]}"
+
+
+""" Return the size, modification time and sha256 of a local file. """
+def file_record(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    stat = os.stat(path)
+    return {"bytes": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256.hexdigest()}
+
+
+""" True if the manifest lists tile as downloaded with the same bands and metafiles, and every
+    one of its files is still in data_folder with the recorded size and checksum. A file whose
+    size and modification time match the manifest isn't hashed again. """
+def is_downloaded(manifest, tile, bands, metafiles, data_folder):
+    key = tile_key(tile)
+    entry = manifest.get(key)
+    if entry is None or not entry.get('complete') or entry.get('bands') != list(bands) \
+            or entry.get('metafiles') != list(metafiles):
+        return False
+    files = dict(entry['files'])
+    for filename, recorded in entry['files'].items():
+        path = os.path.join(data_folder, filename)
+        if not os.path.isfile(path) or os.path.getsize(path) != recorded['bytes']:
+            return False
+        if os.path.getmtime(path) != recorded['mtime']:
+            current = file_record(path)
+            if current['sha256'] != recorded['sha256']:
+                return False
+            files[filename] = current
+    if files != entry['files']:
+        manifest.record(key, files=files)
+    return True
+
+
+""" Download one (tile name, time, aws index) tile into data_folder with an AwsTileRequest,
+    file_threads files at a time, and record its files in the manifest. Skipped if the manifest
+    shows it's already there (see is_downloaded). Files in s3 are fetched with s3_client if
+    given (see SharedAwsDownloadClient). Returns a TileDownload. """
+def download_tile(tile, bands, metafiles, data_folder, manifest, file_threads=FILE_THREADS, config=None,
+                  s3_client=None):
+    result = TileDownload(tile)
+    key = tile_key(tile)
+    start = time.perf_counter()
+    if is_downloaded(manifest, tile, bands, metafiles, data_folder):
+        result.skipped = True
+        result.files = list(manifest.get(key)['files'])
+        print(f"Skipping {key}, already in {data_folder}")
+        return result
+
+    print(f"Downloading {key}...")
+    try:
         request = AwsTileRequest(
             tile = tile[0],
             time = tile[1],
@@ -135,13 +257,61 @@ def download(downloads, bands=['R10m/B04', 'R10m/B08'], metafiles=['tileInfo', '
             bands = bands,
             metafiles = metafiles,
             data_folder = data_folder,
-            data_collection = DATA_COLLECTION
+            data_collection = DATA_COLLECTION,
+            config = config
         )
+        if s3_client is not None:
+            request.download_client_class = functools.partial(SharedAwsDownloadClient, s3_client=s3_client)
+        # whatever is on disk for this tile doesn't match the manifest, so fetch all of it again
+        request.save_data(redownload=True, max_threads=file_threads, raise_download_errors=True)
+        files = {filename: file_record(os.path.join(data_folder, filename)) for filename in request.get_filename_list()}
+        manifest.record(key, files=files, bands=list(bands), metafiles=list(metafiles), complete=True)
+        result.files = list(files)
+        result.bytes = sum(f['bytes'] for f in files.values())
+    except Exception as e:
+        result.error = e
+        print(f"Error downloading {key}: {e}")
+    result.seconds = time.perf_counter() - start
+    if result.ok:
+        print(f"Downloaded {key}: {len(result.files)} file(s), {result.bytes / 2**20:.1f} MB in "
+              f"{result.seconds:.1f} s ({result.throughput / 2**20:.1f} MB/s)")
+    return result
 
-        # trigger download
-        downloaded.append(request.save_data())
-        # downloaded.append(request.get_data(save_data=True))
-    
+
+""" Print how many tiles were downloaded, skipped and failed, with the overall and per-tile throughput. """
+def print_tile_summary(results, seconds):
+    downloaded = [r for r in results if r.ok and not r.skipped]
+    total = sum(r.bytes for r in downloaded)
+    rates = sorted(r.throughput for r in downloaded)
+    print(f"Downloaded {len(downloaded)} tile(s), {total / 2**20:.1f} MB in {seconds:.1f} s "
+          f"({total / 2**20 / seconds if seconds else 0:.1f} MB/s); "
+          f"{sum(r.skipped for r in results)} skipped, {sum(not r.ok for r in results)} failed")
+    if rates:
+        print(f"per tile: median {rates[len(rates) // 2] / 2**20:.1f} MB/s, slowest {rates[0] / 2**20:.1f} MB/s")
+
+
+""" Download (tile name, time, aws index) tiles into data_folder, tile_threads tiles at a time and
+    file_threads files of each tile at a time, all over one shared s3 client (see SHARED_S3_CLIENT).
+    Tiles already in data_folder, with the sizes and checksums recorded in its manifest
+    (MANIFEST_NAME), are skipped. config is an optional SHConfig for the AwsTileRequests. Returns a TileDownload for
+    every tile. """
+def download(downloads, bands=['R10m/B04', 'R10m/B08'], metafiles=['tileInfo', 'qi/MSK_CLOUDS_B00'], data_folder=".",
+             tile_threads=TILE_THREADS, file_threads=FILE_THREADS, config=None):
+    # by default, select R/NIR bands, tile info metadata file, and cloud mask
+
+    download = input(f"Download {len(downloads)} scene(s)? (Y/N) ")
+    if download.lower() not in {'y', 'yes'}:
+        return None
+
+    os.makedirs(data_folder, exist_ok=True)
+    manifest = DownloadJournal(os.path.join(data_folder, MANIFEST_NAME))
+    s3_client = tile_s3_client(config, tile_threads * (file_threads or FILE_THREADS)) if SHARED_S3_CLIENT else None
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=tile_threads) as executor:
+        downloaded = list(executor.map(
+            lambda tile: download_tile(tile, bands, metafiles, data_folder, manifest, file_threads, config, s3_client),
+            downloads))
+    print_tile_summary(downloaded, time.perf_counter() - start)
     return downloaded
 
 
@@ -161,6 +331,20 @@ def main():
                         help="s3 bucket to store downloaded scenes in")
     parser.add_argument("-quiet", "--q", dest="verbose", action="store_false",
                         help="suppress printing to the console")
+    parser.add_argument("-copythreads", "--ct", metavar="int",
+                        dest="copy_threads", type=int, default=COPY_WORKERS,
+                        help="max number of files to copy at once")
+    parser.add_argument("-partthreads", "--pt", metavar="int",
+                        dest="part_threads", type=int, default=COPY_PART_THREADS,
+                        help="max number of parts of one large file to copy at once")
+    parser.add_argument("-local", metavar="path/to/folder", type=str,
+                        help="download the tiles into this folder instead of copying them to s3")
+    parser.add_argument("-tilethreads", "--tt", metavar="int",
+                        dest="tile_threads", type=int, default=TILE_THREADS,
+                        help="max number of tiles to download at once (with -local)")
+    parser.add_argument("-filethreads", "--ft", metavar="int",
+                        dest="file_threads", type=int, default=FILE_THREADS,
+                        help="max number of files of one tile to download at once (with -local)")
     args = parser.parse_args()
 
 
@@ -169,14 +353,16 @@ def main():
     config = authenticate()
 
     tile_list = search(config, date_range=args.date_range, boundary=args.boundary)
-    # grab only desired files: R band, NIR band, metadata file, and cloud mask
-    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
-    copy_to_s3(tile_list, args.dst, files)
+    if args.local:
+        downloads = [aws_tile(path) for _, path in tile_list]
+        download(downloads, data_folder=args.local, tile_threads=args.tile_threads, file_threads=args.file_threads,
+                 config=config)
+    else:
+        # grab only desired files: R band, NIR band, metadata file, and cloud mask
+        files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+        copy_to_s3(tile_list, args.dst, files, workers=args.copy_threads, part_threads=args.part_threads)
 
     print("Done.")
 
-    # downloaded = download(downloads)
-    # print(downloaded)
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,12 @@
 import argparse
-import boto3
 import os
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse as parse_date
 
+from download_utils import S3Copier, s3_copy_client, COPY_WORKERS, COPY_PART_THREADS
+from s2_catalog import S2Catalog, S2_BUCKET, CATALOG_PATH, newest_sequences
+
 '''
 full example CLI command: aws s3 ls s3://sentinel-s2-l2a/tiles/18/N/WM/2021/10/10/0/R10m/B04.jp2 --request-payer requester --region eu-central-1
 
@@ -17,50 +20,90 @@ all farm points/geometries exist under the two tiles:
         MULTIPOLYGON(((-74.0958824705718 6.33225490763692,-74.0974723969699 5.33908748516154,-73.1067674643747 5.33683314603249,-73.1034341557557 6.3295781838079,-74.0958824705718 6.33225490763692)))
 '''
 
+def download(destination_bucket: str, start_date: datetime.datetime, end_date: datetime.datetime, tiles: list, files: list,
+             workers: int = COPY_WORKERS, part_threads: int = COPY_PART_THREADS, catalog_path: str = CATALOG_PATH,
+             cloud_max: float = None, aoi=None):
+    '''
+    Downloads the provided files from each of the provided tiles for all the dates in between and including
+        the start and end date. Assumes request payer.
+    What exists is looked up in the local S2Catalog at catalog_path, which first lists whatever dates it
+        hasn't seen yet, and every (tile, date, sequence, file) found is handed to an S3Copier, which runs workers
+        copies at once. Of the sequences of one datatake only the newest processing is copied (see
+        newest_sequences). With cloud_max, days whose tileInfo.json reports more cloud cover than it are skipped,
+        unless an aoi (shapely geometry, lon/lat) is given: then the cloud cover over the AOI decides (see
+        prefilter), and the JP2 bands of cloudy days are skipped while their small metadata files still get copied.
+        Either way, days whose cloud cover can't be told are kept.
+        Returns a CopyResult for every copy.
+    '''
+    target_bucket = S2_BUCKET
+
+    s3_client = s3_copy_client(workers, part_threads)
+    with S2Catalog(catalog_path, target_bucket) as catalog:
+        added = catalog.refresh(s3_client, tiles, start_date, end_date)
+        print(f"Catalog {catalog_path}: {added} new acquisition(s)")
+        tile_cloud_max = cloud_max if aoi is None else None
+        # a day may hold several sequences (reprocessings, split datatakes); keep the newest of each datatake,
+        # whatever its cloud cover, so superseded counts the same with or without cloud_max
+        acquisitions = catalog.acquisitions(tiles, start_date, end_date)
+        superseded = len(acquisitions) - len(newest_sequences(
+            (tile, date, sequence, product_name) for tile, date, sequence, _, product_name in acquisitions))
+        available = sorted(catalog.available(tiles, start_date, end_date, files, tile_cloud_max, newest_only=True))
+        if aoi is not None and cloud_max is not None:
+            scenes = {key[:3] for key in available}
+            covers = prefilter(s3_client, catalog, scenes, aoi, tiles, start_date, end_date, workers)
+            clear = {scene for scene in scenes if passes(covers[scene], cloud_max)}
+            skipped = [key for key in available if key[3].endswith('.jp2') and key[:3] not in clear]
+            available = [key for key in available if not (key[3].endswith('.jp2') and key[:3] not in clear)]
+            print(f"Cloud prefilter: {len(clear)} of {len(scenes)} scene(s) see the AOI with at most {cloud_max}% "
+                  f"cloud cover; skipping {len(skipped)} JP2 band(s) of the others")
+    for tile in tiles:
+        days = {date for t, date, _, _ in available if t == tile}
+        print(f"Found {len(days)} day(s) with images within {tile} between {start_date.date()} and {end_date.date()}")
+    if superseded:
+        print(f"Skipping {superseded} sequence(s) superseded by a newer processing baseline")
+    with S3Copier(s3_client, workers, part_threads) as copier:
+        for tile, date, sequence, file in available:
+            date_str = f"{date.year}/{date.month}/{date.day}/{sequence}/"
+            target_prefix = f'tiles/{tile}{date_str}{file}'
+            destination_prefix = f"sentinel-2/{tile}{date_str}{os.path.basename(file)}"
+            copier.submit(target_bucket, target_prefix, destination_bucket, destination_prefix)
+        results = copier.join()
+    copier.print_summary(results)
+    return results
+
 
-def checkExistence(s3_client, bucket, target_prefix):
+
+def prefilter(s3_client, catalog: S2Catalog, scenes: set, aoi, tiles: list, start_date: datetime.datetime,
+              end_date: datetime.datetime, threads: int = COPY_WORKERS):
     '''
-    Checks if object with given prefix exists in bucket. Assumes request payer.
+    Returns {(tile, date, sequence): (cloud_cover, aoi_coverage, source)} (see s2_clouds.aoi_cloud_cover) for the
+        scenes over aoi. Scenes the catalog already has a value for aren't read again; for the rest, tileInfo.json
+        and the GML cloud mask (a few KB each, against tens of MB per JP2 band) are read threads scenes at once.
     '''
-    response = s3_client.list_objects_v2(
-        Bucket=bucket, 
-        MaxKeys=1, 
-        Prefix=target_prefix, 
-        RequestPayer='requester')
-    if 'Contents' in response:
-        return True
-    else:
-        return False
+    # shapely and pyproj are only needed with a boundary
+    from s2_clouds import aoi_key, read_scene_cloud_cover
+    key = aoi_key(aoi)
+    covers = catalog.aoi_cloud_covers(key, tiles, start_date, end_date)
+    missing = sorted(scenes - set(covers))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        fetched = dict(zip(missing, executor.map(
+            lambda scene: read_scene_cloud_cover(s3_client, catalog.bucket, scene, aoi), missing)))
+    # scenes whose cloud cover couldn't be told are read again next time
+    catalog.record_aoi_cloud_covers(key, {scene: cover for scene, cover in fetched.items() if cover[2] is not None})
+    covers.update(fetched)
+    return covers
 
 
-def download(destination_bucket: str, start_date: datetime.datetime, end_date: datetime.datetime, tiles: list, files: list):
+def passes(cover: tuple, cloud_max: float):
     '''
-    Downloads the provided files from each of the provided tiles for all the dates in between and including
-        the start and end date. Assumes request payer.
+    Whether a scene's (cloud_cover, aoi_coverage, source) is worth copying the bands of: it sees some of the AOI and
+        has at most cloud_max percent cloud cover over it. Scenes whose cloud cover is unknown are kept.
     '''
-    target_bucket ='sentinel-s2-l2a'    
-    
-    s3_client = boto3.client("s3")
-    temp_date = start_date
-    while temp_date.date() <= end_date.date():
-        date_str = f"{temp_date.year}/{temp_date.month}/{temp_date.day}/0/"  # 0 indicates it is the first grouping of images (never saw more than one)
-        for tile in tiles:
-            for file in files:
-                target_prefix = f'tiles/{tile}{date_str}{file}'
-                destination_prefix = f"sentinel-2/{tile}{date_str}{os.path.basename(file)}"
-                if checkExistence(s3_client, target_bucket, target_prefix):
-                    s3_client.copy(
-                         {
-                             'Bucket': target_bucket,
-                             'Key': target_prefix
-                         },
-                        destination_bucket, 
-                        destination_prefix,
-                        ExtraArgs={'RequestPayer': 'requester'})
-                else:
-                    print(f"No {file} found within {tile} for {temp_date.date()}")
-        temp_date += datetime.timedelta(days=1)
-        
+    cloud_cover, aoi_coverage, _ = cover
+    if aoi_coverage is not None and aoi_coverage == 0:
+        return False
+    return cloud_cover is None or cloud_cover <= cloud_max
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -73,6 +116,18 @@ def main():
                         help="s3 bucket to store downloaded scenes in")
 #     parser.add_argument("-quiet", "--q", dest="verbose", action="store_false",
 #                         help="suppress printing to the console")
+    parser.add_argument("-copythreads", "--ct", metavar="int",
+                        dest="copy_threads", type=int, default=COPY_WORKERS,
+                        help="max number of files to copy at once")
+    parser.add_argument("-partthreads", "--pt", metavar="int",
+                        dest="part_threads", type=int, default=COPY_PART_THREADS,
+                        help="max number of parts of one large file to copy at once")
+    parser.add_argument("-catalog", metavar="path", type=str, default=CATALOG_PATH,
+                        help="sqlite file caching which tiles/dates exist in the S2 bucket")
+    parser.add_argument("-cloud-max", "--cm", dest="cloud_max", type=float,
+                        help="skip days with more cloud cover (percent, over the boundary if given, else the tile)")
+    parser.add_argument("-boundary", "--b", metavar="path/to/geojson", type=str,
+                        help="geojson of the area of interest to measure cloud cover over")
     args = parser.parse_args()
     
     start_date = parse_date(args.date_range[0])
@@ -84,7 +139,12 @@ def main():
     # grab only desired files: R band, NIR band, metadata file, and cloud mask   
     files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
     
-    download(args.dst, start_date, end_date, tiles, files)
+    aoi = None
+    if args.boundary:
+        from s2_clouds import load_aoi  # needs shapely and pyproj
+        aoi = load_aoi(args.boundary)
+    download(args.dst, start_date, end_date, tiles, files, workers=args.copy_threads, part_threads=args.part_threads,
+             catalog_path=args.catalog, cloud_max=args.cloud_max, aoi=aoi)
     
     print("Done.")
 
@@ -6,13 +6,94 @@ import threading
 import re
 import os
 import glob
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
 
-from botocore.exceptions import ClientError
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 
 
-sema = None
-threads = []
+sema = None # limits the number of concurrent download connections
 path = "" # download path
+download_chunk_size = 1 << 20 # bytes read from the connection and written to disk at a time
+journal = None # DownloadJournal recording download progress, if set
+segments = 1 # connections a single large download may be split across
+http_session = None # HTTPSession used for every request (see get_session)
+session_lock = threading.Lock()
+
+SEGMENT_MIN_BYTES = 32 << 20 # files smaller than this always download over one connection
+JOURNAL_CHECKPOINT_BYTES = 64 << 20 # how often a running download's byte count is journaled
+HTTP_POOL_SIZE = 10 # keep-alive connections kept open per host
+HTTP_TIMEOUT = (10, 120) # seconds to wait for a connection, and for data on an open one
+UPLOAD_CHUNK_SIZE = 64 << 20 # part size of multipart s3 uploads (files larger than this are split)
+COPY_CHUNK_SIZE = 32 << 20 # part size of multipart s3 copies (objects larger than this are split)
+COPY_WORKERS = 16 # objects copied at once by S3Copier
+COPY_PART_THREADS = 4 # parts of one multipart copy copied at once
+
+
+""" Thread-safe pooled HTTP layer shared by send_request and the download functions.
+    requests.Session isn't safe to share between threads, so every thread gets its own, but
+    they all mount the same HTTPAdapter, whose urllib3 pools are: a keep-alive connection to
+    a host is reused by whichever thread asks next instead of opening a new TCP/TLS
+    connection per request. Requests time out after timeout unless they pass their own.
+    After authenticate(), the API key is sent as the X-Auth-Token header on requests to the
+    API (and only there, so download hosts never see it). """
+class HTTPSession:
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.timeout = timeout
+        self.api_url = None
+        self.api_key = None
+        self.local = threading.local()
+
+    """ The calling thread's requests.Session. """
+    @property
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    """ Send api_key with every later request to a URL starting with api_url. """
+    def authenticate(self, api_url, api_key):
+        self.api_url = api_url
+        self.api_key = api_key
+
+    """ Send a request with the pooled connections. api_key overrides the authenticated key. """
+    def request(self, method, url, api_key=None, **kwargs):
+        if api_key is None and self.api_key is not None and url.startswith(self.api_url):
+            api_key = self.api_key
+        if api_key is not None:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'X-Auth-Token': api_key}
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+""" Return the shared HTTPSession, creating one with the default settings if main hasn't
+    set http_session. """
+def get_session():
+    global http_session
+    with session_lock:
+        if http_session is None:
+            http_session = HTTPSession()
+        return http_session
 
 
 """ Prompt user for API credentials. """
@@ -22,15 +103,11 @@ def get_credentials(prompt="Username: "):
     return username, password
 
 
-""" Send an HTTP POST request. """
+""" Send an HTTP POST request to the M2M API over the shared session. """
 def send_request(url, data, apiKey=None, exitIfNoResponse=True):  
     json_data = json.dumps(data)
     
-    if apiKey == None:
-        response = requests.post(url, json_data)
-    else:
-        headers = {'X-Auth-Token': apiKey}              
-        response = requests.post(url, json_data, headers = headers)  
+    response = get_session().post(url, json_data, api_key=apiKey)
     
     try:
       httpStatusCode = response.status_code 
@@ -65,48 +142,673 @@ def send_request(url, data, apiKey=None, exitIfNoResponse=True):
     return output['data']
 
 
-""" Download a file from the specified URL. Will append to completed_list if provided. """
-def download_file(url, completed_list = [], max_tries=5):
-    sema.acquire()
-    try:        
-        response = requests.get(url, stream=True)
-        disposition = response.headers['content-disposition']
-        filename = re.findall("filename=(.+)", disposition)[0].strip("\"")
-        print(f"Downloading {filename}...")
-        if path != "" and path[-1] != "/":
-            filename = "/" + filename
-        open(path+filename, 'wb').write(response.content)
-        print(f"Downloaded {filename}.")
-        completed_list.append(filename)
-        sema.release()
-    except Exception as e:
-        sema.release()
-        print(f"Failed to download from {url}: {e}")
-        if max_tries > 0:
-            print("Attempting to redownload...")
-            threaded_download(url, threads, completed_list, max_tries - 1)
+""" Download a file from the specified URL into path, streaming it to disk chunk_size
+    (default download_chunk_size) bytes at a time. Returns the name of the downloaded file.
+    An interrupted download leaves its data in <name>.part, and the next attempt (in this
+    run or a later one) asks the server for the rest with a Range request. When journal is
+    set, progress is recorded under entity_id (or the file name) so reruns can skip or
+    resume it. With segments > 1, large files are fetched over several connections at once
+    (see download_segments). If given a DownloadResult, the time to first byte is recorded on
+    it. Raises an exception if the download fails; retrying is left to DownloadManager. """
+def download_file(url, chunk_size=None, entity_id=None, result=None):
+    key = entity_id
+    entry = journal.get(key) if journal is not None and key is not None else None
+    with sema if sema is not None else nullcontext():
+        response, filename, offset = open_download(url, entry['filename'] if entry else None)
+        if result is not None:
+            result.ttfb = response.elapsed.total_seconds()
+        key = key or filename
+        try:
+            destination = download_destination(filename)
+            progress = journal.checkpoint(key, filename, offset) if journal is not None else None
+            try:
+                if offset == 0 and segments > 1 and can_segment(response):
+                    written = download_segments(url, response, destination, chunk_size)
+                else:
+                    if offset:
+                        print(f"Resuming {filename} from byte {offset}...")
+                    else:
+                        print(f"Downloading {filename}...")
+                    written = write_response(response, destination, chunk_size, offset=offset,
+                                             keep_partial=True, progress=progress)
+            except BaseException:
+                if journal is not None:
+                    journal.record(key, filename=filename, bytes=partial_size(filename), complete=False)
+                raise
+        finally:
+            response.close()
+    if journal is not None:
+        journal.record(key, filename=filename, bytes=offset + written, complete=True)
+    print(f"Downloaded {filename}.")
+    return filename
+
+
+""" Send the GET for a download, continuing from the file's .part when there is one.
+    filename is only known up front when the journal has seen the download before; otherwise
+    the first response names the file and, if a .part of that name exists, the request is
+    sent again with a Range header. Returns (response, filename, offset), where offset is the
+    number of bytes already on disk that the response body continues from. """
+def open_download(url, filename=None):
+    offset = partial_size(filename) if filename else 0
+    response = request_download(url, offset)
+    if filename is None:
+        filename = filename_from_response(response)
+        offset = partial_size(filename)
+        if offset:
+            response.close()
+            response = request_download(url, offset)
+    if offset and response_start(response) != offset:
+        # the server ignored the Range header or the .part is no longer usable: start over
+        response.close()
+        os.remove(download_destination(filename) + ".part")
+        offset = 0
+        response = request_download(url)
+    return response, filename, offset
+
+
+""" GET url as a stream, asking for everything from byte offset onwards. """
+def request_download(url, offset=0):
+    headers = {'Range': f"bytes={offset}-"} if offset else None
+    response = get_session().get(url, stream=True, headers=headers)
+    if response.status_code != 416: # range not satisfiable, handled by open_download
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
+    return response
+
+
+""" Byte position a response body starts at: 0 for a full response, the start of the
+    Content-Range for a partial (206) one, and None if the requested range was refused. """
+def response_start(response):
+    if response.status_code != 206:
+        return 0 if response.ok else None
+    match = re.match(r"bytes (\d+)-", response.headers.get('content-range', ""))
+    return int(match.group(1)) if match else None
+
+
+""" Return where a downloaded file goes in path. """
+def download_destination(filename):
+    return os.path.join(path, filename) if path != "" else filename
+
+
+""" Return the number of bytes already in a file's .part, or 0 if it has none. """
+def partial_size(filename):
+    partial_path = download_destination(filename) + ".part"
+    return os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+
+
+""" Return the file name given in a response's Content-Disposition header. """
+def filename_from_response(response):
+    disposition = response.headers['content-disposition']
+    return re.findall("filename=(.+)", disposition)[0].strip("\"")
+
+
+""" Stream a response body into destination. The data goes to destination.part first and is
+    only renamed once all of it has arrived (and matches Content-Length, when given), so a
+    file at destination is always complete. With offset, the body is appended to the first
+    offset bytes already in the .part. On failure the .part is removed unless keep_partial
+    is set, in which case it is left for a later Range request to continue. progress, if
+    given, is called with the total bytes in the .part after every chunk.
+    Returns the number of bytes written. """
+def write_response(response, destination, chunk_size=None, offset=0, keep_partial=False, progress=None):
+    chunk_size = chunk_size or download_chunk_size
+    temp_path = destination + ".part"
+    written = 0
+    try:
+        with open(temp_path, 'ab' if offset else 'wb') as file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+                written += len(chunk)
+                if progress is not None:
+                    progress(offset + written)
+        check_content_length(response, written)
+    except BaseException:
+        if not keep_partial and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, destination)
+    return written
+
+
+""" Raise an IOError if fewer/more bytes arrived than the response's Content-Length.
+    Skipped for encoded (e.g. gzip) responses, where the header counts the encoded size. """
+def check_content_length(response, received):
+    expected = response.headers.get('content-length')
+    if expected is None or response.headers.get('content-encoding'):
+        return
+    if received != int(expected):
+        raise IOError(f"Incomplete download: received {received} of {expected} bytes")
+
+
+""" True if a response is a full download large enough to be worth splitting into byte
+    ranges, from a server that says it accepts Range requests. """
+def can_segment(response):
+    return (response.status_code == 200
+            and response.headers.get('accept-ranges') == 'bytes'
+            and not response.headers.get('content-encoding')
+            and int(response.headers.get('content-length', 0)) >= SEGMENT_MIN_BYTES)
+
+
+""" Download one file over several connections. The caller's response (already holding one
+    of sema's connections) supplies the first byte range; as many extra connections as sema
+    has free right now (up to segments - 1) fetch the others concurrently over the shared
+    session, each writing its range straight to its place in a preallocated destination.part.
+    Segmented .part files are sparse until complete, so on failure the .part is removed
+    instead of being left to resume from. Returns the number of bytes written. """
+def download_segments(url, response, destination, chunk_size=None):
+    chunk_size = chunk_size or download_chunk_size
+    size = int(response.headers['content-length'])
+    extra = acquire_connections(segments - 1)
+    ranges = split_ranges(size, extra + 1)
+    temp_path = destination + ".part"
+    failed = threading.Event()
+    print(f"Downloading {os.path.basename(destination)} over {len(ranges)} connection(s)...")
+    try:
+        with open(temp_path, 'wb') as file:
+            preallocate(file, size)
+            writer = PositionedWriter(file)
+            with ThreadPoolExecutor(max_workers=max(1, extra)) as executor:
+                futures = [executor.submit(fetch_range, url, start, end, writer, chunk_size, failed)
+                           for start, end in ranges[1:]]
+                try:
+                    write_range(response, *ranges[0], writer, chunk_size, failed)
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    failed.set()
+                    raise
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        release_connections(extra)
+    os.replace(temp_path, destination)
+    return size
+
+
+""" Split [0, size) into at most n contiguous (start, end) byte ranges, end exclusive. """
+def split_ranges(size, n):
+    step = -(-size // max(1, n))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+""" Take up to n connections from sema without waiting for any. A download that already
+    holds a connection must not block on more: once every worker holds one and waits for
+    another, nothing would ever be released. Returns the number taken. """
+def acquire_connections(n):
+    if sema is None:
+        return max(0, n)
+    taken = 0
+    while taken < n and sema.acquire(blocking=False):
+        taken += 1
+    return taken
+
+
+def release_connections(n):
+    if sema is not None:
+        for _ in range(n):
+            sema.release()
+
+
+""" GET bytes [start, end) of url and write them to their place in the file. """
+def fetch_range(url, start, end, writer, chunk_size, failed):
+    response = get_session().get(url, stream=True, headers={'Range': f"bytes={start}-{end - 1}"})
+    try:
+        response.raise_for_status()
+        if response_start(response) != start:
+            raise IOError(f"Server ignored the range request for bytes {start}-{end - 1}")
+        write_range(response, start, end, writer, chunk_size, failed)
+    finally:
+        response.close()
+
+
+""" Write a response body into the file from byte start, stopping at end (the caller's full
+    response runs past its range). Gives up as soon as another segment has failed. """
+def write_range(response, start, end, writer, chunk_size, failed):
+    position = start
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if failed.is_set():
+            raise IOError("Download abandoned after another segment failed")
+        chunk = chunk[:end - position]
+        writer.write(chunk, position)
+        position += len(chunk)
+        if position >= end:
+            break
+    if position != end:
+        raise IOError(f"Incomplete segment: received {position - start} of {end - start} bytes")
+
+
+""" Reserve size bytes on disk for file up front (sparse if the filesystem can't allocate). """
+def preallocate(file, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    file.truncate(size)
+
+
+""" Writes chunks at given offsets of an open file from several threads. Uses os.pwrite,
+    which doesn't touch the shared file position, where available (not on Windows) and
+    seek + write under a lock otherwise. """
+class PositionedWriter:
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def write(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.file.fileno(), view, offset)
+                view = view[written:]
+                offset += written
         else:
+            with self.lock:
+                self.file.seek(offset)
+                self.file.write(data)
+
+
+""" Records the progress of each download in a json file so an interrupted run can resume.
+    Entries are keyed by entity ID (or file name) and hold {"filename", "bytes", "complete"};
+    bytes is checkpointed every checkpoint_bytes while a file downloads and on failure. The
+    .part file on disk stays the source of truth for where a download resumes from. """
+class DownloadJournal:
+    def __init__(self, journal_path, checkpoint_bytes=JOURNAL_CHECKPOINT_BYTES):
+        self.journal_path = journal_path
+        self.checkpoint_bytes = checkpoint_bytes
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    """ True if key was fully downloaded by an earlier run. """
+    def is_complete(self, key):
+        entry = self.get(key)
+        return entry is not None and entry['complete']
+
+    """ Names of the files fully downloaded by earlier runs, for the given keys. """
+    def completed_files(self, keys):
+        return [self.get(key)['filename'] for key in keys if self.is_complete(key)]
+
+    def record(self, key, **fields):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(fields)
+            self.write()
+
+    """ Return a progress callback for write_response that records key's byte count
+        every checkpoint_bytes. """
+    def checkpoint(self, key, filename, offset=0):
+        self.record(key, filename=filename, bytes=offset, complete=False)
+        last = [offset]
+        def progress(received):
+            if received - last[0] >= self.checkpoint_bytes:
+                last[0] = received
+                self.record(key, bytes=received)
+        return progress
+
+    def load(self):
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as journal_file:
+                return json.loads(journal_file.read())
+        return {}
+
+    def write(self):
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, 'w') as journal_file:
+            journal_file.write(json.dumps(self.entries, indent=2))
+        os.replace(temp_path, self.journal_path)
+
+
+""" Outcome of one file handled by DownloadManager. """
+class DownloadResult:
+    def __init__(self, url):
+        self.url = url
+        self.filename = None    # set once the file has been downloaded
+        self.attempts = 0
+        self.error = None       # last exception, if the download never succeeded
+        self.seconds = 0.0      # time from the first attempt to the last
+        self.submitted_at = time.time() # when the URL was handed to the manager
+        self.queue_wait = None  # seconds between submission and a worker picking it up
+        self.ttfb = None        # seconds from sending the request to the response arriving
+
+    @property
+    def ok(self):
+        return self.filename is not None
+
+    def __repr__(self):
+        state = self.filename if self.ok else f"failed: {self.error}"
+        return f"DownloadResult({self.url}, {state}, attempts={self.attempts})"
+
+
+""" Downloads files on a fixed pool of worker threads.
+    submit() blocks once max_queued downloads are waiting or running, failed downloads are
+    retried in the same worker with exponential backoff and jitter, and join() returns one
+    DownloadResult per submitted URL (in submission order) as soon as the last one finishes.
+    download is called as download(url, result=result, **kwargs) and may record timings
+    (e.g. ttfb) on the DownloadResult. on_download, if given, is called with the DownloadResult
+    of each successful download from the worker thread, e.g. to queue it for upload. """
+class DownloadManager:
+    def __init__(self, workers=5, max_queued=None, max_tries=5, backoff=2, max_backoff=60, download=download_file,
+                 on_download=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue_slots = threading.BoundedSemaphore(max_queued or 2 * workers)
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.download = download
+        self.on_download = on_download
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    """ Queue a URL for download. Keyword arguments are passed on to the download function
+        (e.g. entity_id for download_file). Returns a future for its DownloadResult. """
+    def submit(self, url, **kwargs):
+        # created first so time spent blocked on a full queue counts as queue wait
+        result = DownloadResult(url)
+        self.queue_slots.acquire()
+        future = self.executor.submit(self._download, result, kwargs)
+        future.add_done_callback(lambda _: self.queue_slots.release())
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def _download(self, result, kwargs):
+        url = result.url
+        result.queue_wait = time.time() - result.submitted_at
+        start = time.perf_counter()
+        while result.attempts < self.max_tries:
+            result.attempts += 1
+            try:
+                result.filename = self.download(url, result=result, **kwargs)
+                result.error = None
+                break
+            except Exception as e:
+                result.error = e
+                print(f"Failed to download from {url}: {e}")
+                if result.attempts < self.max_tries:
+                    delay = min(self.max_backoff, self.backoff * 2 ** (result.attempts - 1))
+                    delay *= random.uniform(0.5, 1.5)
+                    print(f"Attempting to redownload in {delay:.0f} seconds...")
+                    time.sleep(delay)
+        result.seconds = time.perf_counter() - start
+        if not result.ok:
             print("Max number of tries exceeded. Aborting...")
-    
-""" Download a file from the specified URL in a new thread. Will append to completed_list if provided. """    
-def threaded_download(url, threads, completed_list=[], max_tries=5):
-    thread = threading.Thread(target=download_file, args=(url, completed_list, max_tries))
-    threads.append(thread)
-    thread.start()
+        elif self.on_download is not None:
+            self.on_download(result)
+        return result
+
+    """ Wait for every submitted download to finish and return their DownloadResults. """
+    def join(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
 
 
-""" Given the name of a file on local storage, upload it to an s3 bucket then delete the local copy. """
-def upload_to_s3(filename, bucket, prefix, s3, delete=False):
+""" Print the median and worst queue wait and time to first byte of a list of DownloadResults. """
+def print_download_stats(results):
+    for label, values in (("queue wait", [r.queue_wait for r in results if r.queue_wait is not None]),
+                          ("time to first byte", [r.ttfb for r in results if r.ttfb is not None])):
+        if values:
+            values = sorted(values)
+            print(f"{label}: median {values[len(values) // 2]:.2f} s, max {values[-1]:.2f} s")
+
+
+""" Given the name of a file on local storage, upload it to an s3 bucket then delete the local copy.
+    config is an optional boto3 TransferConfig for the managed (multipart) upload.
+    Returns True if the upload succeeded. """
+def upload_to_s3(filename, bucket, prefix, s3, delete=False, config=None):
     try:
         key = s3_join(prefix, filename)
         print("Uploading " + filename + " to s3...")
-        s3.meta.client.upload_file(Filename=filename, Bucket=bucket, Key=key)
+        s3.meta.client.upload_file(Filename=filename, Bucket=bucket, Key=key, Config=config)
         if delete:
             os.remove(filename)
-    except ClientError as e:
-        print("Error while trying to upload " + filename + ": " +  e)
-    
-    
+        return True
+    except (ClientError, S3UploadFailedError) as e:
+        print(f"Error while trying to upload {filename}: {e}")
+        return False
+
+
+""" Uploads files to s3 on its own pool of worker threads, so files can be uploaded while
+    others are still downloading, and deletes each local file as soon as its upload is done
+    (with delete). Each file is sent as a multipart upload of chunk_size parts, transfer_threads
+    parts at a time. join() returns (filename, uploaded) for every submitted file. """
+class S3Uploader:
+    def __init__(self, bucket, s3, workers=2, transfer_threads=4, chunk_size=UPLOAD_CHUNK_SIZE, delete=True):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=transfer_threads)
+        self.bucket = bucket
+        self.s3 = s3
+        self.delete = delete
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    """ Queue a local file for upload under prefix. Returns a future for whether it uploaded. """
+    def submit(self, filename, prefix):
+        future = self.executor.submit(upload_to_s3, filename, self.bucket, prefix, self.s3, self.delete, self.config)
+        with self.lock:
+            self.futures.append((filename, future))
+        return future
+
+    def join(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait([future for _, future in futures])
+        return [(filename, future.result()) for filename, future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+""" Download a file from url straight into s3, without touching local disk: the response body
+    is read by boto3's managed upload as a stream and sent as a multipart upload of
+    chunk_size parts, transfer_threads at a time, so memory use stays around
+    chunk_size * transfer_threads however large the file is. The object is stored under
+    prefix_for(filename), where filename comes from the response's Content-Disposition.
+    A failed transfer aborts the multipart upload, leaving nothing behind, and raises (the
+    whole file is sent again on retry). Records the time to first byte on result and the
+    finished file in the journal, like download_file. Returns the name of the file. """
+def stream_to_s3(url, bucket, s3, prefix_for, entity_id=None, result=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, transfer_threads=4):
+    config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                            max_concurrency=transfer_threads)
+    with sema if sema is not None else nullcontext():
+        response = request_download(url)
+        try:
+            if result is not None:
+                result.ttfb = response.elapsed.total_seconds()
+            filename = filename_from_response(response)
+            key = s3_join(prefix_for(filename), filename)
+            print(f"Streaming {filename} to s3://{bucket}/{key}...")
+            body = CountingReader(response.raw)
+            s3.meta.client.upload_fileobj(body, bucket, key, Config=config)
+            try:
+                check_content_length(response, body.count)
+            except IOError:
+                s3.meta.client.delete_object(Bucket=bucket, Key=key)
+                raise
+        finally:
+            response.close()
+    if journal is not None:
+        journal.record(entity_id or filename, filename=filename, bytes=body.count, complete=True)
+    print(f"Uploaded {filename}.")
+    return filename
+
+
+""" File-like wrapper around a stream that counts the bytes read through it. """
+class CountingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size if size is not None and size >= 0 else None)
+        self.count += len(data)
+        return data
+
+
+""" Return an s3 client for copying with workers objects at once, part_threads parts each:
+    its connection pool is big enough for all of them, and botocore's standard retry mode
+    retries throttled requests with backoff before S3Copier's own retries kick in. (The
+    adaptive mode also rate-limits the whole client after a throttle, which serializes
+    every copy in flight.) """
+def s3_copy_client(workers=COPY_WORKERS, part_threads=COPY_PART_THREADS):
+    config = Config(max_pool_connections=workers * part_threads + workers,
+                    retries={'mode': 'standard', 'max_attempts': 5})
+    return boto3.client("s3", config=config)
+
+
+""" Outcome of one object handled by S3Copier. """
+class CopyResult:
+    def __init__(self, source_bucket, source_key, dst_bucket, dst_key):
+        self.source_bucket = source_bucket
+        self.source_key = source_key
+        self.dst_bucket = dst_bucket
+        self.dst_key = dst_key
+        self.attempts = 0
+        self.bytes = 0          # bytes copied by the last attempt
+        self.missing = False    # the source object doesn't exist
+        self.error = None       # last exception, if the copy never succeeded
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and not self.missing
+
+    def __repr__(self):
+        state = "copied" if self.ok else ("missing" if self.missing else f"failed: {self.error}")
+        return f"CopyResult(s3://{self.source_bucket}/{self.source_key}, {state}, attempts={self.attempts})"
+
+
+""" Copies objects between buckets server-side on a pool of worker threads, so many
+    latency-bound (e.g. cross-region, requester-pays) copies are in flight at once instead
+    of one after another. Objects larger than chunk_size are copied as multipart copies,
+    part_threads parts at a time. Throttling errors (SlowDown, 503, ...) and connection errors
+    (timeouts, dropped or refused connections) that outlast the client's own retries are
+    retried with exponential backoff and jitter, up to max_tries attempts; a missing source
+    object is reported, not retried. Any other error fails only its own copy, so join()
+    returns one CopyResult per submitted copy, in submission order. """
+class S3Copier:
+    THROTTLING_ERRORS = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                         'TooManyRequestsException', 'ServiceUnavailable', '503'}
+    MISSING_ERRORS = {'404', 'NoSuchKey', 'NotFound'}
+    # EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError, ConnectionClosedError, ...
+    CONNECTION_ERRORS = (BotoConnectionError, HTTPClientError)
+
+    def __init__(self, s3_client, workers=COPY_WORKERS, part_threads=COPY_PART_THREADS, chunk_size=COPY_CHUNK_SIZE,
+                 max_tries=5, backoff=1, max_backoff=30, request_payer=True):
+        self.s3_client = s3_client
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=part_threads)
+        self.extra_args = {'RequestPayer': 'requester'} if request_payer else None
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.futures = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    """ Queue a copy of s3://source_bucket/source_key to s3://dst_bucket/dst_key.
+        Returns a future for its CopyResult. """
+    def submit(self, source_bucket, source_key, dst_bucket, dst_key):
+        result = CopyResult(source_bucket, source_key, dst_bucket, dst_key)
+        future = self.executor.submit(self._copy, result)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def _copy(self, result):
+        start = time.perf_counter()
+        copy_source = {'Bucket': result.source_bucket, 'Key': result.source_key}
+        while result.attempts < self.max_tries:
+            result.attempts += 1
+            result.bytes = 0
+            try:
+                print(f"Copying to s3://{result.dst_bucket}/{result.dst_key}...")
+                self.s3_client.copy(copy_source, result.dst_bucket, result.dst_key, ExtraArgs=self.extra_args,
+                                    Config=self.config, Callback=lambda copied: self._add_bytes(result, copied))
+                result.error = None
+                break
+            except Exception as e:
+                result.error = e
+                code = e.response.get('Error', {}).get('Code') if isinstance(e, ClientError) else None
+                if code in self.MISSING_ERRORS:
+                    result.missing = True
+                    print(f"No object at s3://{result.source_bucket}/{result.source_key}")
+                    break
+                throttled = code in self.THROTTLING_ERRORS
+                if not (throttled or isinstance(e, self.CONNECTION_ERRORS)) or result.attempts == self.max_tries:
+                    print(f"Failed to copy s3://{result.source_bucket}/{result.source_key}: {e}")
+                    break
+                delay = min(self.max_backoff, self.backoff * 2 ** (result.attempts - 1))
+                delay *= random.uniform(0.5, 1.5)
+                print(f"{'Throttled' if throttled else 'Connection error'} copying "
+                      f"s3://{result.source_bucket}/{result.source_key}, retrying in {delay:.0f} seconds...")
+                time.sleep(delay)
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def _add_bytes(self, result, copied):
+        with self.lock:
+            result.bytes += copied
+
+    """ Wait for every submitted copy to finish and return their CopyResults. """
+    def join(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    """ Print how many copies succeeded, were missing or failed, and the throughput since the
+        copier was created. """
+    def print_summary(self, results):
+        elapsed = time.perf_counter() - self.start
+        copied = [r for r in results if r.ok]
+        missing = [r for r in results if r.missing]
+        failed = [r for r in results if not r.ok and not r.missing]
+        total_bytes = sum(r.bytes for r in copied)
+        retried = sum(1 for r in results if r.attempts > 1)
+        print(f"Copied {len(copied)} object(s), {total_bytes / (1 << 20):.1f} MB in {elapsed:.1f} s "
+              f"({total_bytes / (1 << 20) / max(elapsed, 1e-9):.1f} MB/s); {len(missing)} missing, "
+              f"{len(failed)} failed, {retried} throttled or disconnected and retried.")
+        for result in failed:
+            print(f"  s3://{result.source_bucket}/{result.source_key}: {result.error}")
+
+
 """ Intelligently join objects of elements with forward slashes.
     os.path.join will use backslashes on Windows machines, which must be corrected. """
 def s3_join(*elements):
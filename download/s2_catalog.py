@@ -0,0 +1,340 @@
+import re
+import json
+import sqlite3
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Local catalog of what the sentinel-s2-l2a bucket holds for the farm tiles, so planning a copy over a date range
+    is a query against a SQLite file instead of a walk over the bucket.
+
+The bucket only ever gains acquisitions, so each tile remembers the date ranges already listed and a refresh only
+    lists the dates outside them. The last REFRESH_OVERLAP_DAYS days before a listing may still have been ingesting
+    at the time, so they don't count as listed.
+    Cloud cover and product name come from each new acquisition's tileInfo.json, read once when the acquisition is
+    first seen.
+
+A day can hold more than one sequence (0, 1, ...) of a tile: the same datatake reprocessed with a newer processing
+    baseline, or a datatake split in two. The product name (ex. S2A_MSIL2A_20211010T153621_N0301_R068_T18NWM_20211010T194227)
+    tells them apart, see newest_sequences.
+'''
+
+S2_BUCKET = 'sentinel-s2-l2a'
+CATALOG_PATH = "s2_catalog.sqlite"
+REFRESH_OVERLAP_DAYS = 3
+TILE_INFO_THREADS = 8
+
+# [mission]_MSIL2A_[sensing time]_N[processing baseline]_R[relative orbit]_T[tile]_[generation time]
+PRODUCT_NAME_PATTERN = re.compile(r"(?P<mission>S2[A-D])_MSI(?P<level>L\w{2})_(?P<sensing>\d{8}T\d{6})_N(?P<baseline>\d{4})_"
+                                  r"R(?P<orbit>\d{3})_T(?P<tile>\w{5})_(?P<generation>\d{8}T\d{6})")
+
+# tiles/[UTM code]/latitude band/square/[year]/[month]/[day]/[sequence]/[file], where file may sit in a folder (ex. R10m/B04.jp2)
+S2_KEY_PATTERN = re.compile(r"tiles/(?P<tile>\d{1,2}/\w/\w{2}/)(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/"
+                            r"(?P<sequence>\d+)/(?P<file>.+)")
+
+
+def list_available(s3_client, bucket: str, tiles: list, start_date: datetime.date, end_date: datetime.date,
+                   files: list = None):
+    '''
+    Builds an index of what is available in bucket for the tiles between start_date and end_date (inclusive),
+        as a set of (tile, date, sequence, file) tuples, keeping only the given files if any. Assumes request payer.
+    Instead of asking about each tile/day/file, lists every key under tiles/{utm}/{lat}/{sq}/{year}/{month}/ once
+        for each month touching the range, a page of up to 1000 keys per request, so a year of a tile costs about
+        12 requests whether or not there was an acquisition on a given day.
+    '''
+    start_date, end_date = as_date(start_date), as_date(end_date)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    available = set()
+    for tile in tiles:
+        for year, month in months_between(start_date, end_date):
+            pages = paginator.paginate(Bucket=bucket, Prefix=f"tiles/{tile}{year}/{month}/", RequestPayer='requester')
+            for page in pages:
+                for obj in page.get('Contents', []):
+                    m = S2_KEY_PATTERN.match(obj['Key'])
+                    if not m or (files is not None and m.group('file') not in files):
+                        continue
+                    date = datetime.date(int(m.group('year')), int(m.group('month')), int(m.group('day')))
+                    if start_date <= date <= end_date:
+                        available.add((tile, date, int(m.group('sequence')), m.group('file')))
+    return available
+
+
+def months_between(start_date: datetime.date, end_date: datetime.date):
+    '''
+    Returns the (year, month) of every month from start_date to end_date, inclusive.
+    '''
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def as_date(date):
+    '''
+    Returns the date part of a datetime (dateutil's parse gives datetimes), or date itself if it already is one.
+    '''
+    return date.date() if isinstance(date, datetime.datetime) else date
+
+
+def read_tile_info(s3_client, bucket: str, tile: str, date: datetime.date, sequence: int):
+    '''
+    Returns the (cloudyPixelPercentage, dataCoveragePercentage, productName) of an acquisition from its
+        tileInfo.json, with None for whatever is missing or unreadable. Assumes request payer.
+    '''
+    key = f"tiles/{tile}{date.year}/{date.month}/{date.day}/{sequence}/tileInfo.json"
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key, RequestPayer='requester')
+        tile_info = json.loads(obj['Body'].read())
+    except Exception as e:
+        print(f"Could not read cloud cover from s3://{bucket}/{key}: {e}")
+        return None, None, None
+    return tile_info.get('cloudyPixelPercentage'), tile_info.get('dataCoveragePercentage'), tile_info.get('productName')
+
+
+def newest_sequences(acquisitions):
+    '''
+    Takes in (tile, date, sequence, product_name) tuples and returns the set of (tile, date, sequence) to keep:
+        one per tile and datatake (sensing time in the product name), the one with the newest processing baseline,
+        then the latest generation time, then the highest sequence. Sequences with no product name count as one
+        datatake per tile and day, so the highest of them is kept.
+    '''
+    newest = {}
+    for tile, date, sequence, product_name in acquisitions:
+        m = PRODUCT_NAME_PATTERN.match(product_name or '')
+        datatake = (tile, date, m.group('sensing') if m else None)
+        rank = (m.group('baseline'), m.group('generation'), sequence) if m else ('', '', sequence)
+        if datatake not in newest or rank > newest[datatake][0]:
+            newest[datatake] = (rank, (tile, date, sequence))
+    return {kept for _, kept in newest.values()}
+
+
+class S2Catalog:
+    '''
+    SQLite catalog of the acquisitions (tile, date, sequence) in the S2 bucket, the keys under each one, and the
+        date ranges listed so far for each tile. Tiles use the bucket's prefix form (ex. 18/N/WM/) and dates
+        are stored as yyyy-mm-dd text, so they sort and compare as dates.
+    '''
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS acquisitions (
+            tile TEXT NOT NULL,
+            date TEXT NOT NULL,
+            sequence INTEGER NOT NULL,
+            cloud_cover REAL,
+            data_coverage REAL,
+            product_name TEXT,
+            PRIMARY KEY (tile, date, sequence)
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            tile TEXT NOT NULL,
+            date TEXT NOT NULL,
+            sequence INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            PRIMARY KEY (tile, date, sequence, file)
+        );
+        CREATE TABLE IF NOT EXISTS aoi_clouds (
+            tile TEXT NOT NULL,
+            date TEXT NOT NULL,
+            sequence INTEGER NOT NULL,
+            aoi TEXT NOT NULL,
+            cloud_cover REAL,
+            aoi_coverage REAL,
+            source TEXT,
+            PRIMARY KEY (tile, date, sequence, aoi)
+        );
+        CREATE TABLE IF NOT EXISTS synced_ranges (
+            tile TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            synced_at TEXT NOT NULL,
+            PRIMARY KEY (tile, start_date)
+        );
+    """
+
+    def __init__(self, path: str = CATALOG_PATH, bucket: str = S2_BUCKET):
+        self.path = path
+        self.bucket = bucket
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def synced_ranges(self, tile: str):
+        '''
+        Returns the (start, end) date ranges already listed and settled for tile, in order and disjoint
+            (empty if the tile was never synced).
+        '''
+        rows = self.connection.execute(
+            "SELECT start_date, end_date FROM synced_ranges WHERE tile = ? ORDER BY start_date", (tile,))
+        return [(datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)) for start, end in rows]
+
+    def unsynced_ranges(self, tile: str, start_date: datetime.date, end_date: datetime.date):
+        '''
+        Returns the (start, end) date ranges within start_date to end_date that still need listing for tile:
+            every gap between the ranges synced so far (see synced_ranges).
+        '''
+        ranges = []
+        day = start_date
+        for synced_start, synced_end in self.synced_ranges(tile):
+            if synced_start > end_date:
+                break
+            if synced_start > day:
+                ranges.append((day, synced_start - datetime.timedelta(days=1)))
+            day = max(day, synced_end + datetime.timedelta(days=1))
+        if day <= end_date:
+            ranges.append((day, end_date))
+        return ranges
+
+    def mark_synced(self, tile: str, start_date: datetime.date, end_date: datetime.date):
+        '''
+        Records that tile was listed from start_date to end_date, merged with the ranges synced before. Only the
+            days older than REFRESH_OVERLAP_DAYS count as settled (the latest ones may still be ingesting, and days
+            that haven't happened yet can't be settled), so a later refresh lists the rest again.
+        '''
+        settled_end = min(end_date, datetime.date.today() - datetime.timedelta(days=REFRESH_OVERLAP_DAYS))
+        if settled_end < start_date:
+            return
+        merged = []
+        for synced_start, synced_end in sorted(self.synced_ranges(tile) + [(start_date, settled_end)]):
+            if merged and synced_start <= merged[-1][1] + datetime.timedelta(days=1):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], synced_end))
+            else:
+                merged.append((synced_start, synced_end))
+        synced_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.execute("DELETE FROM synced_ranges WHERE tile = ?", (tile,))
+            self.connection.executemany("INSERT INTO synced_ranges VALUES (?, ?, ?, ?)",
+                                        [(tile, start.isoformat(), end.isoformat(), synced_at) for start, end in merged])
+
+    def refresh(self, s3_client, tiles: list, start_date: datetime.date, end_date: datetime.date,
+                threads: int = TILE_INFO_THREADS):
+        '''
+        Brings the catalog up to date for the tiles between start_date and end_date (inclusive), listing only the
+            dates it hasn't seen (see unsynced_ranges), then reads tileInfo.json for the acquisitions in the range
+            that haven't got one read yet, threads at once. Returns the number of new acquisitions.
+        '''
+        start_date, end_date = as_date(start_date), as_date(end_date)
+        added = 0
+        for tile in tiles:
+            for range_start, range_end in self.unsynced_ranges(tile, start_date, end_date):
+                listed = list_available(s3_client, self.bucket, [tile], range_start, range_end)
+                added += self.store(tile, range_start, range_end, listed)
+                self.mark_synced(tile, range_start, range_end)
+        self.read_tile_infos(s3_client, tiles, start_date, end_date, threads)
+        return added
+
+    def store(self, tile: str, start_date: datetime.date, end_date: datetime.date, listed: set):
+        '''
+        Replaces what the catalog holds for tile between start_date and end_date with the listed
+            (tile, date, sequence, file) keys. Returns the number of new acquisitions.
+        '''
+        span = (tile, start_date.isoformat(), end_date.isoformat())
+        known = {(date, sequence) for date, sequence in self.connection.execute(
+            "SELECT date, sequence FROM acquisitions WHERE tile = ? AND date BETWEEN ? AND ?", span)}
+        found = {(date.isoformat(), sequence) for _, date, sequence, _ in listed}
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE tile = ? AND date BETWEEN ? AND ?", span)
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                        [(tile, date.isoformat(), sequence, file) for _, date, sequence, file in listed])
+            for table in ('acquisitions', 'aoi_clouds'):
+                self.connection.executemany(f"DELETE FROM {table} WHERE tile = ? AND date = ? AND sequence = ?",
+                                            [(tile, date, sequence) for date, sequence in known - found])
+            self.connection.executemany("INSERT INTO acquisitions (tile, date, sequence) VALUES (?, ?, ?)",
+                                        [(tile, date, sequence) for date, sequence in found - known])
+        return len(found - known)
+
+    def read_tile_infos(self, s3_client, tiles: list, start_date: datetime.date, end_date: datetime.date,
+                        threads: int = TILE_INFO_THREADS):
+        '''
+        Fills in cloud cover, data coverage and product name from tileInfo.json for the acquisitions of the tiles
+            between start_date and end_date that have a tileInfo.json but nothing read from it yet (new ones, and
+            ones whose read failed before), threads at once.
+        '''
+        query, params = self.filter(tiles, start_date, end_date)
+        missing = self.connection.execute(
+            "SELECT tile, date, sequence FROM acquisitions a JOIN files f USING (tile, date, sequence) "
+            f"WHERE {query} AND f.file = 'tileInfo.json' AND a.cloud_cover IS NULL AND a.product_name IS NULL", params).fetchall()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            infos = list(executor.map(
+                lambda row: read_tile_info(s3_client, self.bucket, row[0], datetime.date.fromisoformat(row[1]), row[2]),
+                missing))
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE acquisitions SET cloud_cover = ?, data_coverage = ?, product_name = ? "
+                "WHERE tile = ? AND date = ? AND sequence = ?",
+                [(*info, *row) for row, info in zip(missing, infos)])
+
+    def acquisitions(self, tiles: list, start_date: datetime.date, end_date: datetime.date, cloud_max: float = None):
+        '''
+        Returns the (tile, date, sequence, cloud_cover, product_name) of every cataloged acquisition of the tiles
+            between start_date and end_date (inclusive), ordered by tile, date then sequence. With cloud_max,
+            acquisitions cloudier than it are left out (ones with unknown cloud cover are kept).
+        '''
+        query, params = self.filter(tiles, start_date, end_date, cloud_max)
+        rows = self.connection.execute(
+            "SELECT tile, date, sequence, cloud_cover, product_name FROM acquisitions "
+            f"WHERE {query} ORDER BY tile, date, sequence", params)
+        return [(tile, datetime.date.fromisoformat(date), sequence, cloud_cover, product_name)
+                for tile, date, sequence, cloud_cover, product_name in rows]
+
+    def available(self, tiles: list, start_date: datetime.date, end_date: datetime.date, files: list = None,
+                  cloud_max: float = None, newest_only: bool = False):
+        '''
+        Returns the same set of (tile, date, sequence, file) tuples as list_available, from the catalog,
+            optionally leaving out acquisitions cloudier than cloud_max. With newest_only, only the sequences
+            picked by newest_sequences are kept, picked among all the acquisitions before cloud_max applies, so a
+            cloudy reprocessing doesn't bring back the older sequence it supersedes.
+        '''
+        query, params = self.filter(tiles, start_date, end_date, cloud_max)
+        rows = self.connection.execute(
+            "SELECT f.tile, f.date, f.sequence, f.file FROM files f JOIN acquisitions a USING (tile, date, sequence) "
+            f"WHERE {query}", params)
+        available = {(tile, datetime.date.fromisoformat(date), sequence, file) for tile, date, sequence, file in rows
+                     if files is None or file in files}
+        if newest_only:
+            kept = newest_sequences((tile, date, sequence, product_name) for tile, date, sequence, _, product_name
+                                    in self.acquisitions(tiles, start_date, end_date))
+            available = {key for key in available if key[:3] in kept}
+        return available
+
+    def aoi_cloud_covers(self, aoi: str, tiles: list, start_date: datetime.date, end_date: datetime.date):
+        '''
+        Returns {(tile, date, sequence): (cloud_cover, aoi_coverage, source)} of the cloud cover over the AOI
+            with id aoi (see s2_clouds) recorded for the tiles between start_date and end_date.
+        '''
+        query, params = self.filter(tiles, start_date, end_date)
+        rows = self.connection.execute(
+            "SELECT tile, date, sequence, cloud_cover, aoi_coverage, source FROM aoi_clouds "
+            f"WHERE aoi = ? AND {query}", [aoi, *params])
+        return {(tile, datetime.date.fromisoformat(date), sequence): (cloud_cover, aoi_coverage, source)
+                for tile, date, sequence, cloud_cover, aoi_coverage, source in rows}
+
+    def record_aoi_cloud_covers(self, aoi: str, covers: dict):
+        '''
+        Stores {(tile, date, sequence): (cloud_cover, aoi_coverage, source)} for the AOI with id aoi.
+        '''
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO aoi_clouds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(tile, date.isoformat(), sequence, aoi, *cover) for (tile, date, sequence), cover in covers.items()])
+
+    @staticmethod
+    def filter(tiles: list, start_date: datetime.date, end_date: datetime.date, cloud_max: float = None):
+        '''
+        Returns the WHERE clause (over the acquisitions columns) and its parameters for the tiles, dates and cloud_max.
+        '''
+        query = f"tile IN ({', '.join('?' * len(tiles))}) AND date BETWEEN ? AND ?"
+        params = [*tiles, as_date(start_date).isoformat(), as_date(end_date).isoformat()]
+        if cloud_max is not None:
+            # unknown cloud cover is kept, like the AOI prefilter does (see download_s2_imgs_s3.passes)
+            query += " AND (cloud_cover <= ? OR cloud_cover IS NULL)"
+            params.append(cloud_max)
+        return query, params
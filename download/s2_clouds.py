@@ -0,0 +1,167 @@
+import re
+import json
+import hashlib
+import functools
+import xml.etree.ElementTree as ET
+
+from pyproj import Transformer
+from shapely.geometry import shape, Polygon
+from shapely.ops import transform, unary_union
+
+'''
+Cloud cover of a Sentinel-2 L2A acquisition over an area of interest (AOI), from the two small files next to its bands:
+    tileInfo.json: tileDataGeometry, the part of the tile with data, and cloudyPixelPercentage for the whole tile
+    qi/MSK_CLOUDS_B00.gml: the OPAQUE and CIRRUS cloud polygons, in the tile's UTM projection
+Products from processing baseline 04.00 on ship the cloud mask as a JP2 raster instead of GML; for those (or whenever
+    the GML can't be read) the tile's cloudyPixelPercentage stands in for the AOI's.
+'''
+
+CLOUD_MASK_FILE = 'qi/MSK_CLOUDS_B00.gml'
+CLOUD_MASK_TYPES = ('OPAQUE', 'CIRRUS')
+WGS84 = 4326
+
+
+def load_aoi(path):
+    '''
+    Reads a geojson file (FeatureCollection, Feature or bare geometry) and returns its geometries
+        merged into one shapely geometry, in lon/lat. Cloud cover is measured over the AOI's area, so
+        it must be made of (Multi)Polygons and not be empty.
+    '''
+    with open(path) as file:
+        geojson = json.load(file)
+    if geojson['type'] == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in geojson['features'] if feature.get('geometry')]
+    elif geojson['type'] == 'Feature':
+        geometries = [geojson['geometry']] if geojson.get('geometry') else []
+    else:
+        geometries = [geojson]
+    shapes = [shape(geometry) for geometry in geometries]
+    other_types = {s.geom_type for s in shapes} - {'Polygon', 'MultiPolygon'}
+    if other_types:
+        raise ValueError(f"{path}: the area of interest must be made of polygons, not {', '.join(sorted(other_types))}")
+    aoi = unary_union(shapes)
+    if aoi.is_empty or aoi.area == 0:
+        raise ValueError(f"{path}: the area of interest is empty")
+    return aoi
+
+
+def aoi_key(aoi):
+    '''
+    Returns a short id for an AOI geometry, used to cache its cloud cover in the catalog.
+    '''
+    return hashlib.sha1(aoi.wkb).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=None)
+def utm_transformer(epsg: int):
+    '''
+    Returns a (cached) lon/lat to epsg transformer.
+    '''
+    return Transformer.from_crs(WGS84, epsg, always_xy=True)
+
+
+def epsg_code(srs_name: str):
+    '''
+    Returns the EPSG code at the end of an srsName/crs name (ex. urn:ogc:def:crs:EPSG::32618), or None.
+    '''
+    m = re.search(r"EPSG:(?:[\d.]*:)?(\d+)$", srs_name or '')
+    return int(m.group(1)) if m else None
+
+
+def local_name(element):
+    '''
+    Returns an XML element's tag without its namespace, so the GML/EOP namespace versions don't matter.
+    '''
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def read_cloud_mask(gml: bytes, mask_types: tuple = CLOUD_MASK_TYPES):
+    '''
+    Parses a MSK_CLOUDS_B00.gml document and returns (epsg, polygons): the EPSG code of its coordinates and a
+        shapely Polygon for every mask feature of the given types. A cloudless mask has no features (and no
+        EPSG code), so it gives (None, []).
+    '''
+    root = ET.fromstring(gml)
+    epsg = None
+    polygons = []
+    for element in root.iter():
+        if epsg is None and 'srsName' in element.attrib:
+            epsg = epsg_code(element.attrib['srsName'])
+        if local_name(element) != 'MaskFeature':
+            continue
+        mask_type = next((e.text for e in element.iter() if local_name(e) == 'maskType'), None)
+        if mask_type not in mask_types:
+            continue
+        for polygon in (e for e in element.iter() if local_name(e) == 'Polygon'):
+            # the exterior ring comes first, then any interior rings
+            rings = []
+            for pos_list in (e for e in polygon.iter() if local_name(e) == 'posList'):
+                dimension = int(pos_list.attrib.get('srsDimension', 2))
+                values = [float(v) for v in pos_list.text.split()]
+                rings.append([values[i:i + 2] for i in range(0, len(values), dimension)])
+            if rings:
+                polygons.append(Polygon(rings[0], rings[1:]))
+    return epsg, polygons
+
+
+def data_footprint(tile_info: dict):
+    '''
+    Returns (epsg, geometry) of the part of the tile with data from a parsed tileInfo.json, or (None, None).
+    '''
+    geometry = tile_info.get('tileDataGeometry') or tile_info.get('tileGeometry')
+    if not geometry:
+        return None, None
+    epsg = epsg_code(geometry.get('crs', {}).get('properties', {}).get('name'))
+    return epsg, shape(geometry)
+
+
+def read_scene_cloud_cover(s3_client, bucket: str, scene: tuple, aoi):
+    '''
+    Reads tileInfo.json and the GML cloud mask of scene (tile, date, sequence) from bucket and returns
+        aoi_cloud_cover for it. Assumes request payer.
+    '''
+    tile, date, sequence = scene
+    prefix = f"tiles/{tile}{date.year}/{date.month}/{date.day}/{sequence}/"
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=prefix + 'tileInfo.json', RequestPayer='requester')
+        tile_info = json.loads(obj['Body'].read())
+    except Exception as e:
+        print(f"Could not read s3://{bucket}/{prefix}tileInfo.json: {e}")
+        tile_info = {}
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=prefix + CLOUD_MASK_FILE, RequestPayer='requester')
+        gml = obj['Body'].read()
+        return aoi_cloud_cover(aoi, tile_info, gml)
+    except Exception:
+        # no GML mask (processing baseline 04.00 on) or an unreadable one
+        return aoi_cloud_cover(aoi, tile_info)
+
+
+def aoi_cloud_cover(aoi, tile_info: dict, gml: bytes = None):
+    '''
+    Returns (cloud_cover, aoi_coverage, source) for an acquisition over aoi (lon/lat):
+        cloud_cover: percent of the observed part of the AOI under cloud
+        aoi_coverage: percent of the AOI inside the tile's data footprint (0 means the acquisition doesn't see it),
+            None when it can't be told (no footprint projection, or an AOI without area)
+        source: 'mask' when cloud_cover comes from the GML cloud mask, 'tile' when it is the tile's
+            cloudyPixelPercentage (no GML), None when neither is known
+    '''
+    epsg, footprint = data_footprint(tile_info)
+    mask_epsg, clouds = read_cloud_mask(gml) if gml is not None else (None, [])
+    epsg = epsg or mask_epsg
+    if epsg is None:
+        if gml is not None and not clouds:
+            return 0.0, None, 'mask'
+        return tile_info.get('cloudyPixelPercentage'), None, 'tile' if 'cloudyPixelPercentage' in tile_info else None
+
+    aoi_utm = transform(utm_transformer(epsg).transform, aoi)
+    observed = aoi_utm.intersection(footprint) if footprint is not None else aoi_utm
+    coverage = 100 * observed.area / aoi_utm.area if aoi_utm.area else None
+    if gml is None:
+        return tile_info.get('cloudyPixelPercentage'), coverage, 'tile' if 'cloudyPixelPercentage' in tile_info else None
+    if observed.is_empty or not clouds:
+        return 0.0, coverage, 'mask'
+    if observed.area == 0:  # a point or line AOI has no area to measure the clouds over
+        return tile_info.get('cloudyPixelPercentage'), coverage, 'tile' if 'cloudyPixelPercentage' in tile_info else None
+    cloud = unary_union([c if c.is_valid else c.buffer(0) for c in clouds])
+    return 100 * observed.intersection(cloud).area / observed.area, coverage, 'mask'
@@ -0,0 +1,356 @@
+import argparse
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import kml
+from geometry_array import GeometryArray
+
+
+TRACKS_GEOJSON = "geojson/Tracks_Productores_San_Pablo_de_borbur-Colombia.geojson"
+
+
+def load_track_coordinates(geojson_path=TRACKS_GEOJSON):
+    '''
+    Reads the tracks geojson and returns the 2D coordinate list of every LineString
+    with more than one point (the same lots turn_lots_into_polygons works on)
+    '''
+    with open(geojson_path, 'r') as json_file:
+        gj = json.loads(json_file.read())
+    _, feature_collection = kml.geojson_feature_parser(gj)
+    coordinate_lists = []
+    for feature in feature_collection["features"]:
+        coordinates = kml.get_feature_coordinates(feature)
+        if coordinates is not None:
+            coordinate_lists.append(coordinates)
+    return coordinate_lists
+
+
+def timed(func, *args, repeat=1):
+    ''' Returns the result of func(*args) and the best wall time over repeat runs '''
+    best = None
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def benchmark_lot_merging(args):
+    ''' Compares the grid-indexed lot merge against the original nested loop '''
+    coordinate_lists = load_track_coordinates(args.geojson)
+    if args.lots:
+        coordinate_lists = coordinate_lists[:args.lots]
+    num_points = sum(len(coords) for coords in coordinate_lists)
+    print(f"{len(coordinate_lists)} lots, {num_points} points, tolerance {args.tolerance} m")
+
+    grid_groups, grid_time = timed(kml.find_connected_lots, coordinate_lists, args.tolerance, repeat=args.repeat)
+    print(f"grid:   {grid_time:.4f} s -> {len(grid_groups)} polygons")
+    if args.skip_nested:
+        return
+    nested_groups, nested_time = timed(kml.find_connected_lots_nested, coordinate_lists, args.tolerance)
+    print(f"nested: {nested_time:.4f} s -> {len(nested_groups)} polygons")
+    print(f"speedup: {nested_time / grid_time:.1f}x")
+
+
+def benchmark_haversine(args):
+    ''' Compares the per-pair Haversine class against the vectorized haversine kernel '''
+    points = np.array([c for coords in load_track_coordinates(args.geojson) for c in coords])
+    coords1 = points[:args.n] if args.n else points
+    coords2 = points[:args.m] if args.m else points
+    print(f"{len(coords1)} x {len(coords2)} distances")
+
+    def class_distances():
+        return [[kml.Haversine(c1, c2).meters for c2 in coords2.tolist()] for c1 in coords1.tolist()]
+
+    class_result, class_time = timed(class_distances)
+    print(f"Haversine class:      {class_time:.4f} s")
+    vector_result, vector_time = timed(kml.haversine_distances, coords1, coords2, args.chunk_size, repeat=args.repeat)
+    print(f"haversine_distances:  {vector_time:.4f} s (max difference {np.abs(vector_result - class_result).max():.2e} m)")
+    _, mask_time = timed(kml.within_tolerance_mask, args.tolerance, coords1, coords2, args.chunk_size, repeat=args.repeat)
+    print(f"within_tolerance_mask: {mask_time:.4f} s")
+    print(f"speedup: {class_time / vector_time:.1f}x (distances), {class_time / mask_time:.1f}x (mask)")
+
+
+def remove_duplicate_coordinates_reference(coords):
+    '''
+    The original O(N^2) (O(N^3) with the skip_list lookups) remove_duplicate_coordinates,
+    kept to check the grid-based version produces exactly the same output
+    '''
+    tolerance = 0.0000001
+    if len(coords) < 2:
+        return coords
+    new_coords = []
+    skip_list = []
+    for i, c1 in enumerate(coords):
+        if i in skip_list:
+            continue
+        skip_list.append(i)
+        new_coords.append(c1)
+        for j, c2 in enumerate(coords):
+            if j in skip_list:
+                continue
+            if math.isclose(c1[0], c2[0], rel_tol=tolerance) and math.isclose(c1[1], c2[1], rel_tol=tolerance):
+                skip_list.append(j)
+    new_coords.append(new_coords[0])
+    return new_coords
+
+
+def benchmark_deduplication(args):
+    '''
+    Checks remove_duplicate_coordinates against the original implementation on the rings
+    built from the tracks data, then times it on a large synthetic ring
+    '''
+    coordinate_lists = load_track_coordinates(args.geojson)
+    rings = []
+    for group in kml.find_connected_lots(coordinate_lists, args.tolerance):
+        rings.append([c for i in group for c in coordinate_lists[i]])
+    # every track point at once, and again with every point repeated (with some float noise)
+    all_points = [c for coords in coordinate_lists for c in coords]
+    rings.append(all_points)
+    rings.append(all_points + [[c[0] * (1 + 1e-9), c[1] * (1 - 1e-9)] for c in reversed(all_points)])
+
+    reference_time = new_time = 0.0
+    for ring in rings:
+        expected, elapsed = timed(remove_duplicate_coordinates_reference, ring)
+        reference_time += elapsed
+        result, elapsed = timed(kml.remove_duplicate_coordinates, ring)
+        new_time += elapsed
+        if result != expected:
+            raise Exception(f"remove_duplicate_coordinates differs from the reference on a ring of {len(ring)} points")
+    print(f"{len(rings)} track rings match the reference implementation")
+    print(f"reference: {reference_time:.4f} s, grid: {new_time:.4f} s")
+
+    # a long ring walking around a lot with every vertex visited twice
+    random = np.random.default_rng(0)
+    angles = np.sort(random.uniform(0, 2 * np.pi, args.vertices // 2))
+    ring = np.column_stack([-74.15 + 0.1 * np.cos(angles), 5.65 + 0.1 * np.sin(angles)]).tolist()
+    ring = ring + ring
+    result, elapsed = timed(kml.remove_duplicate_coordinates, ring, repeat=args.repeat)
+    print(f"{len(ring)} vertex ring -> {len(result) - 1} unique in {elapsed:.4f} s")
+
+
+def benchmark_geometry_memory(args):
+    ''' Compares the memory used by the tracks as nested python lists vs a GeometryArray '''
+    with open(args.geojson, 'r') as json_file:
+        gj = json.loads(json_file.read())
+
+    tracemalloc.start()
+    _, feature_collection = kml.geojson_feature_parser(gj)
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    geometries = GeometryArray.from_geojson(feature_collection)
+    array_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    num_vertices = len(geometries.coordinates)
+    print(f"{len(geometries)} geometries, {num_vertices} vertices")
+    # the property dicts are shared by both, so neither count includes them
+    print(f"nested lists:  {list_bytes / 1024:.0f} KB ({list_bytes / num_vertices:.0f} bytes/vertex)")
+    print(f"GeometryArray: {array_bytes / 1024:.0f} KB ({array_bytes / num_vertices:.0f} bytes/vertex), "
+          f"{geometries.nbytes / 1024:.0f} KB of it in the coordinate/offset buffers")
+
+
+class FakeTask:
+    ''' Stand-in for an ee.batch.Task that finishes after a number of status checks '''
+    def __init__(self, task_id, description, polls):
+        self.id = task_id
+        self.description = description
+        self.polls = polls
+
+
+class FakeEarthEngineClient:
+    '''
+    Stand-in for kml.EarthEngineClient that keeps its tasks in memory: every task is RUNNING
+    for polls status checks, then COMPLETED. Records the most tasks ever unfinished at once,
+    fails to start the exports whose description is in fail and can never check the status
+    of the exports whose description is in lost
+    '''
+    def __init__(self, polls=2, fail=(), lost=()):
+        self.polls = polls
+        self.fail = set(fail)
+        self.lost = set(lost)
+        self.status_checks = {}     # description -> number of task_status calls
+        self.lock = threading.Lock()
+        self.started = {}       # asset_id -> number of features
+        self.unfinished = 0
+        self.peak_unfinished = 0
+
+    def export_table_to_asset(self, feature_obj, description, asset_id):
+        if description in self.fail:
+            raise Exception("fake submit failure")
+        with self.lock:
+            self.started[asset_id] = len(feature_obj["features"])
+            self.unfinished += 1
+            self.peak_unfinished = max(self.peak_unfinished, self.unfinished)
+            return FakeTask(f"task_{len(self.started)}", description, self.polls)
+
+    def task_status(self, task):
+        with self.lock:
+            self.status_checks[task.description] = self.status_checks.get(task.description, 0) + 1
+        if task.description in self.lost:
+            raise Exception("fake status failure")
+        if task.polls == 0:
+            return {"state": "COMPLETED"}
+        task.polls -= 1
+        if task.polls == 0:
+            with self.lock:
+                self.unfinished -= 1
+        return {"state": "RUNNING"}
+
+
+def benchmark_export(args):
+    '''
+    Runs BatchExporter against a fake Earth Engine client on the tracks features, with and
+    without waiting, and checks the sharding, max_in_flight and the manifest. Then checks that
+    run(wait=True) gives up on a task whose status checks keep failing instead of polling forever
+    '''
+    with open(args.geojson, 'r') as json_file:
+        gj = json.loads(json_file.read())
+    _, feature_collection = kml.geojson_feature_parser(gj)
+    features = feature_collection["features"]
+    name = kml.asset_name(args.geojson)
+    num_shards = math.ceil(len(features) / args.shard_size)
+    expected = {f"users/{kml.username}/{name}_{i}": len(features[i * args.shard_size:(i + 1) * args.shard_size])
+                for i in range(num_shards)}
+    failed = f"users/{kml.username}/{name}_{num_shards - 1}"
+    print(f"{len(features)} features in shards of {args.shard_size} -> {num_shards} assets, "
+          f"max {args.max_in_flight} in flight")
+
+    for wait in (True, False):
+        client = FakeEarthEngineClient(polls=args.polls, fail=[failed.split("/")[-1]])
+        with tempfile.TemporaryDirectory() as directory:
+            manifest_path = os.path.join(directory, kml.EXPORT_MANIFEST)
+            exporter = kml.BatchExporter(client=client, max_in_flight=args.max_in_flight, threads=args.threads,
+                                         shard_size=args.shard_size, manifest_path=manifest_path, sleep=lambda s: None)
+            exporter.add(feature_collection, args.geojson)
+            t1 = time.perf_counter()
+            manifest = json.loads(json.dumps(exporter.run(wait=wait)))
+            elapsed = time.perf_counter() - t1
+            with open(manifest_path, 'r') as manifest_file:
+                written = json.loads(manifest_file.read())
+            # a second run with tasks still in flight must poll for room instead of spinning
+            exporter.add(feature_collection, "rerun")
+            exporter.run(wait=True)
+        states = {}
+        for entry in manifest.values():
+            states[entry["state"]] = states.get(entry["state"], 0) + 1
+        print(f"wait={wait}: {elapsed:.4f} s, peak {client.peak_unfinished} unfinished, manifest states {states}")
+
+        if set(manifest) != set(expected) or written != manifest:
+            raise Exception("the manifest doesn't list every shard")
+        if any(manifest[asset_id]["features"] != count for asset_id, count in expected.items()):
+            raise Exception("shards don't hold the expected number of features")
+        if {asset_id: count for asset_id, count in client.started.items() if name in asset_id} != \
+                {asset_id: count for asset_id, count in expected.items() if asset_id != failed}:
+            raise Exception("the client didn't start every shard once")
+        if client.peak_unfinished > args.max_in_flight:
+            raise Exception(f"{client.peak_unfinished} tasks were unfinished at once")
+        if manifest[failed]["state"] != "SUBMIT_FAILED":
+            raise Exception("a failed submit isn't recorded in the manifest")
+        done = [entry["state"] for asset_id, entry in manifest.items() if asset_id != failed]
+        if wait and any(state != "COMPLETED" for state in done):
+            raise Exception("run(wait=True) returned before every task was done")
+        if not wait and not all(state in ("SUBMITTED", "RUNNING", "COMPLETED") for state in done):
+            raise Exception("run(wait=False) left exports unsubmitted")
+
+    lost = f"users/{kml.username}/{name}_0"
+    client = FakeEarthEngineClient(polls=args.polls, lost=[lost.split("/")[-1]])
+    with tempfile.TemporaryDirectory() as directory:
+        exporter = kml.BatchExporter(client=client, max_in_flight=args.max_in_flight, threads=args.threads,
+                                     shard_size=args.shard_size,
+                                     manifest_path=os.path.join(directory, kml.EXPORT_MANIFEST),
+                                     max_status_failures=args.status_failures, sleep=lambda s: None)
+        exporter.add(feature_collection, args.geojson)
+        manifest = exporter.run(wait=True)
+    checks = client.status_checks[lost.split("/")[-1]]
+    print(f"lost task: {manifest[lost]['state']} after {checks} status checks")
+
+    if manifest[lost]["state"] != "FAILED" or not manifest[lost].get("error_message"):
+        raise Exception("a task whose status can't be checked isn't marked FAILED")
+    if checks != args.status_failures:
+        raise Exception(f"the lost task's status was checked {checks} times, not {args.status_failures}")
+    if any(entry["state"] != "COMPLETED" for asset_id, entry in manifest.items() if asset_id != lost):
+        raise Exception("giving up on the lost task held back the other exports")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the polygon processing steps in kml.py on the local geojson data.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="lot merging: grid index vs nested loop")
+    merge_parser.add_argument("-geojson", type=str, default=TRACKS_GEOJSON,
+                              help="path to the tracks geojson file")
+    merge_parser.add_argument("-lots", type=int, default=None,
+                              help="only use the first n lots")
+    merge_parser.add_argument("-tolerance", type=float, default=21.0,
+                              help="merge tolerance in meters")
+    merge_parser.add_argument("-repeat", type=int, default=3,
+                              help="number of runs of the grid merge to take the best time from")
+    merge_parser.add_argument("-skip-nested", dest="skip_nested", action="store_true",
+                              help="don't run the (slow) nested loop")
+    merge_parser.set_defaults(func=benchmark_lot_merging)
+
+    haversine_parser = subparsers.add_parser("haversine", help="Haversine class vs vectorized kernel")
+    haversine_parser.add_argument("-geojson", type=str, default=TRACKS_GEOJSON,
+                                  help="path to the tracks geojson file (source of the points)")
+    haversine_parser.add_argument("-n", type=int, default=None,
+                                  help="number of points on the first side (default all)")
+    haversine_parser.add_argument("-m", type=int, default=None,
+                                  help="number of points on the second side (default all)")
+    haversine_parser.add_argument("-tolerance", type=float, default=21.0,
+                                  help="tolerance in meters for the mask")
+    haversine_parser.add_argument("-chunk-size", dest="chunk_size", type=int, default=kml.DISTANCE_CHUNK_SIZE,
+                                  help="max number of distances computed at once")
+    haversine_parser.add_argument("-repeat", type=int, default=3,
+                                  help="number of runs of the kernel to take the best time from")
+    haversine_parser.set_defaults(func=benchmark_haversine)
+
+    dedup_parser = subparsers.add_parser("dedup", help="coordinate deduplication: regression check and timing")
+    dedup_parser.add_argument("-geojson", type=str, default=TRACKS_GEOJSON,
+                              help="path to the tracks geojson file")
+    dedup_parser.add_argument("-tolerance", type=float, default=21.0,
+                              help="merge tolerance in meters used to build the rings")
+    dedup_parser.add_argument("-vertices", type=int, default=100000,
+                              help="number of vertices in the synthetic ring")
+    dedup_parser.add_argument("-repeat", type=int, default=3,
+                              help="number of runs on the synthetic ring to take the best time from")
+    dedup_parser.set_defaults(func=benchmark_deduplication)
+
+    memory_parser = subparsers.add_parser("memory", help="nested lists vs GeometryArray memory use")
+    memory_parser.add_argument("-geojson", type=str, default=TRACKS_GEOJSON,
+                               help="path to the tracks geojson file")
+    memory_parser.set_defaults(func=benchmark_geometry_memory)
+
+    export_parser = subparsers.add_parser("export", help="BatchExporter against a fake Earth Engine client")
+    export_parser.add_argument("-geojson", type=str, default=TRACKS_GEOJSON,
+                               help="path to the tracks geojson file")
+    export_parser.add_argument("-shard-size", dest="shard_size", type=int, default=300,
+                               help="max number of features per asset")
+    export_parser.add_argument("-max-in-flight", dest="max_in_flight", type=int, default=3,
+                               help="max number of export tasks unfinished at once")
+    export_parser.add_argument("-threads", type=int, default=4,
+                               help="number of threads submitting the exports")
+    export_parser.add_argument("-polls", type=int, default=2,
+                               help="number of status checks a fake task runs for")
+    export_parser.add_argument("-status-failures", dest="status_failures", type=int, default=3,
+                               help="status checks in a row that can fail before a task is marked FAILED")
+    export_parser.set_defaults(func=benchmark_export)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
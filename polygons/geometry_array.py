@@ -0,0 +1,158 @@
+import json
+
+import numpy as np
+
+
+class GeometryArray:
+    '''
+    Array-backed collection of geojson geometries, laid out like GeoArrow:
+        coordinates: N x 2 float64 array holding every vertex of every geometry
+        ring_offsets: ring i is coordinates[ring_offsets[i]:ring_offsets[i + 1]]
+        geometry_offsets: geometry j is made of rings geometry_offsets[j] to geometry_offsets[j + 1]
+        geometry_types: geojson geometry type of each geometry
+        properties: property dict of each geometry
+    Points are stored as a ring of one coordinate, LineStrings and LinearRings as one ring,
+        and Polygons as their outer ring followed by their inner rings.
+    Rings, geometries and slices are numpy views of the same coordinate buffer, so
+        nothing gets copied until the geometries are turned back into geojson.
+    '''
+    SINGLE_RING_TYPES = ("Point", "LineString", "LinearRing")
+
+    def __init__(self, coordinates, ring_offsets, geometry_offsets, geometry_types, properties):
+        self.coordinates = coordinates
+        self.ring_offsets = ring_offsets
+        self.geometry_offsets = geometry_offsets
+        self.geometry_types = list(geometry_types)
+        self.properties = list(properties)
+
+    def __len__(self):
+        return len(self.geometry_types)
+
+    @property
+    def nbytes(self):
+        ''' Size of the coordinate and offset buffers in bytes '''
+        return self.coordinates.nbytes + self.ring_offsets.nbytes + self.geometry_offsets.nbytes
+
+    def ring(self, i):
+        ''' Returns ring i as an M x 2 view into the coordinate buffer '''
+        return self.coordinates[self.ring_offsets[i]:self.ring_offsets[i + 1]]
+
+    def rings(self, j):
+        ''' Returns the rings of geometry j as a list of views '''
+        return [self.ring(i) for i in range(self.geometry_offsets[j], self.geometry_offsets[j + 1])]
+
+    def vertices(self, j):
+        ''' Returns every vertex of geometry j (all rings back to back) as one view '''
+        start = self.ring_offsets[self.geometry_offsets[j]]
+        end = self.ring_offsets[self.geometry_offsets[j + 1]]
+        return self.coordinates[start:end]
+
+    def __getitem__(self, key):
+        '''
+        An int returns that geometry as a geojson feature dict
+        A slice (step 1) returns a GeometryArray sharing this one's coordinate buffer
+        '''
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.take(range(start, stop, step))
+            stop = max(start, stop)
+            ring_start, ring_stop = self.geometry_offsets[start], self.geometry_offsets[stop]
+            coord_start, coord_stop = self.ring_offsets[ring_start], self.ring_offsets[ring_stop]
+            return GeometryArray(self.coordinates[coord_start:coord_stop],
+                                 self.ring_offsets[ring_start:ring_stop + 1] - coord_start,
+                                 self.geometry_offsets[start:stop + 1] - ring_start,
+                                 self.geometry_types[start:stop],
+                                 self.properties[start:stop])
+        if key < 0:
+            key += len(self)
+        return {"type": "Feature", "properties": self.properties[key], "geometry": self.geometry(key)}
+
+    def take(self, indices):
+        ''' Returns a new GeometryArray with only the geometries at indices (copies their coordinates) '''
+        return GeometryArray.from_records((self.geometry_types[j], self.rings(j), self.properties[j]) for j in indices)
+
+    def geometry(self, j):
+        ''' Returns geometry j as a geojson geometry dict '''
+        geometry_type = self.geometry_types[j]
+        rings = [ring.tolist() for ring in self.rings(j)]
+        if geometry_type == "Point":
+            coordinates = rings[0][0] if rings[0] else []
+        elif geometry_type == "Polygon":
+            coordinates = rings
+        else:
+            coordinates = rings[0]
+        return {"type": geometry_type, "coordinates": coordinates}
+
+    def to_geojson(self, indices=None):
+        ''' Returns the geometries (only the ones at indices, if given) as a geojson FeatureCollection dict '''
+        indices = range(len(self)) if indices is None else indices
+        return {"type": "FeatureCollection", "features": [self[j] for j in indices]}
+
+    @classmethod
+    def from_records(cls, records):
+        '''
+        Takes in (geometry_type, rings, properties) tuples, where rings is a list of
+            coordinate lists or arrays (altitude values are dropped)
+        '''
+        ring_arrays = []
+        ring_offsets = [0]
+        geometry_offsets = [0]
+        geometry_types = []
+        properties = []
+        for geometry_type, rings, geometry_properties in records:
+            for ring in rings:
+                ring_array = np.asarray(ring, dtype=np.float64)
+                ring_array = ring_array.reshape(len(ring_array), -1)[:, :2] if len(ring_array) else ring_array.reshape(0, 2)
+                ring_arrays.append(ring_array)
+                ring_offsets.append(ring_offsets[-1] + len(ring_array))
+            geometry_offsets.append(len(ring_offsets) - 1)
+            geometry_types.append(geometry_type)
+            properties.append(geometry_properties)
+        coordinates = np.concatenate(ring_arrays) if ring_arrays else np.empty((0, 2))
+        return cls(np.ascontiguousarray(coordinates),
+                   np.array(ring_offsets, dtype=np.int64),
+                   np.array(geometry_offsets, dtype=np.int64),
+                   geometry_types, properties)
+
+    @classmethod
+    def from_placemarks(cls, placemarks):
+        ''' Takes in Placemark records (see kml.read_kmz_placemarks) '''
+        return cls.from_records((placemark.geometry_type, geometry_rings(placemark.geometry_type, placemark.coordinates),
+                                 placemark.properties) for placemark in placemarks)
+
+    @classmethod
+    def from_geojson(cls, gj):
+        ''' Takes in a geojson FeatureCollection dict '''
+        return cls.from_records((feature["geometry"]["type"],
+                                 geometry_rings(feature["geometry"]["type"], feature["geometry"]["coordinates"]),
+                                 feature["properties"]) for feature in gj["features"])
+
+    def save(self, path, **extra):
+        ''' Writes the buffers (and any extra arrays) to a compressed npz file (path or open binary file) '''
+        np.savez_compressed(path,
+                            coordinates=self.coordinates,
+                            ring_offsets=self.ring_offsets,
+                            geometry_offsets=self.geometry_offsets,
+                            geometry_types=np.array(self.geometry_types, dtype=str),
+                            properties=np.array(json.dumps(self.properties)),
+                            **extra)
+
+    @classmethod
+    def load(cls, npz):
+        ''' Reads a GeometryArray back from an open npz file (np.load) written by save '''
+        return cls(npz["coordinates"], npz["ring_offsets"], npz["geometry_offsets"],
+                   npz["geometry_types"].tolist(), json.loads(str(npz["properties"])))
+
+
+def geometry_rings(geometry_type, coordinates):
+    ''' Splits geojson coordinates into the list of rings GeometryArray stores '''
+    if geometry_type == "Point":
+        return [[coordinates]] if len(coordinates) else [[]]
+    elif geometry_type in GeometryArray.SINGLE_RING_TYPES:
+        return [coordinates]
+    elif geometry_type == "Polygon":
+        return coordinates
+    else:
+        raise Exception("GeometryArray: unhandled geometry type: " + geometry_type)
+
@@ -1,17 +1,47 @@
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import xml.etree.ElementTree as ET
 import os
 import glob
+import argparse
 import kml2geojson
 import ee
 import json
+import hashlib
+import zlib
 import time
 import math
-import copy
+
+import numpy as np
+
+from geometry_array import GeometryArray
 
 
 datasets = ["LANDSAT/LC08/C01/T1"]
 username = "bmiche01"
 
+KML_NAMESPACE = "{http://www.opengis.net/kml/2.2}"
+KML_GEOMETRY_TYPES = ("Point", "LineString", "LinearRing", "Polygon")
+# lightweight record for a kml placemark. coordinates follow geojson nesting for the
+# geometry type and are already 2D ([long, lat], see remove_altitude)
+Placemark = namedtuple("Placemark", ["geometry_type", "coordinates", "properties"])
+
+LOT_BUFFER = 10  # buffer to expand lot polygons by (in meters)
+LOT_HULLS = ("convex", "concave", "raw")
+
+KMZ_CACHE_DIR = "cache"
+# bump when the placemark parsing changes so cached conversions get regenerated
+KMZ_CACHE_VERSION = 1
+
+EXPORT_MANIFEST = "export_manifest.json"
+EXPORT_MAX_IN_FLIGHT = 4        # max number of export tasks running in Earth Engine at once
+EXPORT_POLL_INTERVAL = 5        # seconds between task status checks, doubles while nothing changes
+EXPORT_MAX_POLL_INTERVAL = 120
+EXPORT_DONE_STATES = ("COMPLETED", "FAILED", "CANCELLED", "SUBMIT_FAILED")
+EXPORT_MAX_STATUS_FAILURES = 5  # status checks in a row that may fail before a task is given up on
+
+
 def kmz_to_geojson(kmz_file_paths):
     '''
     Takes in the kmz file paths, unzips them to kml files, 
@@ -21,8 +51,7 @@ def kmz_to_geojson(kmz_file_paths):
     geojson_paths = []
     for path in kmz_file_paths:
         kmz = ZipFile(path, "r")
-        # takes the last part of path without the .kmz. Replaced spaces with unscores if necessary
-        filename = os.path.split(path)[-1][:-4].replace(" ", "_")   
+        filename = kml_name(path)
         new_file_path = ""
         for i, name in enumerate(kmz.namelist()):
             if i > 0:
@@ -38,52 +67,244 @@ def kmz_to_geojson(kmz_file_paths):
     return geojson_paths
 
 
-def geojson_to_earth_engine(geojson_file_paths):
+def kml_name(path):
+    ''' Takes the last part of path without the extension. Replaces spaces with underscores if necessary '''
+    return os.path.splitext(os.path.split(path)[-1])[0].replace(" ", "_")
+
+
+def read_kmz_placemarks(kmz_path):
+    '''
+    Streams the Placemarks out of every kml file inside a kmz, without extracting
+        the kml to disk or reading the whole thing into memory
+    Yields Placemark records (see iter_kml_placemarks)
+    '''
+    with ZipFile(kmz_path, "r") as kmz:
+        for name in kmz.namelist():
+            if not name.lower().endswith(".kml"):   # kmz files can also hold images, etc.
+                continue
+            with kmz.open(name, "r") as kml_file:
+                yield from iter_kml_placemarks(kml_file)
+
+
+def iter_kml_placemarks(kml_file):
+    '''
+    Takes in a kml file object (or path) and incrementally parses it with iterparse
+    Yields a Placemark record per geometry (a MultiGeometry yields one per part)
+        with the name, description and styleUrl as properties, like kml2geojson.
+    Each Placemark element is dropped from the tree once it's parsed, so memory use
+        doesn't grow with the size of the file.
+    '''
+    parents = []
+    for event, elem in ET.iterparse(kml_file, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag != KML_NAMESPACE + "Placemark":
+            continue
+        properties = {}
+        for key in ("name", "description", "styleUrl"):
+            value = elem.findtext(KML_NAMESPACE + key)
+            if value is not None:
+                properties[key] = value
+        polygon_rings = set(elem.iter(KML_NAMESPACE + "innerBoundaryIs")) | set(elem.iter(KML_NAMESPACE + "outerBoundaryIs"))
+        polygon_rings = {ring for boundary in polygon_rings for ring in boundary}
+        for geometry_type in KML_GEOMETRY_TYPES:
+            for geometry in elem.iter(KML_NAMESPACE + geometry_type):
+                if geometry in polygon_rings:
+                    continue    # part of a Polygon, handled there
+                yield Placemark(geometry_type, parse_kml_geometry(geometry_type, geometry), properties)
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def parse_kml_geometry(geometry_type, geometry):
+    '''
+    Turns a kml geometry element into geojson style coordinates:
+        Point: [long, lat]
+        LineString, LinearRing: [[long1, lat1], ...]
+        Polygon: [outer ring, inner ring 1, ...]
+    '''
+    if geometry_type == "Polygon":
+        rings = []
+        for boundary in ("outerBoundaryIs", "innerBoundaryIs"):
+            for ring in geometry.iterfind(f"{KML_NAMESPACE}{boundary}/{KML_NAMESPACE}LinearRing"):
+                rings.append(parse_kml_coordinates(ring.findtext(KML_NAMESPACE + "coordinates", "")))
+        return rings
+    coordinates = parse_kml_coordinates(geometry.findtext(KML_NAMESPACE + "coordinates", ""))
+    if geometry_type == "Point":
+        return coordinates[0] if coordinates else []
+    return coordinates
+
+
+def parse_kml_coordinates(text):
+    ''' Parses a kml "long,lat[,alt] long,lat[,alt] ..." string into 2D coordinates '''
+    if not text.strip():
+        return []
+    return remove_altitude([[float(value) for value in coordinate.split(",")] for coordinate in text.split()])
+
+
+def kmz_cache_key(kmz_path):
+    ''' Returns a sha256 hex digest of the kmz file contents and the converter version '''
+    digest = hashlib.sha256(f"kmz-cache-v{KMZ_CACHE_VERSION}".encode())
+    with open(kmz_path, 'rb') as kmz_file:
+        for chunk in iter(lambda: kmz_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_kmz_geometries(kmz_path, use_cache=True, cache_dir=KMZ_CACHE_DIR):
+    '''
+    Reads the placemarks of a kmz into a GeometryArray
+    With use_cache, the parsed geometries are kept in cache_dir keyed on the kmz
+        contents (see kmz_cache_key), so unchanged kmz files are only ever parsed once
+    A cache file that can't be read (e.g. cut short) counts as a miss and is written again
+    '''
+    if not use_cache:
+        return GeometryArray.from_placemarks(read_kmz_placemarks(kmz_path))
+    key = kmz_cache_key(kmz_path)
+    cache_path = os.path.join(cache_dir, kml_name(kmz_path) + ".npz")
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if str(cache["key"]) == key:
+                    geometries = GeometryArray.load(cache)
+                    print(f"Using cached placemarks for {kmz_path}")
+                    return geometries
+        except (BadZipFile, zlib.error, KeyError, ValueError, OSError, EOFError) as e:
+            print(f"Ignoring unreadable cache {cache_path}: {e}")
+    geometries = GeometryArray.from_placemarks(read_kmz_placemarks(kmz_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    # written next to the cache and moved into place, so an interrupted write never leaves half a cache
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as cache_file:
+        geometries.save(cache_file, key=np.array(key))
+    os.replace(temp_path, cache_path)
+    print("Cached " + cache_path)
+    return geometries
+
+
+def kmz_to_local_features(kmz_file_paths, use_cache=True, workers=1, hull="convex", buffer=LOT_BUFFER):
+    '''
+    Takes in the kmz file paths and streams each one straight into the local pipeline,
+        skipping the kml/ and geojson/ intermediate files
+    With use_cache, the parsed placemarks are reused from KMZ_CACHE_DIR when the kmz hasn't changed
+    With workers > 1, files are parsed and merged in that many processes
+    hull and buffer are passed on to turn_lots_into_polygons for the tracks file
+    Returns a list of (name, feature_obj) tuples like geojson_to_local_features,
+        in the same order as kmz_file_paths
+    '''
+    if workers > 1 and len(kmz_file_paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map keeps the input order regardless of which file finishes first
+            num_files = len(kmz_file_paths)
+            results = list(executor.map(kmz_file_to_local_features, kmz_file_paths,
+                                        [use_cache] * num_files, [hull] * num_files, [buffer] * num_files))
+    else:
+        results = [kmz_file_to_local_features(path, use_cache, hull, buffer) for path in kmz_file_paths]
+    return [(name, feature_obj) for name, feature_obj in results if feature_obj is not None]
+
+
+def kmz_file_to_local_features(kmz_path, use_cache=True, hull="convex", buffer=LOT_BUFFER):
+    '''
+    Runs the local pipeline on one kmz file (see kmz_to_local_features)
+    Returns (name, feature_obj), feature_obj is None if the file has no valid features
+    '''
+    name = kml_name(kmz_path)
+    return name, parse_local_geometries(read_kmz_geometries(kmz_path, use_cache), name, hull, buffer)
+
+
+def geojson_to_local_features(geojson_file_paths):
     '''
     Takes in list file paths for geojson files
-    Returns a list of earth engine objects, where each element of the list
-        represents the feature or collection of features for each geojson file
+    Returns a list of (geojson_path, feature_obj) tuples, where feature_obj is the
+        parsed FeatureCollection or Feature for that file as a plain geojson dict
+        (altitude stripped, lots already turned into polygons for the tracks file).
+    Nothing here talks to Earth Engine, so it can run offline.
     '''
-    ee_objects = []
+    local_objects = []
     for geojson_path in geojson_file_paths:
         with open(geojson_path, 'r') as json_file:
             geojson_dict = json.loads(json_file.read())
-            if "Tracks" in geojson_path:
-                # special dealings with lot file
-                feature_type, feature_obj = geojson_feature_parser(geojson_dict, transform_to_polygons=True)
-                try:
-                    geojson_feature_string = json.dumps(feature_obj.getInfo())
-                    # cut off extension and directory for new extension and directory
-                    output_geojson_path = os.path.join("output_geojson", os.path.split(geojson_path.split(".")[0])[-1] + ".json")
-                    with open(output_geojson_path, 'w') as output_geojson:
-                        output_geojson.write(geojson_feature_string)
-                except Exception as e:
-                    print("Error attempting to convert ee object into geojson: ", e)
-            else:
-                feature_type, feature_obj = geojson_feature_parser(geojson_dict)
-            if feature_type is None or feature_obj is None: # this c
-                print(f"Full file {geojson_path} returned invalid features")
-                continue
-            ee_objects.append(feature_obj)
-    return ee_objects
+        feature_obj = parse_local_features(geojson_dict, geojson_path)
+        if feature_obj is not None:
+            local_objects.append((geojson_path, feature_obj))
+    return local_objects
+
+
+def parse_local_features(geojson_dict, path):
+    '''
+    Takes in a full geojson dict and the path/name of the file it came from
+    Returns the parsed local FeatureCollection or Feature, or None if it has no valid features
+    Lots in the tracks file are turned into polygons, which are also written to output_geojson/
+    '''
+    if "Tracks" in path:
+        # special dealings with lot file
+        feature_type, feature_obj = geojson_feature_parser(geojson_dict, transform_to_polygons=True)
+        if feature_obj is not None:
+            write_output_geojson(feature_obj, path)
+    else:
+        feature_type, feature_obj = geojson_feature_parser(geojson_dict)
+    if feature_type is None or feature_obj is None:
+        print(f"Full file {path} returned invalid features")
+        return None
+    return feature_obj
+
+
+def parse_local_geometries(geometries, path, hull="convex", buffer=LOT_BUFFER):
+    '''
+    Same as parse_local_features, but takes in a GeometryArray (see read_kmz_geometries)
+        so the coordinates stay in its buffers until the final geojson dict is built
+    '''
+    # some of the LineStrings only have one point, GEE will throw an error at this
+    # (the indices of the rest are passed on, so the buffers are never copied to drop them)
+    keep = [j for j, geometry_type in enumerate(geometries.geometry_types)
+            if geometry_type != "LineString" or len(geometries.vertices(j)) > 1]
+    if len(keep) == 0:
+        raise Exception("Attempt to return empty feature collection")
+    if "Tracks" in path:
+        # special dealings with lot file
+        feature_obj = {"type": "FeatureCollection",
+                       "features": turn_lots_into_polygons(geometries, hull=hull, buffer=buffer, indices=keep)}
+        write_output_geojson(feature_obj, path)
+        return feature_obj
+    return geometries.to_geojson(keep)
+
+
+def write_output_geojson(feature_obj, path):
+    ''' Writes the polygons made from the lot file to output_geojson/, named after the source file '''
+    output_geojson_path = os.path.join("output_geojson", kml_name(path) + ".json")
+    os.makedirs("output_geojson", exist_ok=True)
+    with open(output_geojson_path, 'w') as output_geojson:
+        output_geojson.write(json.dumps(feature_obj))
+
+
+def geojson_to_earth_engine(geojson_file_paths):
+    '''
+    Takes in list file paths for geojson files
+    Returns a list of earth engine objects, where each element of the list
+        represents the feature or collection of features for each geojson file
+    '''
+    return [local_to_earth_engine(feature_obj) for _, feature_obj in geojson_to_local_features(geojson_file_paths)]
 
 
 def geojson_feature_parser(gj, transform_to_polygons=False):
     '''
-    Takes in full initial geojson and parses it into earth engine types:
+    Takes in full initial geojson and parses it into local geojson dicts:
         FeatureCollection
         Feature
-    Returns object in the form: feature_type : str, feature_object : ee object
+    with the altitude removed from every coordinate and unusable geometries dropped.
+    Returns object in the form: feature_type : str, feature_object : dict
     '''
     if type(gj) is not dict:
         print(f"json structure is not a dict it is a {str(type(gj))}")
-        return None
+        return None, None
     if gj["type"] == "FeatureCollection":
         feature_list = []
         for json_feature in gj["features"]: # assumes it has the features member
             if json_feature["type"] != "Feature":
                 raise Exception("geojson_feature_parser: not a feature type: " + json_feature["type"])
-                continue
             feature_type, feature_obj = geojson_feature_parser(json_feature)
             if feature_type is None or feature_obj is None:
                 continue
@@ -93,19 +314,38 @@ def geojson_feature_parser(gj, transform_to_polygons=False):
             raise Exception("Attempt to return empty feature collection")
         if transform_to_polygons: # used for the lot data
             feature_list = turn_lots_into_polygons(feature_list)
-        return "FeatureCollection", ee.FeatureCollection(feature_list)
+        return "FeatureCollection", {"type": "FeatureCollection", "features": feature_list}
     elif gj["type"] == "Feature":
-        # Need to turn into Feature object
         geometry_type, geometry = geojson_geometry_parser(gj["geometry"])
         if geometry_type is None or geometry is None: # single point line string
             return None, None
         properties = gj["properties"]
-        return "Feature", ee.Feature(geometry, properties)
+        return "Feature", {"type": "Feature", "properties": properties, "geometry": geometry}
         # type not used now, but might be useful
     else:
         raise Exception("geojson_feature_parser: unhandled type: " + gj["type"])
 
 
+def local_to_earth_engine(feature_obj):
+    '''
+    Takes in a local geojson FeatureCollection or Feature dict (from geojson_feature_parser)
+    Returns the matching ee.FeatureCollection or ee.Feature.
+    This is the only place earth engine objects get built, so it should be called once per
+        object, right before exporting.
+    '''
+    if feature_obj["type"] == "FeatureCollection":
+        return ee.FeatureCollection([local_to_earth_engine(feature) for feature in feature_obj["features"]])
+    elif feature_obj["type"] == "Feature":
+        return ee.Feature(ee.Geometry(feature_obj["geometry"]), feature_obj["properties"])
+    else:
+        raise Exception("local_to_earth_engine: unhandled type: " + feature_obj["type"])
+
+
+EARTH_RADIUS = 6371000     # radius of Earth in meters
+# max number of pairwise distances computed at once by the vectorized haversine functions (~8 MB per temporary)
+DISTANCE_CHUNK_SIZE = 1 << 20
+
+
 class Haversine:
     '''
     from: https://nathanrooy.github.io/posts/2016-09-07/haversine-with-python/
@@ -114,13 +354,13 @@ class Haversine:
     two lon/lat coordnate pairs.
     output distance available in kilometers, meters, miles, and feet.
     example usage: Haversine([lon1,lat1],[lon2,lat2]).feet
-    
+
+    For more than a handful of pairs use haversine_distances / within_tolerance_mask instead.
     '''
     def __init__(self,coord1,coord2):
         lon1,lat1=coord1
         lon2,lat2=coord2
-        
-        R=6371000                               # radius of Earth in meters
+
         phi_1=math.radians(lat1)
         phi_2=math.radians(lat2)
 
@@ -131,125 +371,566 @@ class Haversine:
            math.cos(phi_1)*math.cos(phi_2)*\
            math.sin(delta_lambda/2.0)**2
         c=2*math.atan2(math.sqrt(a),math.sqrt(1-a))
-        
-        self.meters=R*c                         # output distance in meters
-        self.km=self.meters/1000.0              # output distance in kilometers
-        self.miles=self.meters*0.000621371      # output distance in miles
-        self.feet=self.miles*5280               # output distance in feet
 
-def turn_lots_into_polygons(features):
+        self.meters=EARTH_RADIUS*c              # output distance in meters
+
+    @property
+    def km(self):
+        return self.meters/1000.0               # output distance in kilometers
+
+    @property
+    def miles(self):
+        return self.meters*0.000621371          # output distance in miles
+
+    @property
+    def feet(self):
+        return self.miles*5280                  # output distance in feet
+
+
+def as_coordinate_array(coords):
+    '''
+    Takes in a coordinate or a list of coordinates: [[long1, lat1], [long2, lat2], ...]
+    Returns them as an N x 2 float64 array (any altitude values are dropped)
     '''
-    Takes in a list of ee feature objects
-    If any objects contain points that are within the tolerance of each other,
-        then these objects are combined into one polygon
+    array = np.asarray(coords, dtype=np.float64)
+    if array.size == 0:
+        return array.reshape(0, 2)
+    if array.ndim == 1:
+        array = array.reshape(1, -1)
+    return array[:, :2]
 
-    TOLERANCE = 10 meters (honestly if I could get this into a reliable lat, long magnitude, that'd be good)
 
-    (broadly going to ignore single points)
-    for each feature (f1):
-        list_of_points_to_form_polygon = coordinates of feature
-        if this feature has been seen or marked off:
-            continue
-        otherwise:
-            mark it as seen
-            if its a single point:
-                continue
-            for each point in f1 (p1):
-                for each feature (f2):
-                    if this feature has been seen or marked off:
-                        continue
-                    otherwise:
-                        if its a single point:
-                            continue
-                        for each point in this f2 (p2):
-                            if p1 and p2 are within the tolerance (this means we need to combine features):
-                                list_of_points_to_form_polygon.extend(all the coordinates from f2)
-                                break
-    '''
-    BUFFER = 10  # buffer to expand lot polygons by (in meters)
-    # How far apart lots must be to be combined into one polygon, 2.1*BUFFER as to not have buffered polygons overlap
-    TOLERANCE = 2.1 * BUFFER  
-    
-    temp_list = [12, 20, 79, 91]
-    temp_list2 = [902, 1326, 138, 126]
-    print('Number of features:', len(features))
-    time.sleep(2)
-    new_feature_list = []
-    skip_dict = {}      # an attempt to not edit the list while iterating through it in order to ignore features we've already turned into polygons
-    for i, feature in enumerate(features):
-        if i not in temp_list:
+def _haversine_terms(radians1, radians2):
+    '''
+    Takes in a K x 2 and an M x 2 array of [long, lat] in radians
+    Returns the K x M array of the haversine "a" term (sin^2 of half the central angle)
+    '''
+    lon1, lat1 = radians1[:, 0:1], radians1[:, 1:2]
+    lon2, lat2 = radians2[:, 0], radians2[:, 1]
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return np.clip(a, 0.0, 1.0, out=a)
+
+
+def _chunk_rows(num_columns, chunk_size):
+    ''' Number of rows of an (rows x num_columns) block that fit in chunk_size elements '''
+    return max(1, chunk_size // max(1, num_columns))
+
+
+def haversine_distances(coords1, coords2, chunk_size=DISTANCE_CHUNK_SIZE):
+    '''
+    Vectorized haversine.
+    Takes in N and M coordinates ([[long1, lat1], ...], lists or arrays)
+    Returns the N x M array of distances between them in meters
+    The rows are computed chunk_size distances at a time to keep the temporaries small
+    '''
+    radians1 = np.radians(as_coordinate_array(coords1))
+    radians2 = np.radians(as_coordinate_array(coords2))
+    distances = np.empty((len(radians1), len(radians2)))
+    rows = _chunk_rows(len(radians2), chunk_size)
+    for start in range(0, len(radians1), rows):
+        a = _haversine_terms(radians1[start:start + rows], radians2)
+        distances[start:start + rows] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    return distances
+
+
+def _tolerance_threshold(tolerance):
+    ''' Haversine "a" term of a distance of tolerance meters, so we can skip the arcsin/sqrt '''
+    return math.sin(min(tolerance / (2 * EARTH_RADIUS), math.pi / 2)) ** 2
+
+
+def within_tolerance_mask(tolerance, coords1, coords2, chunk_size=DISTANCE_CHUNK_SIZE):
+    '''
+    Takes in N and M coordinates
+    Returns an N x M boolean array, True where the pair is within the tolerance (in meters)
+    '''
+    radians1 = np.radians(as_coordinate_array(coords1))
+    radians2 = np.radians(as_coordinate_array(coords2))
+    threshold = _tolerance_threshold(tolerance)
+    mask = np.empty((len(radians1), len(radians2)), dtype=bool)
+    rows = _chunk_rows(len(radians2), chunk_size)
+    for start in range(0, len(radians1), rows):
+        mask[start:start + rows] = _haversine_terms(radians1[start:start + rows], radians2) <= threshold
+    return mask
+
+
+def any_within_tolerance(tolerance, coords1, coords2, chunk_size=DISTANCE_CHUNK_SIZE):
+    '''
+    Checks if any coordinate in coords1 is within the tolerance (in meters) of any in coords2
+    Stops at the first chunk with a match, and never holds more than one chunk in memory
+    '''
+    radians1 = np.radians(as_coordinate_array(coords1))
+    radians2 = np.radians(as_coordinate_array(coords2))
+    if len(radians1) == 0 or len(radians2) == 0:
+        return False
+    threshold = _tolerance_threshold(tolerance)
+    rows = _chunk_rows(len(radians2), chunk_size)
+    for start in range(0, len(radians1), rows):
+        if (_haversine_terms(radians1[start:start + rows], radians2) <= threshold).any():
+            return True
+    return False
+
+
+class UnionFind:
+    '''
+    Disjoint-set over the integers 0..n-1.
+    Used to group lots that touch each other, either directly or through
+    a chain of other lots, so merging is transitive.
+    '''
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]    # path halving
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return False
+        # keep the smaller index as the root so groups are ordered by their first lot
+        if root_j < root_i:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        return True
+
+    def groups(self):
+        ''' Returns the sets as lists of members, ordered by their smallest member '''
+        groups = {}
+        for i in range(len(self.parent)):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+
+def find_connected_lots(coordinate_lists, tolerance):
+    '''
+    Takes in a list of coordinate lists (one per lot: [[long1, lat1], [long2, lat2], ...])
+    Returns a list of groups of lot indices, where every lot in a group is connected to
+        another lot in the group by a pair of points within the tolerance (in meters)
+
+    Points are projected onto a local equirectangular plane and hashed into a grid
+        with cells as wide as the tolerance. Only lots sharing a 3x3 block of cells are
+        candidates, and each candidate pair is checked with one vectorized haversine call.
+    '''
+    union_find = UnionFind(len(coordinate_lists))
+    coordinate_arrays = [as_coordinate_array(coords) for coords in coordinate_lists]
+    if sum(len(coords) for coords in coordinate_arrays) == 0:
+        return union_find.groups()
+    # use the smallest cos(lat) in the data so projected x distances never overestimate,
+    # and pad the cell size a little so no pair within the tolerance falls outside the 3x3 block
+    max_abs_lat = max(np.abs(coords[:, 1]).max() for coords in coordinate_arrays if len(coords))
+    x_scale = EARTH_RADIUS * math.cos(math.radians(max_abs_lat))
+    y_scale = EARTH_RADIUS
+    # with no buffer the tolerance is 0, lots sharing a point still land in the same cell
+    cell_size = max(tolerance, 1) * 1.01
+
+    # cell -> lots with at least one point in the cell
+    grid = {}
+    lot_cells = []
+    for i, coords in enumerate(coordinate_arrays):
+        radians = np.radians(coords)
+        cells = set(zip(np.floor(radians[:, 0] * x_scale / cell_size).astype(np.int64).tolist(),
+                        np.floor(radians[:, 1] * y_scale / cell_size).astype(np.int64).tolist()))
+        for cell in cells:
+            grid.setdefault(cell, set()).add(i)
+        lot_cells.append(cells)
+
+    # only look forward so each pair of lots is a candidate once
+    candidates = set()
+    for i, cells in enumerate(lot_cells):
+        for cx, cy in cells:
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for j in grid.get((cx + dx, cy + dy), ()):
+                        if j > i:
+                            candidates.add((i, j))
+
+    for i, j in sorted(candidates):
+        # skip lots that are already in the same group
+        if union_find.find(i) == union_find.find(j):
             continue
-        print('top feature', i)
+        if within_tolerance(tolerance, coordinate_arrays[i], coordinate_arrays[j]):
+            union_find.union(i, j)
+    return union_find.groups()
+
+
+def find_connected_lots_nested(coordinate_lists, tolerance):
+    '''
+    Original O(F^2 * P^2) merge: compares every point of every lot against every point
+        of every other lot. Only lots directly touching the first lot of a group are merged
+        (not transitive). Kept as a reference for benchmarking find_connected_lots.
+    Returns a list of groups of lot indices
+    '''
+    groups = []
+    skip_dict = {}      # ignore lots we've already put into a group
+    for i, coordinates in enumerate(coordinate_lists):
         if i in skip_dict:
             continue
-        feature_info = feature.getInfo()
         skip_dict[i] = True
-        coordinates = get_feature_coordinates(feature_info)
-        if coordinates is None:
-            continue
-        coordinates_to_combine = copy.deepcopy(coordinates)    # beware deep copy
-        if id(coordinates[0]) == id(coordinates_to_combine[0]):
-            print(type(coordinates[0]))
-            raise Exception("Deep copy failed")
-        t1 = time.perf_counter()
-        for j, nested_feature in enumerate(features):
-            #print('nested feature', j)
-            if j not in temp_list2:
-                continue
+        group = [i]
+        for j, nested_coordinates in enumerate(coordinate_lists):
             if j in skip_dict:
                 continue
-            nested_feature_info = nested_feature.getInfo()
-            nested_coordinates = get_feature_coordinates(nested_feature_info)
-            if nested_coordinates is None:
-                continue
             coords_combined = False
             for c1 in coordinates:
                 if coords_combined:
                     break
                 for c2 in nested_coordinates:
-                    if within_tolerance(TOLERANCE, c1, c2):
-                        print(f'collision between features {i} and {j}:', c1, c2)
-                        coordinates_to_combine.extend(nested_coordinates)
+                    if within_tolerance(tolerance, c1, c2):
+                        group.append(j)
                         coords_combined = True
                         skip_dict[j] = True
                         break
-        t2 = time.perf_counter()
-        print('time elapsed:', t2-t1, 'seconds')
-        polygon = ee.Geometry.Polygon(remove_duplicate_coordinates(coordinates_to_combine))
-        #polygon = polygon.buffer(BUFFER)
+        groups.append(group)
+    return groups
+
+
+def turn_lots_into_polygons(features, mode="grid", hull="convex", buffer=LOT_BUFFER, indices=None):
+    '''
+    Takes in a list of geojson feature dicts (from geojson_feature_parser) or a GeometryArray,
+        of which only the geometries at indices are used if given
+    If any features contain points that are within the tolerance of each other,
+        then these features are combined into one polygon
+    Returns a list of geojson Polygon feature dicts, with the number of lots, area and
+        validity of each polygon as properties (see build_lot_polygon)
+
+    TOLERANCE = 2.1 * buffer meters
+
+    mode selects how touching lots are found:
+        "grid": spatial hash over projected coordinates, merging is transitive
+            (union-find over connected lots), see find_connected_lots
+        "nested": original pairwise comparison of every point, see find_connected_lots_nested
+    hull and buffer (in meters, 0 for none) select how the polygon is built, see build_lot_polygon
+    Single points and features with 1 or less coordinates are ignored.
+    '''
+    # How far apart lots must be to be combined into one polygon, 2.1*buffer as to not have buffered polygons overlap
+    TOLERANCE = 2.1 * buffer
+
+    if not isinstance(features, GeometryArray):
+        features = GeometryArray.from_geojson({"type": "FeatureCollection", "features": features})
+    indices = range(len(features)) if indices is None else indices
+    print('Number of features:', len(indices))
+    # views into the GeometryArray buffer, nothing is copied until the polygons are built
+    coordinate_lists = []
+    for j in indices:
+        geometry_type = features.geometry_types[j]
+        if geometry_type == "Point":  # ignore single points
+            continue
+        elif geometry_type in ("LineString", "LinearRing"):
+            coordinates = features.vertices(j)
+            if len(coordinates) > 1:
+                coordinate_lists.append(coordinates)
+        else:
+            print("Unhandled geometry: ", geometry_type)
+
+    t1 = time.perf_counter()
+    if mode == "grid":
+        groups = find_connected_lots(coordinate_lists, TOLERANCE)
+    elif mode == "nested":
+        groups = find_connected_lots_nested([coords.tolist() for coords in coordinate_lists], TOLERANCE)
+    else:
+        raise Exception("turn_lots_into_polygons: unhandled mode: " + mode)
+    t2 = time.perf_counter()
+    print(f'Merged {len(coordinate_lists)} lots into {len(groups)} polygons in {t2-t1} seconds')
+
+    new_feature_list = []
+    all_metrics = []
+    for group in groups:
+        coordinates_to_combine = np.concatenate([coordinate_lists[i] for i in group])
+        ring, metrics = build_lot_polygon(coordinates_to_combine, hull, buffer)
+        all_metrics.append(metrics)
+        polygon = {
+            "type": "Feature",
+            "properties": {"lots": len(group), "area_m2": round(metrics["area_m2"], 1), "valid": metrics["valid"]},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [ring]
+            }
+        }
         new_feature_list.append(polygon)
+    print(f'Built {len(all_metrics)} {hull} polygons in {time.perf_counter()-t2} seconds')
+    print_polygon_metrics(all_metrics)
     return new_feature_list
 
+
+def build_lot_polygon(coordinates, hull="convex", buffer=LOT_BUFFER, alpha=None):
+    '''
+    Takes in an N x 2 array of [long, lat] lot coordinates
+    Returns (ring, metrics): a closed polygon ring of [long, lat] lists, and the
+        polygon_metrics of that ring
+
+    hull:
+        "convex": convex hull of the points (monotone chain, O(N log N))
+        "concave": alpha shape of the points (O(N log N) Delaunay triangulation, needs scipy,
+            falls back to convex without it), see alpha_shape for the default alpha
+        "raw": the deduplicated points in the order they came in (the old behaviour,
+            usually self-intersecting)
+    buffer: meters to grow the polygon by, done locally instead of with ee's buffer
+    '''
+    coordinates = remove_duplicate_coordinates(as_coordinate_array(coordinates).tolist())
+    origin = np.mean(coordinates, axis=0)
+    points = project_to_meters(coordinates, origin)
+    if hull == "raw":
+        ring = points[:-1]
+    elif hull == "convex":
+        ring = convex_hull(points)
+        if buffer > 0:
+            # the hull of the buffered hull vertices is the same as of all buffered points
+            ring = convex_hull(buffer_points(ring, buffer))
+    elif hull == "concave":
+        ring = alpha_shape(points, alpha)
+        if buffer > 0:
+            ring = buffer_ring(ring, buffer)
+    else:
+        raise Exception("build_lot_polygon: unhandled hull: " + hull)
+    metrics = polygon_metrics(ring)
+    ring = project_to_degrees(ring, origin).tolist()
+    if len(ring) > 0:
+        ring.append(ring[0])    # close the ring
+    return ring, metrics
+
+
+def project_to_meters(coordinates, origin):
+    '''
+    Projects [long, lat] coordinates onto a plane in meters centered on origin ([long, lat])
+    (equirectangular, which is plenty accurate over the size of a farm)
+    '''
+    coordinates = as_coordinate_array(coordinates)
+    x_scale = EARTH_RADIUS * math.cos(math.radians(origin[1]))
+    return np.column_stack([np.radians(coordinates[:, 0] - origin[0]) * x_scale,
+                            np.radians(coordinates[:, 1] - origin[1]) * EARTH_RADIUS])
+
+
+def project_to_degrees(points, origin):
+    ''' Inverse of project_to_meters '''
+    points = as_coordinate_array(points)
+    x_scale = EARTH_RADIUS * math.cos(math.radians(origin[1]))
+    return np.column_stack([origin[0] + np.degrees(points[:, 0] / x_scale),
+                            origin[1] + np.degrees(points[:, 1] / EARTH_RADIUS)])
+
+
+def convex_hull(points):
+    '''
+    Andrew's monotone chain convex hull, O(N log N)
+    Takes in an N x 2 array of projected points
+    Returns the hull vertices as an H x 2 array in counter-clockwise order (not closed).
+        Fewer than 3 vertices means all the points are the same or on one line.
+    '''
+    points = np.unique(as_coordinate_array(points), axis=0)   # also sorts by x, then y
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower = []
+    upper = []
+    for p in points.tolist():
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    for p in reversed(points.tolist()):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def buffer_points(points, distance, segments=16):
+    '''
+    Replaces each projected point with a polygon of segments vertices around it, drawn
+        so it contains the circle of radius distance (in meters)
+    '''
+    points = as_coordinate_array(points)
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    radius = distance / math.cos(math.pi / segments)
+    offsets = radius * np.column_stack([np.cos(angles), np.sin(angles)])
+    return (points[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+
+
+def buffer_ring(ring, distance):
+    '''
+    Grows a projected (possibly concave) polygon ring by distance meters
+    The edges are densified and every point is replaced by a circle (buffer_points), then the
+        outer boundary of those circles is traced with an alpha shape, so concavities narrower
+        than 2 * distance get filled in just like a real buffer would
+    '''
+    ring = as_coordinate_array(ring)
+    if len(ring) < 2:
+        return convex_hull(buffer_points(ring, distance))
+    start, end = ring, np.roll(ring, -1, axis=0)
+    steps = np.maximum(1, np.ceil(np.linalg.norm(end - start, axis=1) / (distance / 2))).astype(np.int64)
+    densified = np.concatenate([start[i] + (end[i] - start[i]) * (np.arange(steps[i])[:, None] / steps[i])
+                                for i in range(len(ring))])
+    return alpha_shape(buffer_points(densified, distance), distance)
+
+
+def alpha_shape(points, alpha=None):
+    '''
+    Concave hull: keeps the Delaunay triangles with a circumradius of at most alpha (meters)
+        and returns the outer boundary ring of what's left, counter-clockwise (not closed)
+    alpha defaults to the smallest value that keeps at least one triangle around every point,
+        since track points are too unevenly spaced for one fixed value
+    Falls back to the convex hull if scipy isn't installed, the points are degenerate or
+        alpha is too small to keep any triangles
+    '''
+    try:
+        from scipy.spatial import Delaunay
+    except ImportError:
+        print("scipy is not installed, using a convex hull instead of a concave one")
+        return convex_hull(points)
+    points = np.unique(as_coordinate_array(points), axis=0)
+    if len(points) < 4:
+        return convex_hull(points)
+    try:
+        triangles = Delaunay(points).simplices
+    except Exception:   # qhull fails when every point is on one line
+        return convex_hull(points)
+
+    a, b, c = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    doubled_area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+    # orient every triangle counter-clockwise so the boundary edges chain in one direction
+    clockwise = doubled_area < 0
+    triangles[clockwise] = triangles[clockwise][:, [0, 2, 1]]
+    side_lengths = np.linalg.norm(a - b, axis=1) * np.linalg.norm(b - c, axis=1) * np.linalg.norm(c - a, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        circumradius = side_lengths / (2 * np.abs(doubled_area))
+    circumradius[doubled_area == 0] = np.inf
+
+    if alpha is None:
+        smallest_around_point = np.full(len(points), np.inf)
+        for k in range(3):
+            np.minimum.at(smallest_around_point, triangles[:, k], circumradius)
+        alpha = smallest_around_point.max()
+    triangles = triangles[circumradius <= alpha]
+    if len(triangles) == 0:
+        return convex_hull(points)
+
+    # directed edges whose reverse isn't in the kept triangles are on the boundary
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]).astype(np.int64)
+    boundary = ~np.isin(edges[:, 1] * len(points) + edges[:, 0], edges[:, 0] * len(points) + edges[:, 1])
+    next_vertices = {}
+    for start, end in edges[boundary].tolist():
+        next_vertices.setdefault(start, []).append(end)
+
+    rings = []
+    while next_vertices:
+        start = next(iter(next_vertices))
+        ring = [start]
+        vertex = start
+        while True:
+            following = next_vertices[vertex].pop()
+            if not next_vertices[vertex]:
+                del next_vertices[vertex]
+            if following == start or following not in next_vertices:
+                break
+            ring.append(following)
+            vertex = following
+        rings.append(points[ring])
+    # the outer boundary is the ring with the largest counter-clockwise area (holes run clockwise)
+    return max(rings, key=lambda ring: np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1]))
+
+
+def polygon_metrics(ring):
+    '''
+    Takes in a projected (meters) polygon ring as an H x 2 array (not closed)
+    Returns a dict of simple validity checks:
+        vertices, area_m2, ccw (counter-clockwise, as geojson wants the outer ring),
+        simple (no two non-adjacent edges cross), valid (all of the above and 3+ vertices)
+    '''
+    ring = as_coordinate_array(ring)
+    if len(ring) < 3:
+        return {"vertices": len(ring), "area_m2": 0.0, "ccw": False, "simple": False, "valid": False}
+    x, y = ring[:, 0], ring[:, 1]
+    signed_area = 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+    simple = not ring_self_intersects(ring)
+    return {
+        "vertices": len(ring),
+        "area_m2": float(abs(signed_area)),
+        "ccw": bool(signed_area > 0),
+        "simple": simple,
+        "valid": bool(signed_area > 0) and simple,
+    }
+
+
+def ring_self_intersects(ring):
+    ''' Checks if any two non-adjacent edges of the (unclosed) ring properly cross each other '''
+    p, q = ring, np.roll(ring, -1, axis=0)     # edge i goes from p[i] to q[i]
+    n = len(ring)
+
+    def orientation(a, b, c):
+        return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+
+    rows = _chunk_rows(n, DISTANCE_CHUNK_SIZE)
+    for start in range(0, n, rows):
+        i = np.arange(start, min(start + rows, n))[:, None]
+        j = np.arange(n)[None, :]
+        p1, q1 = p[i[:, 0]][:, None, :], q[i[:, 0]][:, None, :]
+        p2, q2 = p[None, :, :], q[None, :, :]
+        crosses = (orientation(p1, q1, p2) * orientation(p1, q1, q2) < 0) & \
+                  (orientation(p2, q2, p1) * orientation(p2, q2, q1) < 0)
+        # only count each pair once, and skip edges that share a vertex
+        adjacent = (j <= i + 1) | ((i == 0) & (j == n - 1))
+        if (crosses & ~adjacent).any():
+            return True
+    return False
+
+
+def print_polygon_metrics(all_metrics):
+    ''' Prints a summary of polygon_metrics over all the polygons built '''
+    if len(all_metrics) == 0:
+        return
+    valid = sum(metrics["valid"] for metrics in all_metrics)
+    vertices = [metrics["vertices"] for metrics in all_metrics]
+    area = sum(metrics["area_m2"] for metrics in all_metrics)
+    print(f'{valid}/{len(all_metrics)} valid polygons, {min(vertices)}-{max(vertices)} vertices, '
+          f'{area / 10000:.1f} hectares total')
+
 def remove_duplicate_coordinates(coords):
     '''
-    Takes in a list of coordinates: [[lat1, long1], [lat2, long2], ...]
-    Removes duplicate coordinates in the list,
+    Takes in a list of coordinates: [[long1, lat1], [long2, lat2], ...]
+    Removes duplicate coordinates in the list (keeping the first occurrence, in order),
         then duplicates the first coordinate to complete the polygon path
+
+    A coordinate is a duplicate if both values are math.isclose to a coordinate we've kept.
+        Kept coordinates are hashed into a grid with cells at least that wide, so each
+        coordinate is only compared against the kept ones in the neighbouring cells.
     '''
     # how close can coords be for them to be the same
     tolerance = 0.0000001 # ~ couple inches max difference, default float eq is more precise
     if len(coords) < 2: # might wanna raise an exception
         return coords
+    # isclose allows a difference of up to tolerance * max(|a|, |b|), so the largest
+    # magnitude on each axis bounds how far apart two duplicates can be
+    cell_x = tolerance * max(abs(c[0]) for c in coords) * 1.01 or 1.0
+    cell_y = tolerance * max(abs(c[1]) for c in coords) * 1.01 or 1.0
+    grid = {}       # cell -> kept coordinates in that cell
     new_coords = []
-    skip_list = []
-    for i, c1 in enumerate(coords):
-        if i in skip_list:
-            continue
-        skip_list.append(i)
-        new_coords.append(c1)
-        for j, c2 in enumerate(coords):
-            if j in skip_list:
-                continue
-            if math.isclose(c1[0], c2[0], rel_tol=tolerance) and math.isclose(c1[1], c2[1], rel_tol=tolerance):
-                # c2 is a duplicate of c1
-                skip_list.append(j)
+    for c in coords:
+        cx = math.floor(c[0] / cell_x)
+        cy = math.floor(c[1] / cell_y)
+        if not _has_close_coordinate(grid, cx, cy, c, tolerance):
+            new_coords.append(c)
+            grid.setdefault((cx, cy), []).append(c)
     new_coords.append(new_coords[0])
     return new_coords
-    
+
+
+def _has_close_coordinate(grid, cx, cy, c1, tolerance):
+    ''' Checks the 3x3 block of grid cells around (cx, cy) for a coordinate isclose to c1 '''
+    for dx in (0, -1, 1):       # own cell first, that's where exact duplicates are
+        for dy in (0, -1, 1):
+            for c2 in grid.get((cx + dx, cy + dy), ()):
+                if math.isclose(c1[0], c2[0], rel_tol=tolerance) and math.isclose(c1[1], c2[1], rel_tol=tolerance):
+                    return True
+    return False
+
 
 def get_feature_coordinates(feature_info):
     ''' 
-    Returns a list of coordinates from a ee feature object's info ( Feature.getInfo() )
+    Returns a list of coordinates from a geojson feature dict (or an ee feature object's info)
     Returns None if the feature is a point or unhandled geometry type or if there is 1 or less coordinates
     '''
     if feature_info['geometry']['type'] == 'Point':  # ignore single points
@@ -270,27 +951,31 @@ def get_feature_coordinates(feature_info):
 
 
 def within_tolerance(tolerance, c1, c2):
-    ''' Checks if two coordinates are within the tolerance of each other (assumes meters)'''
-    if Haversine(c1,c2).meters <= tolerance:
-        return True
-    return False
+    '''
+    Checks if two coordinates are within the tolerance of each other (assumes meters)
+    c1 and c2 can also be lists/arrays of coordinates, in which case it checks if
+        any pair of points between them is within the tolerance (see any_within_tolerance)
+    '''
+    if np.isscalar(c1[0]) and np.isscalar(c2[0]):
+        return Haversine(c1[:2],c2[:2]).meters <= tolerance
+    return any_within_tolerance(tolerance, c1, c2)
 
 
 def geojson_geometry_parser(geometry):
     ''' 
-    Turns GeoJSON geometry into an ee.Geometry() object.
+    Turns GeoJSON geometry into a local geometry dict that can be given to ee.Geometry().
     Our kmz files inlcude elevation data for each coordinate, which GEE does
     not seem to support. Consequently, we must remove this data before
     creating the geometry object.
     '''
-    geometry["coordinates"] = remove_altitude(geometry["coordinates"])
+    geometry = {"type": geometry["type"], "coordinates": remove_altitude(geometry["coordinates"])}
     # some of the LineStrings only have one point, GEE will throw an error at this
     if geometry["type"] == "LineString" and len(geometry["coordinates"]) < 2:
         # returning Nones because a single point is not helpful for forming polygons
         return None, None
         #geometry["type"] = "Point"
         #geometry["coordinates"] = geometry["coordinates"][0]
-    return geometry["type"], ee.Geometry(geometry)
+    return geometry["type"], geometry
 
 
 def remove_altitude(coordinates):
@@ -316,31 +1001,244 @@ def remove_altitude(coordinates):
 
 
 
+def asset_name(name):
+    ''' Turns a file path/name into the name of its Earth Engine asset '''
+    name = os.path.split(os.path.splitext(name)[0])[-1] # remove extension and folder
+    if "racks" in name:     # temp update to signify line string to polygon conversion in earth engine
+        name += "_polygons"
+    return name
+
+
 def export_ee_assets(ee_obj, name):
     '''
     Given a GEE object in memory and a name, uploads it to GEE so you can access it in the
     code editor.
     NOTE: change {username} to your Google username.
+    Returns the started export task
     '''
-    name = os.path.split(os.path.splitext(name)[0])[-1] # remove extension and folder
-    if "racks" in name:     # temp update to signify line string to polygon conversion in earth engine
-        name += "_polygons"
+    name = asset_name(name)
     task = ee.batch.Export.table.toAsset(collection=ee_obj, description=name, assetId=(f"users/{username}/" + name))
     task.start()
     print("Uploading " + name + " to GEE...")
+    return task
+
+
+class EarthEngineClient:
+    '''
+    The Earth Engine calls BatchExporter makes. Swap in an object with the same two methods
+        (e.g. a fake task backend) to run the exporter offline.
+    '''
+    def export_table_to_asset(self, feature_obj, description, asset_id):
+        ''' Starts exporting a local geojson FeatureCollection dict to asset_id, returns the task '''
+        task = ee.batch.Export.table.toAsset(collection=local_to_earth_engine(feature_obj),
+                                             description=description, assetId=asset_id)
+        task.start()
+        return task
+
+    def task_status(self, task):
+        ''' Returns the task's status dict, with at least "state" (and "error_message" if it failed) '''
+        return task.status()
+
+
+class BatchExporter:
+    '''
+    Exports local feature collections to Earth Engine assets:
+        - collections with more than shard_size features are split over several assets (name_0, name_1, ...)
+        - exports are submitted from a thread pool, keeping at most max_in_flight tasks unfinished
+            (None for no limit), polling for room when there are more
+        - task states are polled with a backoff (poll_interval, doubling up to max_poll_interval
+            while nothing changes) and written to a json manifest of asset ids as they change
+        - a task whose status can't be checked max_status_failures times in a row is marked FAILED
+    '''
+    def __init__(self, client=None, max_in_flight=EXPORT_MAX_IN_FLIGHT, threads=4, shard_size=None,
+                 manifest_path=EXPORT_MANIFEST, poll_interval=EXPORT_POLL_INTERVAL,
+                 max_poll_interval=EXPORT_MAX_POLL_INTERVAL, max_status_failures=EXPORT_MAX_STATUS_FAILURES,
+                 sleep=time.sleep):
+        self.client = client if client is not None else EarthEngineClient()
+        self.max_in_flight = max(1, max_in_flight) if max_in_flight is not None else None
+        self.threads = max(1, threads)
+        self.shard_size = shard_size
+        self.manifest_path = manifest_path
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_status_failures = max(1, max_status_failures)
+        self.sleep = sleep
+        self.pending = []       # (description, asset_id, feature_obj) not submitted yet
+        self.in_flight = {}     # asset_id -> task
+        self.status_failures = {}   # asset_id -> status checks in a row that raised
+        self.manifest = self.load_manifest()
+
+    def add(self, feature_obj, name):
+        ''' Queues a local FeatureCollection (or Feature) dict to be exported under asset_name(name) '''
+        name = asset_name(name)
+        if feature_obj["type"] == "Feature":
+            features = [feature_obj]
+        else:
+            features = feature_obj["features"]
+        if self.shard_size and len(features) > self.shard_size:
+            shards = [features[i:i + self.shard_size] for i in range(0, len(features), self.shard_size)]
+            names = [f"{name}_{i}" for i in range(len(shards))]
+        else:
+            shards = [features]
+            names = [name]
+        for shard_name, shard in zip(names, shards):
+            self.pending.append((shard_name, f"users/{username}/" + shard_name,
+                                 {"type": "FeatureCollection", "features": shard}))
+
+    def run(self, wait=True):
+        '''
+        Submits every queued export, polling whenever max_in_flight tasks are unfinished until one
+            of them is done. With wait, keeps polling until all of them are done, otherwise returns
+            once the last one is submitted.
+        Returns the manifest: asset_id -> {"description", "task_id", "features", "state", "error_message"}
+        '''
+        interval = self.poll_interval
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while self.pending or (wait and self.in_flight):
+                if self.max_in_flight is None:
+                    started = self.submit(executor, len(self.pending))
+                else:
+                    started = self.submit(executor, self.max_in_flight - len(self.in_flight))
+                if not self.pending and not wait:
+                    break
+                if not self.in_flight:
+                    if not started:
+                        break   # nothing to wait for and nothing could be started
+                    continue
+                self.sleep(interval)
+                if self.poll():
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval * 2, self.max_poll_interval)
+        self.write_manifest()
+        return self.manifest
+
+    def submit(self, executor, count):
+        ''' Starts up to count pending exports concurrently. Returns the number of exports started '''
+        batch, self.pending = self.pending[:max(0, count)], self.pending[max(0, count):]
+
+        def start(export):
+            description, asset_id, feature_obj = export
+            return self.client.export_table_to_asset(feature_obj, description, asset_id)
+
+        futures = [executor.submit(start, export) for export in batch]
+        for (description, asset_id, feature_obj), future in zip(batch, futures):
+            entry = {"description": description, "task_id": None, "features": len(feature_obj["features"]),
+                     "state": None, "error_message": None}
+            try:
+                task = future.result()
+                entry["task_id"] = getattr(task, "id", None)
+                entry["state"] = "SUBMITTED"
+                self.in_flight[asset_id] = task
+                print("Uploading " + description + " to GEE...")
+            except Exception as e:
+                entry["state"] = "SUBMIT_FAILED"
+                entry["error_message"] = str(e)
+                print(f"Error starting export of {description}: {e}")
+            self.manifest[asset_id] = entry
+        if batch:
+            self.write_manifest()
+        return len(batch)
+
+    def poll(self):
+        ''' Checks the state of every in flight task. Returns True if any of them changed '''
+        changed = False
+        for asset_id, task in list(self.in_flight.items()):
+            entry = self.manifest[asset_id]
+            try:
+                status = self.client.task_status(task)
+            except Exception as e:
+                failures = self.status_failures.get(asset_id, 0) + 1
+                self.status_failures[asset_id] = failures
+                print(f"Error checking the export of {asset_id} ({failures}/{self.max_status_failures}): {e}")
+                if failures >= self.max_status_failures:
+                    # the task may still be running in Earth Engine, but it can't be followed from here
+                    changed = True
+                    entry["state"] = "FAILED"
+                    entry["error_message"] = f"status check failed {failures} times in a row: {e}"
+                    del self.in_flight[asset_id]
+                    del self.status_failures[asset_id]
+                continue
+            self.status_failures.pop(asset_id, None)
+            if status.get("state") != entry["state"]:
+                changed = True
+                entry["state"] = status.get("state")
+                entry["error_message"] = status.get("error_message")
+                print(f"{entry['description']}: {entry['state']}")
+            if entry["state"] in EXPORT_DONE_STATES:
+                del self.in_flight[asset_id]
+        if changed:
+            self.write_manifest()
+        return changed
+
+    def load_manifest(self):
+        ''' Reads the existing manifest (if any) so reruns add to it instead of replacing it '''
+        if self.manifest_path and os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                return json.loads(manifest_file.read())
+        return {}
+
+    def write_manifest(self):
+        if not self.manifest_path:
+            return
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, 'w') as manifest_file:
+            manifest_file.write(json.dumps(self.manifest, indent=2))
+        os.replace(temp_path, self.manifest_path)
+
+
+def export_local_features(local_objects, threads=1, client=None, wait=False, **exporter_options):
+    '''
+    Takes in a list of (name, feature_obj) tuples (from kmz_to_local_features)
+    Exports each one with a BatchExporter (see there for exporter_options, e.g. shard_size,
+        max_in_flight, manifest_path). With wait, blocks until every task is done.
+    Returns the export manifest
+    '''
+    exporter = BatchExporter(client=client, threads=threads, **exporter_options)
+    for name, feature_obj in local_objects:
+        exporter.add(feature_obj, name)
+    return exporter.run(wait=wait)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the kmz files in kmz/ into Earth Engine assets.")
+    parser.add_argument("-workers", "--workers", metavar="int",
+                        dest="workers", type=int, default=1,
+                        help="number of processes used to parse and merge the kmz files")
+    parser.add_argument("-exportthreads", "--et", metavar="int",
+                        dest="export_threads", type=int, default=4,
+                        help="number of threads used to submit the Earth Engine exports")
+    parser.add_argument("-shardsize", "--ss", metavar="int",
+                        dest="shard_size", type=int, default=None,
+                        help="split collections with more features than this over several assets")
+    parser.add_argument("-maxinflight", "--mif", metavar="int",
+                        dest="max_in_flight", type=int, default=EXPORT_MAX_IN_FLIGHT,
+                        help="max number of export tasks running at once (polls for room, even without -wait)")
+    parser.add_argument("-manifest", metavar="path/to/json",
+                        dest="manifest_path", type=str, default=EXPORT_MANIFEST,
+                        help="where to record the asset ids and task states")
+    parser.add_argument("-wait", "--w", dest="wait", action="store_true",
+                        help="poll the export tasks until they finish")
+    parser.add_argument("-hull", metavar="type", choices=LOT_HULLS, default="convex",
+                        help=f"how to turn merged lots into polygons: {', '.join(LOT_HULLS)}")
+    parser.add_argument("-buffer", "--b", metavar="meters", dest="buffer", type=float, default=LOT_BUFFER,
+                        help="meters to grow the lot polygons by (0 for none)")
+    parser.add_argument("-nocache", "--nc", dest="use_cache", action="store_false",
+                        help=f"always reparse the kmz files instead of using {KMZ_CACHE_DIR}/")
+    args = parser.parse_args()
+
     ee.Initialize()
-    kmz_file_paths = glob.glob(f"kmz{os.path.sep}*")
+    kmz_file_paths = sorted(glob.glob(f"kmz{os.path.sep}*"))
     print(kmz_file_paths)
-    # TODO: only need to generate geojson files once, maybe split into separate script
-    print("Converting kmz files to geoJSON files...")
-    geojson_file_paths = kmz_to_geojson(kmz_file_paths)
+    # parsed kmz files are cached in KMZ_CACHE_DIR, so this is only slow the first time
+    print("Parsing kmz files...")
+    local_objects = kmz_to_local_features(kmz_file_paths, use_cache=args.use_cache, workers=args.workers,
+                                          hull=args.hull, buffer=args.buffer)
     print("Generating GEE objects...")
-    ee_objects = geojson_to_earth_engine(geojson_file_paths)
-    for obj, name in zip(ee_objects, geojson_file_paths):
-        export_ee_assets(obj, name)
+    export_local_features(local_objects, threads=args.export_threads, wait=args.wait,
+                          shard_size=args.shard_size, max_in_flight=args.max_in_flight,
+                          manifest_path=args.manifest_path)
     
     
 if __name__ == "__main__":